@@ -7,19 +7,31 @@
 # consider it licensed as GPLv2+. Also, I'm sorry.
 
 import os
+import re
+import sys
+import json
+import mmap
 import time
 import struct
+import array
+import hashlib
+import binascii
 
 import usb.core
 import usb.util
 
 from usb.core import USBError
-from collections import namedtuple
+from collections import namedtuple, deque
 
+import queue
 import argparse
+import threading
+import concurrent.futures
 
 # unoptimized, translated from http://mdfs.net/Info/Comp/Comms/CRC16.htm
-def crc16(data, poly=0x1021, iv=0x0000, xorf=0x0000):
+# Kept around as the reference implementation for CRC16 below (and for
+# gk64bench.py to compare against); nothing else should be calling this.
+def crc16_bitwise(data, poly=0x1021, iv=0x0000, xorf=0x0000):
     crc = int(iv)
     for b in bytearray(data):
         crc ^= (b << 8)
@@ -29,6 +41,98 @@ def crc16(data, poly=0x1021, iv=0x0000, xorf=0x0000):
                 crc = (crc ^ poly) & 0xffff # xor with poly and trunc to 16bit
     return (crc & 0xffff) ^ xorf
 
+class CRC16(object):
+    '''Table-driven, incremental CRC16 (MSB-first, same math as crc16_bitwise)
+
+    Usage is hashlib-ish:
+
+        c = CRC16(poly=0x1021, iv=0xffff)
+        c.update(chunk1)
+        c.update(chunk2)
+        c.value()
+
+    The generic path is slice-by-2: two 256-entry tables, so each loop
+    iteration eats two bytes. Since the 0x1021 polynomial is the one
+    binascii.crc_hqx() implements (in C, and it takes an arbitrary starting
+    value), we just hand that one off to binascii - which is nice, because
+    0x1021 is what every packet and image checksum uses.
+    '''
+    _tables = dict()
+
+    def __init__(self, poly=0x1021, iv=0x0000, xorf=0x0000, data=None):
+        self.poly = poly & 0xffff
+        self.iv = iv & 0xffff
+        self.xorf = xorf & 0xffff
+        self.crc = self.iv
+        self._t1, self._t2 = self._get_tables(self.poly)
+        if data is not None:
+            self.update(data)
+
+    def __repr__(self):
+        return "<{} poly={:#06x} crc={:#06x}>".format(self.__class__.__name__,
+                                                      self.poly, self.value())
+
+    @classmethod
+    def _get_tables(cls, poly):
+        if poly not in cls._tables:
+            t1 = []
+            for b in range(256):
+                crc = b << 8
+                for _ in range(8):
+                    crc <<= 1
+                    if crc & 0x10000:
+                        crc = (crc ^ poly) & 0xffff
+                t1.append(crc)
+            # t2[x] is t1[x] pushed through one more (zero) byte, which lets
+            # us do: crc = t2[(crc >> 8) ^ b0] ^ t1[(crc & 0xff) ^ b1]
+            t2 = [((t & 0xff) << 8) ^ t1[t >> 8] for t in t1]
+            cls._tables[poly] = (t1, t2)
+        return cls._tables[poly]
+
+    def _update(self, crc, data):
+        if self.poly == 0x1021:
+            return binascii.crc_hqx(data, crc)
+        t1, t2 = self._t1, self._t2
+        data = memoryview(data).cast('B')
+        n = len(data) & ~1
+        for b0, b1 in zip(data[0:n:2], data[1:n:2]):
+            crc = t2[(crc >> 8) ^ b0] ^ t1[(crc & 0xff) ^ b1]
+        if n < len(data):
+            crc = ((crc << 8) & 0xffff) ^ t1[(crc >> 8) ^ data[n]]
+        return crc
+
+    def update(self, data):
+        '''Feed more data into the CRC. Returns self, so you can chain it.'''
+        self.crc = self._update(self.crc, data)
+        return self
+
+    def value(self):
+        return self.crc ^ self.xorf
+
+    def reset(self):
+        self.crc = self.iv
+        return self
+
+    def copy(self):
+        c = self.__class__.__new__(self.__class__)
+        c.__dict__.update(self.__dict__)
+        return c
+
+    def packets(self, data, size=0x40):
+        '''Bulk path: return a list of CRCs, one per size-byte chunk of data.
+
+        Each chunk is checksummed on its own (starting from iv), which is
+        what you want for a buffer full of 64-byte command packets. This
+        doesn't touch the running CRC.
+        '''
+        data = memoryview(data).cast('B')
+        iv, xorf, update = self.iv, self.xorf, self._update
+        return [update(iv, data[o:o+size]) ^ xorf
+                for o in range(0, len(data), size)]
+
+def crc16(data, poly=0x1021, iv=0x0000, xorf=0x0000):
+    return CRC16(poly, iv, xorf, data).value()
+
 def crc16_usb(data, iv=0xffff):
     return crc16(data, poly=0x8005, iv=0xffff, xorf=0xffff)
 
@@ -36,24 +140,98 @@ def mycrc16(data, iv=0xffff):
     return crc16(data, poly=0x1021, iv=0xffff, xorf=0x0000)
 
 
+# bytes.translate() table for the text column: printable ASCII stays, the
+# rest turns into dots
+_hexdump_printable = bytes(b if 0x20 <= b < 0x7f else 0x2e for b in range(256))
+
 def hexdump_line(data):
-    linedata = bytearray(data[:16])
-    hexbytes = ["%02x" % b for b in linedata] + (["  "] * (16-len(linedata)))
-    printable = ''.join(chr(b) if b >= 0x20 and b < 0x7f else '.' for b in linedata)
-    return '{}  {}   {} {}'.format(' '.join(hexbytes[:8]),
-                                   ' '.join(hexbytes[8:]),
+    linedata = bytes(data[:16])
+    hexbytes = binascii.hexlify(linedata, ' ').decode('ascii').ljust(47)
+    printable = linedata.translate(_hexdump_printable).decode('ascii')
+    return '{}  {}   {} {}'.format(hexbytes[:23],
+                                   hexbytes[24:],
                                    printable[:8],
                                    printable[8:])
 
-def hexdump_iterlines(data, start=0):
-    offset = 0
-    while offset < len(data):
-        yield "{:08x}  {}".format(start+offset,
-                                  hexdump_line(data[offset:offset+0x10]))
-
-def hexdump(data, start=0):
-    for line in hexdump_iterlines(data, start):
-        print(line)
+def _hexdump_rows(data, start=None):
+    # hexdump_line() for every 16-byte row of data, but with the hex and text
+    # conversion done in one go for the whole lot instead of row by row.
+    # If start is given, each row gets its address on the front.
+    data = bytes(data)
+    full = len(data) & ~0xf
+    hexbytes = binascii.hexlify(data[:full], ' ').decode('ascii')
+    printable = data[:full].translate(_hexdump_printable).decode('ascii')
+    if start is None:
+        rows = ['%s  %s   %s %s' % (hexbytes[h:h+23], hexbytes[h+24:h+47],
+                                    printable[t:t+8], printable[t+8:t+16])
+                for h, t in zip(range(0, full*3, 48), range(0, full, 16))]
+    else:
+        rows = ['%08x  %s  %s   %s %s' % (start+t, hexbytes[h:h+23], hexbytes[h+24:h+47],
+                                          printable[t:t+8], printable[t+8:t+16])
+                for h, t in zip(range(0, full*3, 48), range(0, full, 16))]
+    if full < len(data):
+        row = hexdump_line(data[full:])
+        rows.append(row if start is None else "{:08x}  {}".format(start+full, row))
+    return rows
+
+def hexdump_iterchunks(data, start=0, collapse=False, chunksize=0x1000):
+    '''Hexdump data (bytes, memoryview, mmap, ...) a chunk at a time.
+
+    Yields a list of lines for every `chunksize` bytes. Addresses start at
+    `start`. With collapse=True, runs of identical rows get squeezed down to
+    a single "*" line, and there's a last line with just the end address on
+    it (so you can tell how long a run at the end was), like `hexdump -C`.
+    '''
+    if chunksize & 0xf:
+        raise ValueError("chunksize should be a multiple of 16")
+    prev = None
+    squeezed = False
+    with memoryview(data) as view:
+        for pos in range(0, len(view), chunksize):
+            chunk = bytes(view[pos:pos+chunksize])
+            rows = _hexdump_rows(chunk, start+pos)
+            if not collapse:
+                yield rows
+                continue
+            lines = []
+            for idx, row in enumerate(rows):
+                raw = chunk[idx*16:idx*16+16]
+                if raw == prev:
+                    if not squeezed:
+                        lines.append('*')
+                        squeezed = True
+                    continue
+                prev = raw
+                squeezed = False
+                lines.append(row)
+            yield lines
+        if collapse and len(view):
+            yield ['{:08x}'.format(start + len(view))]
+
+def hexdump_iterlines(data, start=0, collapse=False):
+    for lines in hexdump_iterchunks(data, start, collapse):
+        yield from lines
+
+def hexdump(data, start=0, collapse=False, out=None):
+    if out is None:
+        out = sys.stdout
+    chunks = hexdump_iterchunks(data, start, collapse)
+    try:
+        for lines in chunks:
+            if lines:
+                out.write('\n'.join(lines) + '\n')
+    finally:
+        chunks.close() # let go of data now, in case it's an mmap
+
+def hexdump_file(filename, start=0, end=None, base=0, collapse=False, out=None):
+    '''Hexdump [start:end) of a file (e.g. dump/BBD8-dump.flash) without
+    reading the whole thing in; addresses are shown as base+offset.'''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as view, view[start:end] as part:
+                hexdump(part, base+start, collapse, out)
 
 # USB Packet Structure:
 #
@@ -107,10 +285,7 @@ class BindataMixin(object):
     def _pack(self):
         return self._struct.pack(*self)
     def _hexdump(self):
-        data = self._pack()
-        size = self._struct.size
-        return '\n'.join(hexdump_line(data[s:s+0x10])
-                         for s in range(0,size,0x10))
+        return '\n'.join(_hexdump_rows(self._pack()))
     def _calculate_checksum(self):
         return mycrc16(self._replace(checksum=0)._pack())
     def _replace_checksum(self):
@@ -128,6 +303,96 @@ ReplyPacketTuple = namedtuple("ReplyPacketTuple", "cmd subcmd result pad1 pad2 c
 class ReplyPacket(ReplyPacketTuple, BindataMixin):
     _struct = PacketStruct
 
+# The namedtuples above are nice to look at but every _replace()/_pack()
+# makes a new object, which adds up when you're sending a few thousand
+# packets. PacketBuffer is the fast path: one preallocated 64-byte buffer
+# that packets get packed into and checksummed in place. It's an
+# array('B') because that's what pyusb reads into / writes from without
+# copying. The namedtuples are still the thing callers get back; they're
+# just a view of what's in the buffer.
+PacketHeaderStruct = struct.Struct("<BBHBBH")
+PacketChecksumStruct = struct.Struct("<H")
+PacketChecksumOffset = 6
+PacketPayloadSize = PacketStruct.size - PacketHeaderStruct.size
+
+_zero_payload = memoryview(bytes(PacketPayloadSize))
+
+class PacketBuffer(object):
+    '''A reusable buffer for encoding/decoding one 64-byte packet'''
+    def __init__(self):
+        self.buf = array.array('B', bytes(PacketStruct.size))
+        self.view = memoryview(self.buf)
+
+    def encode(self, cmd, subcmd, offset=0, pad1=0, length=0, data=None):
+        '''Pack a command packet into the buffer; returns the buffer'''
+        PacketHeaderStruct.pack_into(self.buf, 0, cmd, subcmd, offset, pad1, length, 0)
+        n = 0
+        if data:
+            data = memoryview(data).cast('B')
+            n = len(data)
+            if n > PacketPayloadSize:
+                raise ValueError("payload is {} bytes, max {:#x}".format(n, PacketPayloadSize))
+            self.view[8:8+n] = data
+        self.view[8+n:] = _zero_payload[n:]
+        self.patch_checksum()
+        return self.buf
+
+    def load(self, data):
+        '''Copy a packet (e.g. from a packet stream) into the buffer'''
+        self.view[:] = data
+        return self.buf
+
+    def patch_checksum(self):
+        PacketChecksumStruct.pack_into(self.buf, PacketChecksumOffset, 0)
+        PacketChecksumStruct.pack_into(self.buf, PacketChecksumOffset,
+                                       binascii.crc_hqx(self.buf, 0xffff)) # mycrc16
+
+    def header(self):
+        '''(cmd, subcmd, offset/result, pad1, length/pad2, checksum)'''
+        return PacketHeaderStruct.unpack_from(self.buf)
+
+    def payload(self):
+        return self.view[8:]
+
+    def checksum_ok(self):
+        stored, = PacketChecksumStruct.unpack_from(self.buf, PacketChecksumOffset)
+        PacketChecksumStruct.pack_into(self.buf, PacketChecksumOffset, 0)
+        ok = binascii.crc_hqx(self.buf, 0xffff) == stored
+        PacketChecksumStruct.pack_into(self.buf, PacketChecksumOffset, stored)
+        return ok
+
+    def command(self):
+        return CommandPacket._unpack(self.buf)
+
+    def reply(self):
+        return ReplyPacket._unpack(self.buf)
+
+def encode_packet_stream(data, cmd=2, subcmd=2, offset=0, chunksize=0x38):
+    '''Encode data as a stream of command packets, chunksize bytes apiece.
+
+    This is what cdboot_send_firmware sends: packet i carries
+    data[i*chunksize:(i+1)*chunksize] and has offset + i*chunksize in the
+    offset field (bits 16-23 go in pad1, like send_cmd does). Returns one
+    array('B') with all the packets back to back, checksums and all.
+    '''
+    data = memoryview(data).cast('B')
+    size = PacketStruct.size
+    count = (len(data) + chunksize - 1) // chunksize
+    stream = array.array('B', bytes(count * size))
+    view = memoryview(stream)
+    pack_into = PacketHeaderStruct.pack_into
+    for i in range(count):
+        pos = i * size
+        o = i * chunksize
+        chunk = data[o:o+chunksize]
+        addr = offset + o
+        pack_into(stream, pos, cmd, subcmd, addr & 0xffff, addr >> 16, len(chunk), 0)
+        view[pos+8:pos+8+len(chunk)] = chunk
+    crcs = CRC16(iv=0xffff).packets(stream, size)
+    for i, crc in enumerate(crcs):
+        PacketChecksumStruct.pack_into(stream, i*size + PacketChecksumOffset, crc)
+    return stream
+
 # TODO: document the .bimg header format here!!
 
 BImgHdrTuple = namedtuple("BImgHdrTuple", "magic checksum ts size datachecksum itype name")
@@ -160,21 +425,63 @@ class GK64(object):
     GK64Product = 0x0907
     CDBootProduct = 0x0905
 
-    def __init__(self, bus=None, address=None):
+    # a gk64trace.Tracer, if we're being traced (set it on the class to
+    # trace every GK64). When it's None, none of the tracing code runs.
+    trace = None
+
+    def __init__(self, bus=None, address=None, transport=None):
+        # transport is anything with a usb.core-style find(); the default is
+        # usb.core itself, but see gk64sim.SimTransport
+        self.transport = transport if transport is not None else usb.core
         self.dev = None
         self.cmd_in = None
         self.cmd_out = None
         self.fwid = None
-        if bus is None or address is None:
-            self.find_dev()
+        self._tx = PacketBuffer()
+        self._rx = PacketBuffer()
+        self.bad_replies = 0    # replies dropped for having a bad checksum
+        # Which device is ours. The USB address changes every time the
+        # keyboard re-enumerates (i.e. every mode switch), so once we've
+        # found it we keep track of it by bus + port path instead, or by
+        # serial number if the backend can't tell us the port path.
+        self.bus = bus
+        self.address = address
+        self.port_numbers = None
+        self.serial = None
+        self.find_dev()
 
     def __repr__(self):
         return "<{} dev={!r}>".format(self.__class__.__name__, self.dev)
 
-    def find_dev(self):
-        self.dev = usb.core.find(idVendor=self.SemitekVendor) or usb.core.find(idVendor=self.WeltrendVendor)
+    def _is_mine(self, dev):
+        if self.bus is not None and dev.bus != self.bus:
+            return False
+        if self.port_numbers is not None:
+            return getattr(dev, 'port_numbers', None) == self.port_numbers
+        if self.serial is not None:
+            return _serial_number(dev) == self.serial
+        if self.address is not None:
+            return dev.address == self.address
+        return True
+
+    def _find(self):
+        for vendor in (self.SemitekVendor, self.WeltrendVendor):
+            for dev in self.transport.find(find_all=True, idVendor=vendor):
+                if self._is_mine(dev):
+                    return dev
+        return None
+
+    def find_dev(self, dev=None):
+        self.dev = dev if dev is not None else self._find()
         if self.dev is None:
             return False
+        self.bus = self.dev.bus
+        self.port_numbers = getattr(self.dev, 'port_numbers', None)
+        self.serial = None
+        if self.port_numbers is None:
+            self.serial = _serial_number(self.dev)
+        if self.port_numbers is not None or self.serial is not None:
+            self.address = None
         if self.dev.idProduct == self.GK64Product:
             iface = 1
         elif self.dev.idProduct == self.CDBootProduct:
@@ -184,79 +491,203 @@ class GK64(object):
         if self.dev.is_kernel_driver_active(iface):
             self.dev.detach_kernel_driver(iface)
         self.cmd_in, self.cmd_out = self.dev[0][iface,0].endpoints()
+        if self.trace is not None:
+            self.dev = self.trace.wrap(self)
         return True
 
     def send_cmd(self, cmd, subcmd, offset=0, length=0, data=None, getreply=True, verbose=False, replytimeout=None):
         if offset & 0xff000000:
             raise ValueError("offset {:#010x} > 0x00ffffff".format(offset))
-        if not data:
-            data = bytearray(0x38)
-        pkt = CommandPacket(cmd, subcmd, offset & 0xffff, offset >> 16, length, 0, data)._replace_checksum()
-        if verbose:
-            print("send packet:")
-            print(pkt._hexdump())
-        self.dev.write(self.cmd_out, pkt._pack())
+        self._tx.encode(cmd, subcmd, offset & 0xffff, offset >> 16, length, data)
+        self._write_tx(verbose)
         if not getreply:
             return
-        r = ReplyPacket._unpack(self.dev.read(self.cmd_in, 0x40, timeout=replytimeout))
+        return self.read_reply(verbose=verbose, replytimeout=replytimeout)
+
+    def send_packet(self, pkt, verbose=False):
+        '''Send an already-encoded 64-byte packet (e.g. from encode_packet_stream)'''
+        self._tx.load(pkt)
+        self._write_tx(verbose)
+
+    def _write_tx(self, verbose=False):
+        if verbose:
+            print("send packet:")
+            print(self._tx.command()._hexdump())
+        self.dev.write(self.cmd_out, self._tx.buf)
+
+    def read_reply(self, verbose=False, replytimeout=None):
+        '''Read the next reply with a good checksum.
+
+        Replies with bad checksums get thrown away (and counted in
+        bad_replies), same as if they'd never arrived: if no good one turns
+        up within replytimeout ms, that's a timeout.
+        '''
+        deadline = None
+        if replytimeout is not None:
+            deadline = time.monotonic() + replytimeout / 1000.0
+        while True:
+            n = self.dev.read(self.cmd_in, self._rx.buf, timeout=replytimeout)
+            if n != PacketStruct.size:
+                # the rest of the buffer would still be the last packet
+                raise USBError("short reply ({} bytes)".format(n), errno=5) # EIO
+            if self._rx.checksum_ok():
+                break
+            self.bad_replies += 1
+            if verbose:
+                print("recv reply with bad checksum, ignoring it:")
+                print(self._rx.reply()._hexdump())
+            if self.trace is not None:
+                self.trace.count(self, 'bad reply checksums')
+            if deadline is not None:
+                replytimeout = int((deadline - time.monotonic()) * 1000)
+                if replytimeout <= 0:
+                    raise USBError("Operation timed out (bad reply checksum)", errno=110)
+        r = self._rx.reply()
         if verbose:
             print("recv reply:")
             print(r._hexdump())
         return r
 
+    def drain_replies(self, replytimeout=100):
+        '''Read and throw away any replies the device still has queued up.
+
+        Returns the number of replies discarded.
+        '''
+        count = 0
+        while True:
+            try:
+                self.read_reply(replytimeout=replytimeout)
+            except USBError as e:
+                if e.errno == 110:
+                    return count
+                raise
+            count += 1
+
     def get_fwid(self):
         r = self.send_cmd(1,1)
         if r.result == 1:
             self.fwid = "{r[3]:02x}-{r[2]:02x}{r[1]:02x}-{r[0]:02x}-V{r[5]:d}.{r[4]:d}".format(r=r.data)
         return self.fwid
 
-    def enter_cdboot_mode(self):
+    def wait_for_product(self, product, timeout=5.0, interval=0.005, max_interval=0.1):
+        '''Wait for the device to (re)appear as `product`, then grab it.
+
+        Polls with exponential backoff, from `interval` up to `max_interval`
+        seconds, and gives up after `timeout` seconds. After a mode switch
+        the old device hangs around for a moment before it drops off the
+        bus, so if it's still showing up as `product` we wait until it's
+        gone or has come back under a new address. Polling can miss the
+        gap entirely when it re-enumerates quickly, and the port path
+        stays the same, so the address is what tells the two apart.
+        '''
+        self._check_trackable()
+        old_product = self.dev.idProduct if self.dev is not None else None
+        old_addr = (self.dev.bus, self.dev.address) if self.dev is not None else None
+        gone = old_product != product
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                dev = self._find()
+                if dev is None:
+                    gone = True
+                elif (dev.bus, dev.address) != old_addr:
+                    # re-enumerated, whether or not we saw it go
+                    gone = True
+                    if dev.idProduct == product:
+                        return self.find_dev(dev)
+                elif dev.idProduct == product and gone:
+                    return self.find_dev(dev)
+            except USBError as e:
+                if e.errno != 19: # it went away while we were looking at it
+                    raise
+                gone = True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.dev = None
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+    def _check_trackable(self):
+        # All we've got is the address, and that'll change when it
+        # re-enumerates; rather than grab whatever turns up at some address
+        # afterwards (maybe another keyboard), don't switch modes at all.
+        if self.dev is not None and self.address is not None:
+            raise Error("can't keep track of {!r} across a mode switch: no port "
+                        "path or serial number, only the USB address".format(self))
+
+    def enter_cdboot_mode(self, timeout=5.0):
+        self._check_trackable()
+        start = time.monotonic()
         r = self.send_cmd(3,2)
-        time.sleep(1)
-        return self.find_dev()
-
-    def enter_keyboard_mode(self):
+        ok = self.wait_for_product(self.CDBootProduct, timeout)
+        if self.trace is not None:
+            self.trace.add_span(self, 'enter cdboot mode', start, ok=ok)
+        return ok
+
+    def enter_keyboard_mode(self, timeout=5.0):
+        self._check_trackable()
+        start = time.monotonic()
         self.send_cmd(3,1)
-        time.sleep(1)
-        return self.find_dev()
-
-    def read_memory_hax(self, offset, verbose=True, replytimeout=None):
-        # use my haxed firmware to read arbitrary memory addresses :D
+        ok = self.wait_for_product(self.GK64Product, timeout)
+        if self.trace is not None:
+            self.trace.add_span(self, 'enter keyboard mode', start, ok=ok)
+        return ok
+
+    def read_memory_hax(self, offset, verbose=True, replytimeout=100, retries=5):
+        '''Read the 0x38 bytes at offset with my haxed firmware's cmd 4,1 :D
+
+        One request at a time, with the packets hexdumped if verbose; see
+        read_memory for the fast way. The reply has to echo back the low 16
+        bits of offset to count. If it doesn't turn up within replytimeout
+        ms, the request gets resent with twice the timeout, up to `retries`
+        times.
+        '''
         if offset & 0xff000000:
             raise ValueError("offset {:#010x} > 0x00ffffff".format(offset))
-        data = bytearray(0x38)
-        pkt = CommandPacket(4, 1, offset & 0xffff, 0, offset >> 16, 0, data)._replace_checksum()
-        if verbose:
-            print("send packet:")
-            print(pkt._hexdump())
-        self.dev.write(self.cmd_out, pkt._pack())
-        r = ReplyPacket._unpack(self.dev.read(self.cmd_in, 0x40, timeout=replytimeout))
-        if verbose:
-            print("recv reply:")
-            print(r._hexdump())
-        retries = 0
-        # result == offset works when offset <= 0x00ffffff, but otherwise..
-        #while not (r.pad2 == 0x38 and r.result == offset):
-        while not (r.pad2 == 0x38):
-            if verbose:
+        pkt = PacketBuffer()
+        pkt.encode(4, 1, offset & 0xffff, 0, offset >> 16)
+        for attempt in range(retries + 1):
+            if attempt and verbose:
                 print("retrying...")
-            if retries == 0:
-                if verbose:
-                    print("resend packet:")
-                    print(pkt._hexdump())
-                    self.dev.write(self.cmd_out, pkt._pack())
-            try:
-                r = ReplyPacket._unpack(self.dev.read(self.cmd_in, 0x40, timeout=replytimeout))
-            except USBError as e:
-                if e.errno == 110 and retries <= 5:
-                    retries += 1
-                    time.sleep(0.05)
-                else:
-                    raise
-            if verbose:
-                print("recv reply:")
-                print(r._hexdump())
-        return r.data
+            self.send_packet(pkt.buf, verbose)
+            deadline = time.monotonic() + (replytimeout << attempt) / 1000.0
+            while True:
+                remaining = int((deadline - time.monotonic()) * 1000)
+                if remaining <= 0:
+                    break
+                try:
+                    r = self.read_reply(verbose=verbose, replytimeout=remaining)
+                except USBError as e:
+                    if e.errno != 110:
+                        raise
+                    break
+                if r.cmd == 4 and r.pad2 == 0x38 and r.result == offset & 0xffff:
+                    return r.data
+        raise USBError("no reply reading {:#x}".format(offset), errno=110)
+
+    def read_memory(self, ranges, window=8, retries=5, replytimeout=100):
+        '''Read a list of (start, end) address ranges with the haxed cmd
+        4,1, and return them back to back as one bytes.
+
+        Keeps `window` requests in flight, matches replies up by the address
+        they echo back, and resends just the ones that go unanswered, with
+        exponential backoff (see read_memory_blocks).
+        '''
+        blocks = []
+        size = 0
+        for start, end in ranges:
+            if not 0 <= start <= end <= 0x1000000:
+                raise ValueError("can't read {:#x}-{:#x}".format(start, end))
+            # the position in the output rides along at the end of the block
+            blocks.extend(block + (size + block[2] - start,)
+                          for block in memory_blocks(start, end))
+            size += end - start
+        out = bytearray(size)
+        for block, data in read_memory_blocks(self, blocks, window, retries, replytimeout):
+            readaddr, skip, offset, length, pos = block
+            out[pos:pos+length] = data[skip:skip+length]
+        return bytes(out)
 
     def cdboot_update_version(self, verdata):
         # the per-keyboard updater sends this after the firmware update but
@@ -269,7 +700,29 @@ class GK64(object):
         if not (r.result == 1 and r.data[:8] == verdata):
             raise FirmwareUpdateError("signature setting failed", r)
 
-    def cdboot_send_firmware(self, bindata, hdr=None):
+    def cdboot_send_firmware(self, bindata, hdr=None, window=1, retries=3, replytimeout=None,
+                             verbose=True, progress=None, chunks=None, stream=None):
+        '''Send a firmware image to the bootloader (must be in CDBOOT mode).
+
+        window is the number of chunks sent before we wait for their replies;
+        1 is the old strict send/wait/send behavior. If a reply times out
+        (or only comes back with a bad checksum) we throw away any leftover
+        replies and resend from the last ACKed offset, up to `retries` times
+        in a row before giving up. A NAK raises FirmwareUpdateError right
+        away, like it always has: the bootloader said no, and sending the
+        same thing again won't change its mind.
+
+        Set verbose=False to keep quiet; progress, if given, gets called as
+        progress(stage, done, total) as things move along.
+
+        chunks, if given, is a list of the (0x38-aligned) offsets to send;
+        the rest of the image gets skipped (see DeltaFlasher). stream, if
+        given, is the already-encoded encode_packet_stream() of the image
+        (see ImageStore), so we don't have to encode it again.
+        '''
+        log = print if verbose else _quiet
+        if progress is None:
+            progress = _quiet
         if hdr is None:
             # construct an appropriate header
             hdr = make_bimg_header(bindata)
@@ -278,136 +731,1378 @@ class GK64(object):
 
         if not isinstance(hdr, BImgHdr):
             raise ValueError("hdr should be bytes or an instance of BImgHdr")
+        if window < 1:
+            raise ValueError("window must be >= 1")
 
         # Both updaters do this first, soooo..
         info_r = self.send_cmd(1,2)
         # TODO: use this to verify update later?
 
-        print("sending firmware header: ", end='', flush=True)
+        progress('header', 0, 0)
+        log("sending firmware header: ", end='', flush=True)
         # Both updaters send the header twice and get one (delayed) reply
         self.send_cmd(2,1,data=hdr._pack(), getreply=False)
         r = self.send_cmd(2,1,data=hdr._pack(), replytimeout=10000)
         if r.result != 1:
             raise FirmwareUpdateError(".bimg header not accepted", r)
-        print("ok")
-
-        # send firmware one packet-payload (<= 0x38 bytes) at a time
-        offset = 0
-        print("sending firmware ({:5}/{:5}): ".format(offset, hdr.size),
-              end='', flush=True)
-        while offset < hdr.size:
-            chunk = bindata[offset:offset+0x38] # this might be <0x38 bytes
-            size = len(chunk)                   # ...so get the actual size
-            r = self.send_cmd(2,2, offset=offset, length=size, data=chunk)
-            if r.result != 1:
-                raise FirmwareUpdateError("NAK at offset {}".format(offset), r)
-            offset += size
-            print("\rsending firmware ({:5}/{:5}): ".format(offset, hdr.size),
-                  end='', flush=True)
-        print("ok")
+        log("ok")
+
+        # send firmware one packet-payload (<= 0x38 bytes) at a time, in
+        # batches of up to `window` chunks, then collect one reply per chunk.
+        # The bootloader handles packets (and queues up replies) in order,
+        # but a reply doesn't say which offset it's for, so a dropped packet
+        # just shows up as a timeout at the end of the batch. So nothing in a
+        # batch counts as sent until every chunk in it has been ACKed.
+        if stream is None or len(stream) != -(-hdr.size // 0x38) * PacketStruct.size:
+            stream = encode_packet_stream(bindata[:hdr.size], 2, 2)
+        stream = memoryview(stream)
+        if chunks is None:
+            chunks = range(0, hdr.size, 0x38)
+        chunks = list(chunks)
+        total = sum(min(0x38, hdr.size - offset) for offset in chunks)
+        acked = 0           # chunks[:acked] have been ACKed
+        done = 0            # ..which is this many bytes
+        failures = 0
+        sendstart = time.monotonic()
+        progress('sending', done, total)
+        log("sending firmware ({:5}/{:5}): ".format(done, total),
+            end='', flush=True)
+        while acked < len(chunks):
+            batch = chunks[acked:acked+window]
+            for offset in batch:
+                pos = (offset // 0x38) * PacketStruct.size
+                self.send_packet(stream[pos:pos+PacketStruct.size])
+
+            nak = None
+            timedout = False
+            try:
+                got = 0
+                while got < len(batch):
+                    r = self.read_reply(replytimeout=replytimeout)
+                    if (r.cmd, r.subcmd) != (2,2):
+                        continue # not a reply to a chunk; ignore it
+                    if r.result != 1 and nak is None:
+                        nak = (batch[got], r)
+                    got += 1
+            except USBError as e:
+                if e.errno != 110 or failures >= retries:
+                    raise
+                timedout = True
+
+            if nak:
+                raise FirmwareUpdateError("NAK at offset {}".format(nak[0]), nak[1])
+            if not timedout:
+                acked += len(batch)
+                done += sum(min(0x38, hdr.size - offset) for offset in batch)
+                failures = 0
+                progress('sending', done, total)
+                log("\rsending firmware ({:5}/{:5}): ".format(done, total),
+                    end='', flush=True)
+                continue
+            # timeout: rewind to the start of the batch and go again
+            failures += 1
+            if self.trace is not None:
+                self.trace.count(self, 'fwup retries')
+            self.drain_replies()
+        log("ok")
+        if self.trace is not None:
+            self.trace.add_span(self, 'fwup send', sendstart, nbytes=total, window=window)
 
         # send final timestamp / checksum
-        print("sending final packet: ", end='', flush=True)
-        final_time = int(time.time())  # TODO: not 100% sure this is right
-        final_checksum = 0x1337        # FIXME this is a lie!!
-        final_data = struct.pack('<IxxH', final_time, final_checksum)
-        r = self.send_cmd(2,3, data=final_data)
+        progress('finalizing', 0, 0)
+        log("sending final packet: ", end='', flush=True)
+        r = self.send_cmd(2,3, data=self.final_packet_data())
         if r.result != 1:
             raise FirmwareUpdateError("firmware final checksum rejected", r)
-        print("ok")
+        log("ok")
+        return True
+
+    @staticmethod
+    def final_packet_data():
+        '''Payload for the 2,3 packet that ends a firmware update'''
+        final_time = int(time.time())  # TODO: not 100% sure this is right
+        final_checksum = 0x1337        # FIXME this is a lie!!
+        return struct.pack('<IxxH', final_time, final_checksum)
+
+    def update_firmware(self, bindata, hdr=None, window=1, verbose=True, progress=None,
+                        chunks=None, stream=None):
+        '''The whole fwup dance: reset into CDBOOT mode, send it, reset back.
+
+        Returns True if the firmware went through and the keyboard came back
+        afterwards. Whatever happens, we try to put the keyboard back into
+        keyboard mode at the end. verbose,
+        progress, chunks and stream work like they do for
+        cdboot_send_firmware.
+        '''
+        log = print if verbose else _quiet
+        if progress is None:
+            progress = _quiet
+        # TODO: should have a context manager for CDBOOT mode..
+        # FIXME: header will be rejected if we're already in cdboot mode.
+        # Gotta reset first...
+        progress('cdboot', 0, 0)
+        log("switching to CDBOOT mode: ", end='', flush=True)
+        self.enter_keyboard_mode()
+        if not self.enter_cdboot_mode():
+            log("failed :<")
+            return False
+        log("ok")
+
+        fwup_ok = False
+        back = False
+        try:
+            fwup_ok = self.cdboot_send_firmware(bindata, hdr, window=window,
+                                                verbose=verbose, progress=progress,
+                                                chunks=chunks, stream=stream)
+        finally:
+            progress('keyboard', 0, 0)
+            log("switching back to keyboard mode: ", end='', flush=True)
+            back = self.enter_keyboard_mode()
+            log("ok" if back else "failed :<")
+        # if it didn't come back, self.dev is None and nobody can check on it
+        return fwup_ok and back
+
+def _serial_number(dev):
+    '''dev's USB serial number, or None if it hasn't got one (or we can't
+    read string descriptors at all)'''
+    try:
+        return dev.serial_number or None
+    except (AttributeError, ValueError, NotImplementedError, USBError):
+        return None
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+def memory_blocks(start, end, blocksize=0x38):
+    '''Yield (readaddr, skip, offset, length) for each block in start..end
+
+    Reads never go past end, because bad things happen if you read past a
+    memory boundary. So the last block gets moved back to end at end, and
+    we skip the bytes we already have.
+    '''
+    offset = start
+    while offset < end:
+        readaddr = offset
+        if offset + blocksize > end:
+            readaddr = max(end - blocksize, 0)
+        length = min(blocksize, end - offset)
+        yield (readaddr, offset - readaddr, offset, length)
+        offset += length
+
+def read_memory_blocks(kbd, blocks, window=8, retries=5, replytimeout=1000,
+                       max_replytimeout=None):
+    '''Read memory_blocks() with the haxed cmd 4,1, `window` at a time.
+
+    Yields (block, data) as the replies come in, which isn't necessarily in
+    order. The device echoes the low 16 bits of the address back in each
+    reply, which is how replies get matched up with requests. Blocks only
+    need to start with readaddr and have offset third; anything else in
+    them just comes back out with the data.
+
+    Each request gets replytimeout ms for its reply. Any that don't make it
+    get resent, on their own, with double the timeout each time (up to
+    max_replytimeout, default 8x replytimeout) until one of them has been
+    resent `retries` times, at which point the timeout gets raised.
+    '''
+    if max_replytimeout is None:
+        max_replytimeout = replytimeout * 8
+    todo = iter(blocks)
+    inflight = dict()   # readaddr & 0xffff -> (block, deadline, tries)
+    pending = deque()   # (block, tries) that need (re)sending
+    while True:
+        while len(inflight) < window:
+            block, tries = pending.popleft() if pending else (next(todo, None), 0)
+            if block is None:
+                break
+            readaddr = block[0]
+            if readaddr & 0xffff in inflight:
+                # a reply for this one would look just like the reply for
+                # the one 64k away that's already in flight; wait for it
+                pending.appendleft((block, tries))
+                break
+            # address bits 16-23 go in the length byte
+            kbd.send_cmd(4,1, offset=readaddr & 0xffff, length=readaddr >> 16,
+                         getreply=False)
+            timeout = min(replytimeout << tries, max_replytimeout)
+            inflight[readaddr & 0xffff] = (block, time.monotonic() + timeout / 1000.0, tries)
+        if not inflight:
+            return
+
+        wait = min(deadline for _, deadline, _ in inflight.values()) - time.monotonic()
+        try:
+            r = kbd.read_reply(replytimeout=max(1, int(wait * 1000)))
+        except USBError as e:
+            if e.errno != 110:
+                raise
+            # resend just the ones whose time is up
+            now = time.monotonic()
+            for key, (block, deadline, tries) in list(inflight.items()):
+                if deadline > now:
+                    continue
+                if tries >= retries:
+                    raise
+                del inflight[key]
+                pending.append((block, tries + 1))
+                if kbd.trace is not None:
+                    kbd.trace.count(kbd, 'read retries')
+            continue
+
+        entry = inflight.get(r.result)
+        if r.cmd != 4 or r.pad2 != 0x38 or entry is None:
+            continue # stale or unrelated reply
+        del inflight[r.result]
+        yield entry[0], r.data
+
+class MemoryDumper(object):
+    '''Dump a range of device memory to a file, quickly and resumably.
+
+    Needs the haxed firmware (see read_memory_hax). Up to `window` read
+    requests are kept in flight (see read_memory_blocks). Data goes
+    straight into a preallocated, mmap'd output file, and progress is
+    checkpointed to `outfile + '.progress'` so an interrupted dump can pick
+    up where it left off.
+    '''
+    blocksize = 0x38
+
+    def __init__(self, kbd, start, end, outfile, window=8, retries=5,
+                 replytimeout=1000, checkpoint_every=0x800):
+        if end <= start:
+            raise ValueError("end {:#x} <= start {:#x}".format(end, start))
+        self.kbd = kbd
+        self.start = start
+        self.end = end
+        self.outfile = outfile
+        self.progressfile = outfile + '.progress'
+        self.window = window
+        self.retries = retries
+        self.replytimeout = replytimeout
+        self.checkpoint_every = checkpoint_every
+        self.done = start       # everything below this is safely on disk
+        self.elapsed = 0.0
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def blocks(self, offset):
+        return memory_blocks(offset, self.end, self.blocksize)
+
+    def load_checkpoint(self):
+        '''Returns True if there was a usable checkpoint to resume from'''
+        try:
+            with open(self.progressfile) as progf:
+                prog = json.load(progf)
+        except (OSError, ValueError):
+            return False
+        if (prog.get('start'), prog.get('end')) != (self.start, self.end):
+            return False
+        if not os.path.exists(self.outfile) or \
+           os.path.getsize(self.outfile) != self.size:
+            return False
+        self.done = prog['done']
+        return True
+
+    def save_checkpoint(self):
+        tmpfile = self.progressfile + '.tmp'
+        with open(tmpfile, 'w') as progf:
+            json.dump(dict(start=self.start, end=self.end, done=self.done), progf)
+        os.replace(tmpfile, self.progressfile)
+
+    def run(self, resume=True, progress=True):
+        '''Do the dump. Returns the number of bytes read this time around.'''
+        if not (resume and self.load_checkpoint()):
+            self.done = self.start
+            with open(self.outfile, 'wb') as outf:
+                outf.truncate(self.size)
+        elif progress:
+            print("resuming dump at {:#x}".format(self.done))
+
+        finished = set()    # offsets that are written but not yet contiguous
+        startdone = self.done
+        lastcheckpoint = self.done
+        starttime = time.monotonic()
+
+        with open(self.outfile, 'r+b') as outf, \
+             mmap.mmap(outf.fileno(), self.size) as outmap:
+            try:
+                for block, data in read_memory_blocks(self.kbd, self.blocks(self.done),
+                                                      self.window, self.retries,
+                                                      self.replytimeout):
+                    readaddr, skip, offset, length = block
+                    pos = offset - self.start
+                    outmap[pos:pos+length] = data[skip:skip+length]
+                    finished.add(offset)
+                    if self.done not in finished:
+                        continue
+                    while self.done in finished:
+                        finished.remove(self.done)
+                        self.done = min(self.done + self.blocksize, self.end)
+
+                    if self.done - lastcheckpoint >= self.checkpoint_every:
+                        outmap.flush()
+                        self.save_checkpoint()
+                        lastcheckpoint = self.done
+                    if progress:
+                        self.print_progress(startdone, starttime)
+            finally:
+                self.elapsed = time.monotonic() - starttime
+                if self.kbd.trace is not None:
+                    self.kbd.trace.add_span(self.kbd, 'dump', starttime,
+                                            nbytes=self.done - startdone, window=self.window)
+                outmap.flush()
+                if self.done < self.end:
+                    self.save_checkpoint()
+
+        if os.path.exists(self.progressfile):
+            os.unlink(self.progressfile)
+        if progress:
+            self.print_progress(startdone, starttime)
+            print()
+        return self.done - startdone
+
+    def print_progress(self, startdone, starttime):
+        elapsed = max(time.monotonic() - starttime, 1e-6)
+        print("\rdumping {:#08x}-{:#08x}: {:6}/{:6} bytes, {:7.0f} bytes/sec".format(
+              self.start, self.end, self.done - self.start, self.size,
+              (self.done - startdone) / elapsed), end='', flush=True)
+
+# The WT59F164 memory map, from the top of disasm/BBD8.disasm:
+# (name, start, end). Everything not listed is "RESERVED".
+MemoryRegions = [
+    ('flash',     0x000000, 0x010000),
+    ('sram',      0x100000, 0x102000),
+    ('pwm',       0x1f5c00, 0x1f6400),
+    ('gpio',      0x1f6800, 0x1f6c00),
+    ('sysctl',    0x200000, 0x200400),
+    ('flashprog', 0x200400, 0x200800),
+    ('watchdog',  0x200800, 0x200c00),
+    ('wakeup',    0x200c00, 0x201000),
+    ('rtc',       0x201000, 0x201400),
+    ('cec',       0x201400, 0x201800),
+    ('ir',        0x201800, 0x201c00),
+    ('timer',     0x201c00, 0x203400),
+    ('uart',      0x203400, 0x204000),
+    ('spi',       0x204400, 0x204c00),
+    ('i2c',       0x205400, 0x205800),
+    ('adc',       0x206400, 0x206800),
+    ('i2s',       0x206c00, 0x207000),
+    ('usb',       0x207800, 0x207c00),
+    ('dma',       0x300000, 0x300400),
+    ('bootrom',   0x400000, 0x402000),
+]
+# Just the memories. Reading some peripheral registers might have side
+# effects (clearing interrupt flags or FIFOs or whatever), so you have to
+# ask for those by name.
+DefaultSnapshotRegions = ('flash', 'sram', 'bootrom')
+
+def memory_region(name):
+    '''name -> (name, start, end) from MemoryRegions'''
+    for region in MemoryRegions:
+        if region[0] == name:
+            return region
+    raise ValueError("unknown memory region {!r} (try: {})".format(
+                     name, ", ".join(r[0] for r in MemoryRegions)))
+
+# Sparse snapshot file layout:
+#   header:  magic, u32 region count, u32 extent count
+#   regions: name, u32 start, u32 end, u32 first extent, u32 extent count
+#   extents: u32 addr, u32 length, u8 kind, u8 fill byte, u32 data offset
+#   data:    the bytes for the SparseData extents, back to back
+# Every region is covered by its extents, in order, with no gaps.
+SparseMagic = b'GK64SPR1'
+SparseHeaderStruct = struct.Struct("<8sII")
+SparseRegionStruct = struct.Struct("<12sIIII")
+SparseExtentStruct = struct.Struct("<IIBBxxI")
+SparseData = 0      # we've got the bytes
+SparseFill = 1      # read it; it's all `fill`
+SparseProbed = 2    # probes around it were all `fill`; assumed to be `fill`
+SparseKinds = {SparseData: 'data', SparseFill: 'fill', SparseProbed: 'probed'}
+
+def _blank(data):
+    '''The fill byte if data is all 0xff or all 0x00, else None'''
+    if data and data[0] in (0x00, 0xff) and data.count(data[0]) == len(data):
+        return data[0]
+    return None
+
+def _fill_runs(data, min_run):
+    '''(start, end, fill) for each run of >= min_run 0x00s or 0xffs'''
+    pattern = re.compile(b'\\x00{%d,}|\\xff{%d,}' % (min_run, min_run))
+    return [(m.start(), m.end(), data[m.start()]) for m in pattern.finditer(data)]
+
+class SparseDumper(object):
+    '''Snapshot whole named memory regions into a sparse file.
+
+    Needs the haxed firmware (it uses read_memory). Only the regions get
+    read - not the megabytes of reserved space between them - with
+    `window` requests in flight, and runs of >= min_run 0x00s or 0xffs in
+    what comes back are stored as fill instead of data.
+
+    With probe=True it also tries to skip reading the blank bits:
+
+      1. probe one block at every `stride` bytes (and at the end)
+      2. wherever two neighbouring probes are blank (all 0xff or all 0x00,
+         the same both times), probe halfway between them, and so on,
+         until the gap is down to `fine` bytes; a gap that stays blank all
+         the way down doesn't get read
+
+    That's a guess, and it can be wrong: BBD8-dump.flash has 55 bytes of
+    something at 0xf6c2 in the middle of 6k of 0xff, and probing sails
+    right past it. So skipped gaps are marked SparseProbed in the output,
+    and it's off by default. Counters: probed, read and skipped bytes.
+    '''
+    def __init__(self, kbd, regions=DefaultSnapshotRegions, stride=0x1000, fine=0x400,
+                 min_run=0x100, probe=False, window=8, retries=5, replytimeout=100):
+        self.kbd = kbd
+        self.regions = [memory_region(r) if isinstance(r, str) else tuple(r)
+                        for r in regions]
+        if fine < 0x38 or stride < fine:
+            raise ValueError("need stride >= fine >= 0x38")
+        self.stride = stride
+        self.fine = fine
+        self.min_run = min_run
+        self.probe = probe
+        self.window = window
+        self.retries = retries
+        self.replytimeout = replytimeout
+        self.probed = self.read = self.skipped = 0
+        self.elapsed = 0.0
+
+    def _read(self, ranges):
+        '''read_memory, but split back up into one bytes per range'''
+        data = self.kbd.read_memory(ranges, self.window, self.retries, self.replytimeout)
+        out = []
+        pos = 0
+        for start, end in ranges:
+            out.append(data[pos:pos+end-start])
+            pos += end - start
+        return out
+
+    def _probe_range(self, addr, start, end):
+        # the block at addr, kept inside the region
+        addr = max(min(addr, end - 0x38), start)
+        return (addr, min(addr + 0x38, end))
+
+    def find_blank(self, start, end):
+        '''Steps 1 and 2: returns [(start, end, fill), ...] probably blank'''
+        probes = dict()     # addr -> fill byte (or None)
+        cells = [(s, min(s + self.stride, end)) for s in range(start, end, self.stride)]
+        blank = []
+        while cells:
+            todo = sorted(set(p for cell in cells for p in cell) - set(probes))
+            ranges = [self._probe_range(p, start, end) for p in todo]
+            for p, data in zip(todo, self._read(ranges)):
+                probes[p] = _blank(data)
+                self.probed += len(data)
+            split = []
+            for s, e in cells:
+                fill = probes[s]
+                if fill is None or probes[e] != fill:
+                    continue
+                if e - s <= self.fine:
+                    blank.append((s, e, fill))
+                else:
+                    mid = s + (e - s) // 2
+                    split += [(s, mid), (mid, e)]
+            cells = split
+        blank.sort()
+        merged = []
+        for s, e, fill in blank:
+            if merged and merged[-1][1] == s and merged[-1][2] == fill:
+                merged[-1] = (merged[-1][0], e, fill)
+            else:
+                merged.append((s, e, fill))
+        return merged
+
+    def snapshot_region(self, start, end):
+        '''Returns (extents, data) for one region, extents being
+        [(addr, length, kind, fill, data offset), ...]'''
+        blank = self.find_blank(start, end) if self.probe else []
+        wanted = []
+        pos = start
+        for s, e, fill in blank + [(end, end, None)]:
+            if pos < s:
+                wanted.append((pos, s))
+            pos = e
+        extents = []
+        chunks = dict(zip(wanted, self._read(wanted)))
+        for s, e, fill in blank:
+            chunks[(s, e)] = fill
+            self.skipped += e - s
+        data = []
+        datasize = 0
+        for s, e in sorted(chunks):
+            chunk = chunks[(s, e)]
+            if not isinstance(chunk, bytes):
+                extents.append((s, e - s, SparseProbed, chunk, 0))
+                continue
+            self.read += len(chunk)
+            pos = 0
+            for rs, rend, fill in _fill_runs(chunk, self.min_run) + [(len(chunk), len(chunk), None)]:
+                if pos < rs:
+                    extents.append((s + pos, rs - pos, SparseData, 0, datasize))
+                    data.append(chunk[pos:rs])
+                    datasize += rs - pos
+                if rs < rend:
+                    extents.append((s + rs, rend - rs, SparseFill, fill, 0))
+                pos = rend
+        return extents, b''.join(data)
+
+    def run(self, outfile):
+        '''Snapshot all the regions into outfile; returns the extent list
+        per region, {name: extents}'''
+        starttime = time.monotonic()
+        self.probed = self.read = self.skipped = 0
+        regions = []
+        for name, start, end in self.regions:
+            extents, data = self.snapshot_region(start, end)
+            regions.append((name, start, end, extents, data))
+        write_sparse(outfile, regions)
+        self.elapsed = time.monotonic() - starttime
+        if self.kbd.trace is not None:
+            self.kbd.trace.add_span(self.kbd, 'snapshot', starttime,
+                                    nbytes=self.probed + self.read)
+        return {name: extents for name, _, _, extents, _ in regions}
+
+def write_sparse(outfile, regions):
+    '''regions: [(name, start, end, extents, data), ...], extents as from
+    SparseDumper.snapshot_region (data offsets relative to that region's data)'''
+    nextents = sum(len(r[3]) for r in regions)
+    out = [SparseHeaderStruct.pack(SparseMagic, len(regions), nextents)]
+    first = 0
+    for name, start, end, extents, _ in regions:
+        out.append(SparseRegionStruct.pack(name.encode('ascii'), start, end,
+                                           first, len(extents)))
+        first += len(extents)
+    base = 0
+    for _, _, _, extents, data in regions:
+        for addr, length, kind, fill, offset in extents:
+            out.append(SparseExtentStruct.pack(addr, length, kind, fill,
+                                               base + offset if kind == SparseData else 0))
+        base += len(data)
+    out += [r[4] for r in regions]
+    with open(outfile + '.tmp', 'wb') as f:
+        f.write(b''.join(out))
+    os.replace(outfile + '.tmp', outfile)
+
+class SparseSnapshot(object):
+    '''A sparse snapshot file, as written by SparseDumper.
+
+    regions is [(name, start, end, extents), ...]; read() puts the bytes
+    back together, filling in the blank bits.
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            blob = f.read()
+        magic, nregions, nextents = SparseHeaderStruct.unpack_from(blob)
+        if magic != SparseMagic:
+            raise ValueError("{}: not a sparse snapshot".format(filename))
+        pos = SparseHeaderStruct.size
+        regions = [SparseRegionStruct.unpack_from(blob, pos + n * SparseRegionStruct.size)
+                   for n in range(nregions)]
+        pos += nregions * SparseRegionStruct.size
+        extents = [SparseExtentStruct.unpack_from(blob, pos + n * SparseExtentStruct.size)
+                   for n in range(nextents)]
+        self.data = memoryview(blob)[pos + nextents * SparseExtentStruct.size:]
+        self.regions = [(name.rstrip(b'\0').decode('ascii'), start, end,
+                         extents[first:first+count])
+                        for name, start, end, first, count in regions]
+
+    def region(self, name):
+        for region in self.regions:
+            if region[0] == name:
+                return region
+        raise ValueError("no region {!r} in this snapshot".format(name))
+
+    def read(self, start, end):
+        '''Bytes start..end, or ValueError if the snapshot doesn't cover it all'''
+        out = bytearray(end - start)
+        covered = 0
+        for _, rstart, rend, extents in self.regions:
+            for addr, length, kind, fill, offset in extents:
+                lo, hi = max(addr, start), min(addr + length, end)
+                if lo >= hi:
+                    continue
+                if kind == SparseData:
+                    out[lo-start:hi-start] = self.data[offset+lo-addr:offset+hi-addr]
+                else:
+                    out[lo-start:hi-start] = bytes([fill]) * (hi - lo)
+                covered += hi - lo
+        if covered != end - start:
+            raise ValueError("snapshot doesn't cover all of {:#x}-{:#x}".format(start, end))
+        return bytes(out)
+
+def verify_firmware(kbd, bindata, base=None, window=8, retries=5, replytimeout=1000):
+    '''Read back what's in flash where bindata should be, and check it.
+
+    Needs the haxed firmware (it uses read_memory_blocks). Each block read
+    gets compared with the same bytes of the image, so only the flashed
+    region gets read, not the whole flash. Returns a list of (start, end)
+    address ranges that don't match; empty means the image is all there.
+    '''
+    if base is None:
+        base = fw_base_addr
+    end = base + len(bindata)
+    image = memoryview(bindata)
+    bad = []
+    for block, data in read_memory_blocks(kbd, memory_blocks(base, end), window,
+                                          retries, replytimeout):
+        readaddr, skip, offset, length = block
+        if data[skip:skip+length] != image[offset-base:offset-base+length]:
+            bad.append((offset, offset+length))
+    # replies come back in any order; sort and merge neighbouring blocks
+    ranges = []
+    for start, stop in sorted(bad):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+def changed_chunks(old, new, chunksize=0x38):
+    '''Offsets of the chunksize-byte chunks of new that differ from old'''
+    return [offset for offset in range(0, len(new), chunksize)
+            if old[offset:offset+chunksize] != new[offset:offset+chunksize]]
+
+class FirmwareCache(object):
+    '''The last image we successfully flashed onto each kind of keyboard.
+
+    Images are plain .bin files in `path`, named after the fwid the
+    keyboard reported with that image on it (see GK64.get_fwid). A
+    .delta-ok file next to one means a delta upload onto that kind of
+    board has been read back and checked out (see DeltaFlasher).
+    '''
+    def __init__(self, path=None):
+        self.path = path if path is not None else _cache_dir('flashed')
+
+    def _filename(self, fwid):
+        return os.path.join(self.path, fwid.replace(os.sep, '_') + '.bin')
+
+    def get(self, fwid):
+        try:
+            with open(self._filename(fwid), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, fwid, bindata):
+        os.makedirs(self.path, exist_ok=True)
+        filename = self._filename(fwid)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(bindata)
+        os.replace(filename + '.tmp', filename)
+
+    def delta_proven(self, fwid):
+        return os.path.exists(self._filename(fwid) + '.delta-ok')
+
+    def prove_delta(self, fwid):
+        os.makedirs(self.path, exist_ok=True)
+        open(self._filename(fwid) + '.delta-ok', 'w').close()
+
+class DeltaFlasher(object):
+    '''Flash just the chunks that changed since last time.
+
+    The last image that went onto each kind of board is kept in a
+    FirmwareCache, and only the 0x38-byte chunks that differ from it get
+    sent. That only works if the bootloader leaves alone the parts of flash
+    we don't send, and if the cache is right about what's on the board. So
+    after a delta upload we read the image back with verify_firmware (which
+    needs the haxed firmware, in the image being flashed too), and if
+    anything at all goes wrong we do a full upload instead.
+
+    Nobody knows yet whether the stock bootloaders erase the whole image
+    when they get the header; if one does, a delta leaves a broken image
+    until the full upload puts it right. So a delta only gets sent to a
+    kind of board that's taken one before and read back fine (the cache
+    remembers), or with unproven=True to be the one that finds out.
+
+    After run(), mode is 'delta' or 'full', and sent/saved are byte counts.
+    '''
+    def __init__(self, kbd, cache=None, window=1, unproven=False, verbose=True,
+                 progress=None):
+        self.kbd = kbd
+        self.cache = cache if cache is not None else FirmwareCache()
+        self.window = window
+        self.unproven = unproven
+        self.verbose = verbose
+        self.log = print if verbose else _quiet
+        self.progress = progress if progress is not None else _quiet
+        self.mode = None
+        self.sent = 0
+        self.saved = 0
+
+    def _fwid(self):
+        if self.kbd.dev is None or self.kbd.dev.idProduct != GK64.GK64Product:
+            return None
+        try:
+            return self.kbd.get_fwid()
+        except USBError:
+            return None
+
+    def _delta(self, image, hdr, chunks):
+        log = self.log
+        try:
+            if not self.kbd.update_firmware(image, hdr, window=self.window,
+                                            verbose=self.verbose,
+                                            progress=self.progress, chunks=chunks):
+                log("delta upload failed, doing a full upload")
+                return False
+        except FirmwareUpdateError as e:
+            log("bootloader didn't take the delta ({}), doing a full upload".format(e.message))
+            return False
+        except USBError as e:
+            log("delta upload failed ({}), doing a full upload".format(e))
+            return False
+        self.progress('verifying', 0, 0)
+        log("verifying: ", end='', flush=True)
+        try:
+            bad = verify_firmware(self.kbd, image)
+        except Exception as e:
+            # whatever it was, we don't know what's in flash now
+            log("can't read it back ({}), doing a full upload".format(e))
+            return False
+        if bad:
+            log("mismatch at {}, doing a full upload".format(format_ranges(bad)))
+            return False
+        log("ok")
         return True
 
-def wait_for_dev():
+    def run(self, bindata, hdr=None):
+        '''Flash bindata; returns True if it went through, one way or another'''
+        if hdr is None:
+            hdr = make_bimg_header(bindata)
+        image = bytes(bindata[:hdr.size])
+        fwid = self._fwid()
+        old = self.cache.get(fwid) if fwid else None
+        self.mode, self.sent, self.saved = 'full', 0, 0
+        proven = fwid is not None and self.cache.delta_proven(fwid)
+        if old is not None and not (proven or self.unproven):
+            self.log("{}'s bootloader isn't known to keep what a delta doesn't "
+                     "send, doing a full upload".format(fwid))
+        elif old is not None:
+            chunks = changed_chunks(old, image)
+            size = sum(min(0x38, hdr.size - offset) for offset in chunks)
+            self.log("{} of {} bytes changed since the last flash ({})".format(
+                     size, hdr.size, fwid))
+            if self._delta(image, hdr, chunks):
+                self.mode, self.sent, self.saved = 'delta', size, hdr.size - size
+            else:
+                self.sent = size
+        elif fwid:
+            self.log("no cached image for {}, doing a full upload".format(fwid))
+        if self.mode == 'full':
+            if self.kbd.dev is None and not (self.kbd.wait_for_product(GK64.GK64Product)
+                                             or self.kbd.find_dev()):
+                self.log("lost the keyboard :<")
+                return False
+            if not self.kbd.update_firmware(image, hdr, window=self.window,
+                                            verbose=self.verbose,
+                                            progress=self.progress):
+                return False
+            self.sent += hdr.size
+        # the fwid can change along with the firmware, so file it under
+        # whatever the board says now
+        newfwid = self._fwid()
+        if newfwid:
+            self.cache.put(newfwid, image)
+            if self.mode == 'delta':
+                self.cache.prove_delta(fwid)
+                self.cache.prove_delta(newfwid)
+        return True
+
+def find_keyboards(transport=None):
+    '''Return a list of every attached GK6x (in either mode)'''
+    if transport is None:
+        transport = usb.core
+    devs = []
+    for vendor in (GK64.SemitekVendor, GK64.WeltrendVendor):
+        devs.extend(transport.find(find_all=True, idVendor=vendor))
+    return devs
+
+class FlashJob(object):
+    '''Where one keyboard is at in a FleetFlasher run'''
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+        self.state = 'queued'
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return "<{} {} {}>".format(self.__class__.__name__, self.name, self.state)
+
+    @property
+    def name(self):
+        return "{:03d}:{:03d}".format(self.bus, self.address)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def progress(self, stage, done, total):
+        self.state = stage
+        if total:
+            self.done, self.total = done, total
+
+class FleetFlasher(object):
+    '''Flash the same firmware onto every attached keyboard at once.
+
+    Each keyboard gets its own worker thread (up to `jobs` of them) doing
+    the whole update_firmware() sequence, so a slow or broken board only
+    holds up itself. Progress for all of them goes on one status line.
+    '''
+    def __init__(self, bindata, hdr=None, window=1, jobs=None, transport=None,
+                 verify=False, stream=None):
+        if hdr is None:
+            hdr = make_bimg_header(bindata)
+        self.bindata = bindata
+        self.hdr = hdr
+        self.window = window
+        self.jobs = jobs
+        self.transport = transport
+        self.verify = verify
+        self.stream = stream
+        self.flashjobs = []
+
+    def discover(self):
+        self.flashjobs = [FlashJob(dev.bus, dev.address)
+                          for dev in find_keyboards(self.transport)]
+        return self.flashjobs
+
+    def _flash(self, job):
+        job.started = time.monotonic()
+        try:
+            kbd = GK64(job.bus, job.address, transport=self.transport)
+            if kbd.dev is None:
+                raise Error("device went away")
+            if not kbd.update_firmware(self.bindata, self.hdr, window=self.window,
+                                       verbose=False, progress=job.progress,
+                                       stream=self.stream):
+                raise Error("couldn't switch to CDBOOT mode")
+            if self.verify:
+                job.state = 'verifying'
+                bad = verify_firmware(kbd, self.bindata[:self.hdr.size])
+                if bad:
+                    raise Error("verify failed at {}".format(format_ranges(bad)))
+            job.state = 'done'
+        except FirmwareUpdateError as e:
+            job.state, job.error = 'failed', e.message
+        except Exception as e:
+            job.state, job.error = 'failed', str(e) or e.__class__.__name__
+        finally:
+            job.finished = time.monotonic()
+        return job
+
+    def status_line(self, elapsed):
+        counts = dict()
+        for job in self.flashjobs:
+            counts[job.state] = counts.get(job.state, 0) + 1
+        sent = sum(job.done for job in self.flashjobs)
+        return "{}/{} done [{}] {:7.0f} bytes/sec".format(
+               counts.get('done', 0), len(self.flashjobs),
+               ", ".join("{} {}".format(n, state) for state, n in sorted(counts.items())),
+               sent / max(elapsed, 1e-6))
+
+    def run(self, report_interval=0.5, verbose=True):
+        '''Flash everything; returns the list of FlashJobs'''
+        if not self.flashjobs:
+            self.discover()
+        if not self.flashjobs:
+            return []
+        start = time.monotonic()
+        workers = self.jobs or len(self.flashjobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._flash, job) for job in self.flashjobs]
+            while True:
+                finished, _ = concurrent.futures.wait(futures, timeout=report_interval)
+                if verbose:
+                    print("\r" + self.status_line(time.monotonic() - start).ljust(79),
+                          end='', flush=True)
+                if len(finished) == len(futures):
+                    break
+        if verbose:
+            print("\r" + self.status_line(time.monotonic() - start).ljust(79))
+        return self.flashjobs
+
+def wait_for_dev(transport=None, interval=0.01, max_interval=0.2):
     print("Looking for device...", flush=True, end='')
     while True:
         try:
-            kbd = GK64()
+            kbd = GK64(transport=transport)
             if kbd.dev is not None:
-                kbd.sendcmd(1,2)
+                kbd.send_cmd(1,2)
                 break
         except USBError as e:
             if e.errno == 13: # EPERM
                 raise
-        time.sleep(0.2)
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
         print(".", flush=True, end='')
     print(" found {}".format(kbd))
     return kbd
 
-def probe_loop():
+class ScanStore(object):
+    '''On-disk results of a CommandScanner run, so it can pick up where it
+    left off. One JSON object per line, appended as we go:
+
+        {"cmd": 1, "subcmd": 1, "status": "data", "result": 1, "data": "01..."}
+        {"cmd": 8, "subcmd": 4, "status": "mismatch", "reply": [1, 2], ...}
+        {"skip": 3, "reason": "2 subcommands reset the device"}
+
+    "reply" is there when the reply that got recorded was for some other
+    cmd/subcmd (a late one, usually).
+
+    If a pair shows up more than once, the last line wins (that's how a probe
+    gets re-filed as a reset once we figure out it was the culprit).
     '''
-    Yeah, this is gross, but this is just for my personal experimentation..
+    def __init__(self, path):
+        self.path = path
+        self.results = dict()   # (cmd, subcmd) -> record
+        self.skipped = dict()   # cmd -> reason
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        pass # torn last line from a crash
+        self.f = open(path, 'a')
+
+    def _apply(self, rec):
+        if 'skip' in rec:
+            self.skipped[rec['skip']] = rec.get('reason')
+        else:
+            self.results[rec['cmd'], rec['subcmd']] = rec
+
+    def _write(self, rec):
+        with self.lock:
+            self._apply(rec)
+            self.f.write(json.dumps(rec) + '\n')
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def done(self, cmd, subcmd):
+        return (cmd, subcmd) in self.results
+
+    def record(self, cmd, subcmd, status, reply=None):
+        rec = dict(cmd=cmd, subcmd=subcmd, status=status)
+        if reply is not None:
+            if (reply.cmd, reply.subcmd) != (cmd, subcmd):
+                rec['reply'] = [reply.cmd, reply.subcmd]
+            rec['result'] = reply.result
+            if any(reply.data):
+                rec['data'] = bytes(reply.data).hex()
+        self._write(rec)
+        return rec
+
+    def skip(self, cmd, reason):
+        self._write(dict(skip=cmd, reason=reason))
+
+    def resets(self, cmd):
+        '''How many of cmd's subcommands have reset the device so far'''
+        with self.lock: # other workers are adding to results
+            return sum(1 for (c, _), rec in self.results.items()
+                       if c == cmd and rec['status'] == 'reset')
+
+    def counts(self):
+        counts = dict()
+        with self.lock:
+            for rec in self.results.values():
+                counts[rec['status']] = counts.get(rec['status'], 0) + 1
+        return counts
+
+class CommandScanner(object):
+    '''Walk the cmd/subcmd space to see what the firmware answers to.
+
+    This used to be probe_loop(), which took days: it did every pair in
+    order, pinged the keyboard after every single probe, and forgot
+    everything if it crashed. Now:
+
+    - results go into a ScanStore as we go, and a rerun skips what's done
+    - the liveness ping only happens after something odd (a timeout, or
+      only a reply to some other command), or every so often otherwise;
+      the gap between pings doubles while things are going fine, up to
+      max_check_interval probes
+    - when the keyboard drops off the bus we find it again by polling (see
+      wait_for_product), then retry the last couple of probes one at a time
+      to figure out which one did it. If it isn't back after
+      reconnect_waits * reconnect_timeout seconds, we give up (USBError)
+    - commands get skipped (and the store remembers that) after
+      max_timeouts timeouts in a row, or max_resets subcommands that
+      reset the device
+    - with several keyboards attached, each one takes commands off a
+      shared queue, so N boards scan N commands at once
     '''
-    kbd = wait_for_dev()
-    results = dict()
-    skip_a = [2,3,5,6,7]
+    DefaultSkip = (2,3,5,6,7)
     # NOTE: 3:1, 3:2, and 3:3 all seem to reset the system.. but 4 doesn't?
-    timeoutcount = 0
-    for a in range(1,256):
-        for b in range(1,255):
-            if a in skip_a: continue
 
-            print("Trying command {:02x}:{:02x}: ".format(a,b), end='', flush=True)
+    def __init__(self, store, kbds, cmds=range(1,256), subcmds=range(1,255),
+                 skip=DefaultSkip, replytimeout=200, max_timeouts=3,
+                 max_resets=2, max_check_interval=64, settle=0.1,
+                 reconnect_timeout=10.0, reconnect_waits=6, verbose=True):
+        self.store = store
+        self.kbds = list(kbds)
+        self.cmds = list(cmds)
+        self.subcmds = list(subcmds)
+        self.skip = set(skip)
+        self.replytimeout = replytimeout
+        self.max_timeouts = max_timeouts
+        self.max_resets = max_resets
+        self.max_check_interval = max_check_interval
+        self.settle = settle
+        self.reconnect_timeout = reconnect_timeout
+        self.reconnect_waits = reconnect_waits
+        self.log = print if verbose else _quiet
+        self.lock = threading.Lock() # for the counters; the workers share them
+        self.probes = 0
+        self.checks = 0
+        self.reconnects = 0
+
+    def _count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _name(self, kbd):
+        return "{:03d}:{}".format(kbd.bus or 0, '.'.join(str(p) for p in
+                                                         kbd.port_numbers or ()))
+
+    def _read_matching(self, kbd, cmd, subcmd):
+        '''Returns (reply, other): the reply to cmd/subcmd, or None if it
+        didn't turn up in time, and the last reply to anything else that
+        did turn up in the meantime (or None).'''
+        # a reply to an earlier probe that timed out can still turn up late;
+        # skip over those
+        other = None
+        while True:
+            try:
+                r = kbd.read_reply(replytimeout=self.replytimeout)
+            except USBError as e:
+                if e.errno == 110:
+                    return None, other
+                raise
+            if (r.cmd, r.subcmd) == (cmd, subcmd):
+                return r, other
+            other = r
 
-            reply = None
-            result = None
-            # Send command and save reply (or exception)
+    def _probe(self, kbd, cmd, subcmd):
+        '''Send one command; returns (status, reply)'''
+        self._count('probes')
+        try:
+            kbd.send_cmd(cmd, subcmd, getreply=False)
+            r, other = self._read_matching(kbd, cmd, subcmd)
+            if r is None:
+                # it answered, just not to this; could be the firmware's
+                # way of saying "huh?", so keep what it said
+                return ('mismatch', other) if other is not None else ('timeout', None)
+        except USBError as e:
+            if e.errno == 110:
+                return 'timeout', None
+            if e.errno == 19:
+                return 'reset', None
+            return 'error', None
+        if any(r.data):
+            return 'data', r
+        if r.result == 1:
+            return 'ok', r
+        if r.result == 0:
+            return 'nak', r
+        return 'other', r
+
+    def _alive(self, kbd):
+        self._count('checks')
+        try:
+            kbd.send_cmd(1,2, getreply=False)
+            return self._read_matching(kbd, 1, 2)[0] is not None
+        except USBError:
+            return False
+
+    def _reconnect(self, kbd):
+        self._count('reconnects')
+        kbd.dev = None
+        interval = 0.005
+        waits = 1
+        deadline = time.monotonic() + self.reconnect_timeout
+        while True:
             try:
-                reply = kbd.sendcmd(a,b)
-                result = reply
-                timeoutcount = 0
-                if any(reply.data):
-                    print("reply OK, data:", reply._hexdump())
-                elif reply.result == 1:
-                    print("reply OK")
-                elif reply.result == 0:
-                    print("reply NAK")
+                dev = kbd._find()
+                if dev is not None:
+                    kbd.find_dev(dev)
+                    if dev.idProduct == GK64.CDBootProduct:
+                        # something kicked it into the bootloader
+                        kbd.enter_keyboard_mode(self.reconnect_timeout)
+                        continue
+                    if self._alive(kbd):
+                        return
+            except USBError as e:
+                if e.errno != 19:
+                    raise
+            if time.monotonic() > deadline:
+                if waits >= self.reconnect_waits:
+                    raise USBError("{}: keyboard didn't come back".format(self._name(kbd)),
+                                   errno=19)
+                self.log("{}: waiting for the keyboard to come back...".format(self._name(kbd)))
+                waits += 1
+                deadline = time.monotonic() + self.reconnect_timeout
+            time.sleep(interval)
+            interval = min(interval * 2, 0.5)
+
+    def _isolate(self, kbd, cmd, subcmd):
+        # probe on its own, give it a moment, and see if the device survived
+        status, r = self._probe(kbd, cmd, subcmd)
+        if status != 'reset':
+            time.sleep(self.settle)
+            if not self._alive(kbd):
+                status = 'reset'
+        if status == 'reset':
+            self._reconnect(kbd)
+        return status, r
+
+    def _report(self, kbd, cmd, subcmd, status, r):
+        if status in ('data', 'ok', 'other', 'mismatch', 'reset'):
+            msg = "{}: {:02x}:{:02x} {}".format(self._name(kbd), cmd, subcmd, status)
+            if r is not None and status != 'ok':
+                msg += "\n" + r._hexdump()
+            # in one go, so other workers don't cut in
+            self.log(msg + "\n", end='', flush=True)
+
+    def _skip(self, kbd, cmd, reason):
+        self.log("{}: skipping command {:02x}: {}".format(self._name(kbd), cmd, reason))
+        self.store.skip(cmd, reason)
+
+    def _find_culprits(self, kbd, cmd, suspects):
+        '''The device went away; get it back and retry each probe that might
+        have done it, one at a time. Returns how many of them reset it.'''
+        self._reconnect(kbd)
+        resets = 0
+        while suspects:
+            _, subcmd = suspects.popleft()
+            status, r = self._isolate(kbd, cmd, subcmd)
+            self.store.record(cmd, subcmd, status, r)
+            self._report(kbd, cmd, subcmd, status, r)
+            if status == 'reset':
+                resets += 1
+        return resets
+
+    def _scan_cmd(self, kbd, cmd):
+        timeouts = 0
+        resets = self.store.resets(cmd)
+        interval = 1
+        since_check = 0
+        # (time sent, subcmd) of the probes we haven't seen the device
+        # survive yet. A reset isn't instant, so a probe only counts as
+        # survived once a liveness check `settle` seconds after it passes.
+        suspects = deque()
+        for subcmd in self.subcmds:
+            if resets >= self.max_resets and cmd not in self.store.skipped:
+                self._skip(kbd, cmd, "{} subcommands reset the device".format(resets))
+            if cmd in self.store.skipped:
+                return
+            if self.store.done(cmd, subcmd):
+                continue
+            sent = time.monotonic()
+            status, r = self._probe(kbd, cmd, subcmd)
+            suspects.append((sent, subcmd))
+            if status == 'reset':
+                resets += self._find_culprits(kbd, cmd, suspects)
+                interval = 1
+                since_check = 0
+                continue
+
+            self.store.record(cmd, subcmd, status, r)
+            self._report(kbd, cmd, subcmd, status, r)
+            since_check += 1
+            if status == 'timeout':
+                timeouts += 1
+                if timeouts >= self.max_timeouts:
+                    self._skip(kbd, cmd, "{} timeouts in a row".format(timeouts))
+            else:
+                timeouts = 0
+            odd = status in ('timeout', 'mismatch', 'error')
+            if odd or since_check >= interval:
+                since_check = 0
+                checked = time.monotonic()
+                if self._alive(kbd):
+                    while suspects and suspects[0][0] < checked - self.settle:
+                        suspects.popleft()
+                    if odd:
+                        interval = 1
+                    else:
+                        interval = min(interval * 2, self.max_check_interval)
                 else:
-                    print("unhandled reply:", reply._hexdump())
-            except USBError as err:
-                print(err)
-                result = err
-                if err.errno == 110:
-                    timeoutcount += 1
-
-            results[a,b] = result
-            if timeoutcount == 3:
-                timeoutcount = 0
-                skip_a.append(a)
-                kbd = wait_for_dev()
-
-            # Check if the device is still available..
+                    interval = 1
+                    resets += self._find_culprits(kbd, cmd, suspects)
+        # make sure the last few didn't take it down on the way out
+        if suspects:
+            time.sleep(self.settle)
+            if not self._alive(kbd):
+                resets += self._find_culprits(kbd, cmd, suspects)
+        if resets >= self.max_resets and cmd not in self.store.skipped:
+            self._skip(kbd, cmd, "{} subcommands reset the device".format(resets))
+
+    def _worker(self, kbd, todo):
+        while True:
             try:
-                kbd.sendcmd(1,2)
-            except USBError as err:
-                # Record that this command lead to an error
-                result = [result, err]
-                # Wait a moment to recover
-                # And reconnect if needed
-                if err.errno == 19: # No such device
-                    time.sleep(0.2)
-                    kbd.find_dev()
-
-            # If we got a good result, show the user
-            if reply and (reply.result or any(reply.data)):
-                print(reply._hexdump())
-                print
-
-    print(results)
-
-def binfile_read(binfile):
-    '''Read the data of a (descrambled) firmware image'''
+                cmd = todo.get_nowait()
+            except queue.Empty:
+                return
+            self._scan_cmd(kbd, cmd)
+
+    def pending(self):
+        return [cmd for cmd in self.cmds
+                if cmd not in self.skip and cmd not in self.store.skipped and
+                not all(self.store.done(cmd, s) for s in self.subcmds)]
+
+    def run(self):
+        '''Scan everything that isn't done yet; returns the elapsed time'''
+        start = time.monotonic()
+        todo = queue.Queue()
+        for cmd in self.pending():
+            todo.put(cmd)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.kbds)) as pool:
+            for f in [pool.submit(self._worker, kbd, todo) for kbd in self.kbds]:
+                f.result()
+        return time.monotonic() - start
+
+def binfile_read(binfile, crc=None):
+    '''Read the data of a (descrambled) firmware image
+
+    If crc is a CRC16 object, it gets updated with the data as it's read.
+    '''
     if os.path.getsize(binfile) > 0xffff:
         raise ValueError(".bin is too big (>64kb)")
-    bindata = bytes()
     with open(binfile, 'rb') as binf:
-        for idx in range(16):
-            vec = binf.read(4)
-            if vec[0:2] != b'\x48\x00':
-                raise ValueError(".bin doesn't start with a vector table?")
-            bindata += vec
-        bindata += binf.read()
+        bindata = binf.read()
+    check_vector_table(bindata)
+    if crc is not None:
+        crc.update(bindata)
     return bindata
 
+def check_vector_table(bindata):
+    # every one of the 16 vectors is a "j" instruction (0x48 0x00 ..)
+    vectors = bindata[:0x40]
+    if len(vectors) < 0x40 or vectors[0::4] != b'\x48' * 16 or \
+       vectors[1::4] != b'\x00' * 16:
+        raise ValueError(".bin doesn't start with a vector table?")
+
+def _cache_dir(*parts):
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cachedir, 'gk64', *parts)
+
+# Image store entry layout: this header, then the image at 0x40, then the
+# encoded packet stream at stream_offset (64-byte aligned).
+#   magic, image size, mycrc16 of image, BImgHdr, stream offset, stream size
+ImageEntryStruct = struct.Struct("<8sIH2x32sII")
+ImageEntryMagic = b'GK64IMG1'
+
+class StoredImage(object):
+    '''A firmware image out of an ImageStore, with everything fwup needs.
+
+    bindata and stream are memoryviews into the mmap'd entry file, so
+    close() this (or use it as a context manager) when you're done.
+
+    hdr is the header as it was built when the image went into the store,
+    timestamp and all; header() gives you one stamped with the time now,
+    like a freshly made one would be.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, size, self.crc, hdrdata, soff, ssize = \
+                ImageEntryStruct.unpack_from(self._map)
+            if magic != ImageEntryMagic or 0x40 + size > soff or \
+               soff + ssize != len(self._map):
+                raise ValueError("{}: bad image store entry".format(filename))
+            self.hdr = BImgHdr._unpack(hdrdata)
+            self._view = memoryview(self._map)
+            self.bindata = self._view[0x40:0x40+size]
+            self.stream = self._view[soff:soff+ssize]
+            if mycrc16(self.bindata) != self.crc:
+                raise ValueError("{}: image checksum mismatch".format(filename))
+        except (struct.error, ValueError):
+            self.close()
+            raise
+
+    def header(self, ts=None):
+        '''hdr, but with ts (default: now) as its timestamp'''
+        ts = ts if ts else int(time.time())
+        return self.hdr._replace(ts=ts)._replace_checksum()
+
+    def close(self):
+        for name in ('bindata', 'stream', '_view'):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ImageStore(object):
+    '''Firmware images we've seen before, keyed by a hash of the .bin file.
+
+    The first time we see a .bin we check it, work out its CRC and BImgHdr,
+    encode the whole 2,2 packet stream, and write all that to one entry
+    file. After that, get() is a hash and an mmap, so fwup can start
+    sending right away.
+    '''
+    def __init__(self, path=None):
+        self.path = path if path is not None else _cache_dir('images')
+
+    def _filename(self, digest):
+        return os.path.join(self.path, digest + '.gkimg')
+
+    @staticmethod
+    def build(bindata, hdr=None):
+        '''Returns the bytes of a store entry for bindata'''
+        check_vector_table(bindata)
+        if hdr is None:
+            hdr = make_bimg_header(bindata)
+        stream = encode_packet_stream(bindata[:hdr.size], 2, 2)
+        soff = (0x40 + len(bindata) + 0x3f) & ~0x3f
+        entry = bytearray(soff)
+        ImageEntryStruct.pack_into(entry, 0, ImageEntryMagic, len(bindata),
+                                   mycrc16(bindata), hdr._pack(), soff,
+                                   len(stream) * stream.itemsize)
+        entry[0x40:0x40+len(bindata)] = bindata
+        return bytes(entry) + stream.tobytes()
+
+    def get(self, binfile):
+        '''Returns a StoredImage for binfile, adding it to the store if need be'''
+        if os.path.getsize(binfile) > 0xffff:
+            raise ValueError(".bin is too big (>64kb)")
+        with open(binfile, 'rb') as binf:
+            bindata = binf.read()
+        filename = self._filename(hashlib.sha256(bindata).hexdigest())
+        try:
+            return StoredImage(filename)
+        except (OSError, ValueError):
+            pass # not there yet (or broken); (re)build it
+        entry = self.build(bindata)
+        os.makedirs(self.path, exist_ok=True)
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(entry)
+        os.replace(tmpfile, filename)
+        return StoredImage(filename)
+
+# The firmware image gets loaded at this address in flash; see the notes on
+# FIRMWARE_LAYOUT in disasm/BBD8.disasm. Offsets in 2,2 packets are relative
+# to this.
+fw_base_addr = 0x2a00
+
 # These are the values for "magic", "itype", and "name" that I've seen in the
 # corresponding file types. "name" doesn't seem to matter for bimg so I'm
 # setting it to something recognizable.
@@ -455,14 +2150,66 @@ fw_finalize_packets = {fwid:{p:fw_finalize_packet(*p) for p in pairs}
                        for fwid,pairs in fw_finalize_values.items()}
 
 
-def memaddr(s):
-    addr = int(s, 16)
-    if addr > 0xffffff:
+def format_ranges(ranges):
+    return ", ".join("{:#06x}-{:#06x}".format(start, end) for start, end in ranges)
+
+def report_verify(kbd, bindata, window=8):
+    '''verify_firmware() and print how it went; returns True if it's good'''
+    start = time.monotonic()
+    bad = verify_firmware(kbd, bindata, window=window)
+    elapsed = time.monotonic() - start
+    if bad:
+        print("MISMATCH at {} ({} bytes)".format(format_ranges(bad),
+                                                 sum(e - s for s, e in bad)))
+        return False
+    print("ok ({:.2f}s)".format(elapsed))
+    return True
+
+def hexint(s):
+    return int(s, 16)
+
+def memaddr(s, limit=0xffffff):
+    # hex, or a region name from MemoryRegions with an optional hex offset
+    # ("sram+100")
+    name, plus, offset = s.partition('+')
+    if name in dict((r[0], r) for r in MemoryRegions):
+        addr = memory_region(name)[1] + (int(offset, 16) if plus else 0)
+    else:
+        addr = int(s, 16)
+    if not 0 <= addr <= limit:
         raise ValueError
     return addr
 
+def memend(s):
+    # like memaddr, but for end addresses (and sizes), where 0x1000000 is
+    # fine too
+    return memaddr(s, 0x1000000)
+
+def regionlist(s):
+    if s == 'all':
+        return [r[0] for r in MemoryRegions]
+    names = s.split(',')
+    for name in names:
+        memory_region(name)
+    return names
+
+def intrange(s):
+    first, _, last = s.partition('-')
+    return range(int(first, 0), int(last or first, 0) + 1)
+
+def intlist(s):
+    return tuple(int(v, 0) for v in s.split(',') if v)
+
 def parse_args():
     parser = argparse.ArgumentParser(description='GK6x firmware tool')
+    parser.add_argument("--sim", action="store_true",
+                        help="talk to a simulated keyboard (see gk64sim.py)")
+    parser.add_argument("--sim-keyboards", type=int, default=1, metavar="N",
+                        help="how many keyboards to simulate (default: %(default)s)")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="write latency/retry/throughput stats here as JSON")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write a Chrome/Perfetto trace here")
     subp = parser.add_subparsers(
         description="(commands marked with a * require modified firmware)")
 
@@ -470,6 +2217,44 @@ def parse_args():
     fwup.add_argument("action", action="store_const", const="fwup", help=argparse.SUPPRESS)
     fwup.add_argument("binfile", help="firmware binary (w/o header)")
     fwup.add_argument("--header", help="firmware header")
+    fwup.add_argument("--window", type=int, default=1,
+                      help="firmware chunks to send before waiting for a reply (default: %(default)s)")
+    fwup.add_argument("--verify", action="store_true",
+                      help="* read the firmware back afterwards to check it")
+    fwup.add_argument("--store", default=None,
+                      help="image store directory (default: ~/.cache/gk64/images)")
+    fwup.add_argument("--no-store", action="store_true",
+                      help="don't use (or add to) the image store")
+    fwup.add_argument("--delta", action="store_true",
+                      help="* only send what changed since the last --delta flash")
+    fwup.add_argument("--cache", default=None,
+                      help="where --delta keeps flashed images (default: ~/.cache/gk64/flashed)")
+    fwup.add_argument("--delta-unproven", action="store_true",
+                      help="* send a --delta even if no delta onto this kind of board has "
+                           "checked out yet (if its bootloader erases the image, the "
+                           "fallback full upload has to put it back)")
+
+    fleet = subp.add_parser("fleet", help="send a firmware update to every attached keyboard")
+    fleet.add_argument("action", action="store_const", const="fleet", help=argparse.SUPPRESS)
+    fleet.add_argument("binfile", help="firmware binary (w/o header)")
+    fleet.add_argument("--header", help="firmware header")
+    fleet.add_argument("--window", type=int, default=1,
+                       help="firmware chunks to send before waiting for a reply (default: %(default)s)")
+    fleet.add_argument("--jobs", type=int, default=None,
+                       help="keyboards to flash at once (default: all of them)")
+    fleet.add_argument("--store", default=None,
+                       help="image store directory (default: ~/.cache/gk64/images)")
+    fleet.add_argument("--verify", action="store_true",
+                       help="* read the firmware back afterwards to check it")
+
+    verify = subp.add_parser("verify", help="* check the firmware in flash matches a .bin")
+    verify.add_argument("action", action="store_const", const="verify", help=argparse.SUPPRESS)
+    verify.add_argument("binfile", help="firmware binary (w/o header)")
+    verify.add_argument("--window", type=int, default=8,
+                        help="read requests to keep in flight (default: %(default)s)")
+
+    listp = subp.add_parser("list", help="list attached keyboards")
+    listp.add_argument("action", action="store_const", const="list", help=argparse.SUPPRESS)
 
     cmd = subp.add_parser('cmd', help="send command packet")
     cmd.add_argument("action", action="store_const", const="cmd", help=argparse.SUPPRESS)
@@ -479,95 +2264,259 @@ def parse_args():
     peek = subp.add_parser('peek', help="* peek at a memory address")
     peek.add_argument("action", action="store_const", const="peek", help=argparse.SUPPRESS)
     peek.add_argument("offset", type=memaddr, help="memory address to peek at")
+    peek.add_argument("--size", type=memend, default=0x38,
+                      help="how many bytes to read (default: 0x38)")
 
     dump = subp.add_parser('dump', help="* dump memory to a file")
     dump.add_argument("action", action="store_const", const="dump", help=argparse.SUPPRESS)
     dump.add_argument("start", type=memaddr, help="start address")
-    dump.add_argument("end", type=memaddr, help="end address")
+    dump.add_argument("end", type=memend, help="end address")
     dump.add_argument("outfile", help="output filename")
+    dump.add_argument("--window", type=int, default=8,
+                      help="read requests to keep in flight (default: %(default)s)")
+    dump.add_argument("--restart", action="store_true",
+                      help="ignore any saved progress and start over")
+
+    snap = subp.add_parser('snapshot', help="* sparse dump of whole memory regions")
+    snap.add_argument("action", action="store_const", const="snapshot", help=argparse.SUPPRESS)
+    snap.add_argument("outfile", help="output filename")
+    snap.add_argument("--regions", type=regionlist, default=list(DefaultSnapshotRegions),
+                      help="comma-separated, or 'all' (default: {}; choose from: {})".format(
+                           ",".join(DefaultSnapshotRegions),
+                           ",".join(r[0] for r in MemoryRegions)))
+    snap.add_argument("--probe", action="store_true",
+                      help="skip reading gaps that look blank when probed (faster, "
+                           "but can miss small bits of data)")
+    snap.add_argument("--stride", type=hexint, default=0x1000,
+                      help="--probe: distance between the first probes (hex, default: 1000)")
+    snap.add_argument("--fine", type=hexint, default=0x400,
+                      help="--probe: smallest gap that gets probed again (hex, default: 400)")
+    snap.add_argument("--window", type=int, default=8,
+                      help="read requests to keep in flight (default: %(default)s)")
+
+    unsp = subp.add_parser('unsparse', help="get a plain binary back out of a snapshot")
+    unsp.add_argument("action", action="store_const", const="unsparse", help=argparse.SUPPRESS)
+    unsp.add_argument("infile", help="snapshot file")
+    unsp.add_argument("outfile", nargs='?', help="output filename (leave it off to list regions)")
+    unsp.add_argument("--region", help="region to write out")
+    unsp.add_argument("--start", type=memaddr, help="or: start address")
+    unsp.add_argument("--end", type=memend, help="..and end address")
+
+    hexd = subp.add_parser('hexdump', help="hexdump a file (e.g. a memory dump)")
+    hexd.add_argument("action", action="store_const", const="hexdump", help=argparse.SUPPRESS)
+    hexd.add_argument("infile", help="file to dump")
+    hexd.add_argument("--start", type=hexint, default=0, help="file offset to start at")
+    hexd.add_argument("--end", type=hexint, default=None, help="file offset to stop at")
+    hexd.add_argument("--base", type=hexint, default=0,
+                      help="address of the start of the file (default: 0)")
+    hexd.add_argument("-s", "--squeeze", action="store_true",
+                      help="show repeated lines as '*'")
+
+    scan = subp.add_parser('scan', help="probe every cmd/subcmd pair and record the replies")
+    scan.add_argument("action", action="store_const", const="scan", help=argparse.SUPPRESS)
+    scan.add_argument("outfile", help="results file (a rerun picks up where it left off)")
+    scan.add_argument("--cmds", type=intrange, default=range(1,256), metavar="A-B",
+                      help="command numbers to scan (default: 1-255)")
+    scan.add_argument("--skip", type=intlist, default=CommandScanner.DefaultSkip,
+                      metavar="A,B,..", help="commands not to touch (default: %(default)s)")
+    scan.add_argument("--timeout", type=int, default=200,
+                      help="reply timeout in ms (default: %(default)s)")
 
     args = parser.parse_args()
 
     return args
 
 def main(args):
-    kbd = GK64()
+    transport = None
+    if args.sim:
+        import gk64sim
+        transport = gk64sim.SimTransport([gk64sim.SimKeyboard(address=n+1)
+                                          for n in range(args.sim_keyboards)])
+
+    if args.action == "list":
+        for dev in find_keyboards(transport):
+            print("{:03d}:{:03d} {:04x}:{:04x}".format(dev.bus, dev.address,
+                                                      dev.idVendor, dev.idProduct))
+        return
+
+    elif args.action == "fleet":
+        with ImageStore(args.store).get(args.binfile) as image:
+            if args.header:
+                hdr = BImgHdr._unpack(open(args.header,'rb').read(0x20))
+            else:
+                hdr = image.header()
+            fleet = FleetFlasher(image.bindata, hdr, window=args.window, jobs=args.jobs,
+                                 transport=transport, verify=args.verify,
+                                 stream=image.stream)
+            if not fleet.discover():
+                print("no keyboards found")
+                return
+            print("flashing {} keyboards".format(len(fleet.flashjobs)))
+            for job in fleet.run():
+                print("{}: {} in {:.1f}s{}".format(job.name, job.state, job.elapsed,
+                      ": {}".format(job.error) if job.error else ""))
+        return
+
+    elif args.action == "hexdump":
+        try:
+            hexdump_file(args.infile, args.start, args.end, args.base, args.squeeze)
+        except BrokenPipeError:
+            pass # piped into head or whatever
+        return
+
+    elif args.action == "unsparse":
+        snap = SparseSnapshot(args.infile)
+        if not args.outfile:
+            for name, start, end, extents in snap.regions:
+                sizes = dict((kind, 0) for kind in SparseKinds)
+                for addr, length, kind, fill, offset in extents:
+                    sizes[kind] += length
+                print("{:<10} {:#08x}-{:#08x}: {}".format(name, start, end, ", ".join(
+                      "{} {}".format(sizes[k], SparseKinds[k]) for k in sorted(SparseKinds))))
+            return
+        if args.region:
+            _, start, end, _ = snap.region(args.region)
+        elif args.start is not None and args.end is not None:
+            start, end = args.start, args.end
+        else:
+            raise SystemExit("unsparse: need --region or --start and --end")
+        try:
+            data = snap.read(start, end)
+        except ValueError as e:
+            raise SystemExit("unsparse: {}".format(e))
+        with open(args.outfile, 'wb') as outf:
+            outf.write(data)
+        return
+
+    elif args.action == "scan":
+        kbds = [GK64(dev.bus, dev.address, transport=transport)
+                for dev in find_keyboards(transport)
+                if dev.idProduct == GK64.GK64Product]
+        if not kbds:
+            print("no keyboards found")
+            return
+        store = ScanStore(args.outfile)
+        scanner = CommandScanner(store, kbds, cmds=args.cmds, skip=args.skip,
+                                 replytimeout=args.timeout)
+        print("scanning {} commands on {} keyboards".format(len(scanner.pending()),
+                                                           len(kbds)))
+        try:
+            elapsed = scanner.run()
+        finally:
+            store.close()
+        print("{} probes, {} liveness checks, {} reconnects in {:.1f}s".format(
+              scanner.probes, scanner.checks, scanner.reconnects, elapsed))
+        print(", ".join("{} {}".format(n, status)
+                        for status, n in sorted(store.counts().items())))
+        return
+
+    kbd = GK64(transport=transport)
     if args.action == "cmd":
         print(kbd.send_cmd(args.cmd, args.sub)._hexdump())
 
     elif args.action == "peek":
-        hexdump(kbd.read_memory_hax(args.offset), args.offset)
+        # stop at the end of the address space rather than complain
+        end = min(args.offset + args.size, 0x1000000)
+        hexdump(kbd.read_memory([(args.offset, end)]), args.offset)
 
     elif args.action == "dump":
-        size = 0x38
-        overlap = 0
-        offset = args.start
-        end = args.end
-        with open(args.outfile, 'wb+') as flash_out:
-            while offset < end:
-                print("hax reading flash: {:#x}".format(offset), end='\n', flush=True)
-                # check to make sure we don't read past end, because bad things
-                # happen if you read past a memory boundary...
-                if (offset + size) >= end:
-                    overlap = offset + size - end
-                    offset -= overlap
-                    assert(offset + size == end)
-                chunk = kbd.read_memory_hax(offset)
-                if overlap:
-                    chunk = chunk[overlap:]
-                flash_out.write(chunk)
-                offset += len(chunk)
-            print()
+        dumper = MemoryDumper(kbd, args.start, args.end, args.outfile,
+                              window=args.window)
+        count = dumper.run(resume=not args.restart)
+        print("read {} bytes in {:.2f}s".format(count, dumper.elapsed))
+
+    elif args.action == "snapshot":
+        dumper = SparseDumper(kbd, args.regions, stride=args.stride, fine=args.fine,
+                              probe=args.probe, window=args.window)
+        extents = dumper.run(args.outfile)
+        for name in args.regions:
+            stored = sum(e[1] for e in extents[name] if e[2] == SparseData)
+            print("{:<10} {:6} bytes of data in {} extents".format(
+                  name, stored, len(extents[name])))
+        print("probed {} bytes, read {}, skipped {} in {:.2f}s".format(
+              dumper.probed, dumper.read, dumper.skipped, dumper.elapsed))
 
     elif args.action == "fwup":
         print("reading firmware data: ", end='', flush=True)
-        # TODO: checksum while reading
-        bindata = binfile_read(args.binfile)
-        print("ok, size {}, checksum {:04X}".format(len(bindata), mycrc16(bindata)))
-        hdr = None
-        if args.header:
-            print("reading firmware header: ", end='', flush=True)
-            hdrdata = open(args.header,'rb').read(0x20)
-            hdr = BImgHdr._unpack(hdrdata)
+        image = stream = None
+        if args.no_store:
+            crc = CRC16(iv=0xffff)
+            bindata = binfile_read(args.binfile, crc)
+            checksum = crc.value()
         else:
-            print("building firmware header: ", end='', flush=True)
-            hdr = make_bimg_header(bindata)
-        print("ok, name='{}', ts={} ({})".format(hdr.name.rstrip(b'\0').decode('utf8'),
-                                                 hdr.ts,
-                                                 time.strftime("%c", time.gmtime(hdr.ts))))
-
-        # TODO: should have a context manager for CDBOOT mode..
-        # FIXME: header will be rejected if we're already in cdboot mode.
-        # Gotta reset first...
-        print("switching to CDBOOT mode: ", end='', flush=True)
-        kbd.enter_keyboard_mode()
-        if not kbd.enter_cdboot_mode():
-            print("failed :<")
-            return
-        print("ok")
-
+            image = ImageStore(args.store).get(args.binfile)
+            bindata, checksum, stream = image.bindata, image.crc, image.stream
         try:
-            fwup_ok = False
-            fwup_ok = kbd.cdboot_send_firmware(bindata, hdr)
-        except FirmwareUpdateError as e:
-            print("fwup failed: {}".format(e.message))
-            print("reply was:")
-            print(e.reply._hexdump())
-        except OSError as e:
-            print("fwup failed: {}".format(e))
-        finally:
-            print("switching back to keyboard mode: ", end='', flush=True)
-            if kbd.enter_keyboard_mode():
-                print("ok")
+            print("ok, size {}, checksum {:04X}".format(len(bindata), checksum))
+            hdr = None
+            if args.header:
+                print("reading firmware header: ", end='', flush=True)
+                hdrdata = open(args.header,'rb').read(0x20)
+                hdr = BImgHdr._unpack(hdrdata)
+            elif image is not None:
+                # everything but the timestamp, which should be now, not
+                # whenever the image went into the store
+                print("using stored firmware header: ", end='', flush=True)
+                hdr = image.header()
             else:
-                print("failed :<")
+                print("building firmware header: ", end='', flush=True)
+                hdr = make_bimg_header(bindata)
+            print("ok, name='{}', ts={} ({})".format(hdr.name.rstrip(b'\0').decode('utf8'),
+                                                     hdr.ts,
+                                                     time.strftime("%c", time.gmtime(hdr.ts))))
+
+            fwup_ok = False
+            try:
+                if args.delta:
+                    flasher = DeltaFlasher(kbd, FirmwareCache(args.cache), window=args.window,
+                                           unproven=args.delta_unproven)
+                    fwup_ok = flasher.run(bindata, hdr)
+                    if fwup_ok:
+                        print("{} upload: sent {} bytes, saved {} bytes".format(
+                              flasher.mode, flasher.sent, flasher.saved))
+                else:
+                    fwup_ok = kbd.update_firmware(bindata, hdr, window=args.window,
+                                                  stream=stream)
+            except FirmwareUpdateError as e:
+                print("fwup failed: {}".format(e.message))
+                print("reply was:")
+                print(e.reply._hexdump())
+            except OSError as e:
+                print("fwup failed: {}".format(e))
+            if fwup_ok and args.verify:
+                print("verifying: ", end='', flush=True)
+                fwup_ok = report_verify(kbd, bindata[:hdr.size])
             if fwup_ok:
                 print("firmware updated successfully! have fun!!!!")
+        finally:
+            if image is not None:
+                image.close() # bindata and stream are views into it
+
+    elif args.action == "verify":
+        bindata = binfile_read(args.binfile)
+        print("verifying {} bytes at {:#06x}: ".format(len(bindata), fw_base_addr),
+              end='', flush=True)
+        if not report_verify(kbd, bindata, window=args.window):
+            raise SystemExit(1)
+
+def traced_main(args):
+    if not (args.stats or args.trace):
+        return main(args)
+    import gk64trace
+    # only keep trace events if they asked for a trace
+    GK64.trace = tracer = gk64trace.Tracer() if args.trace else gk64trace.Tracer(max_events=0)
+    try:
+        return main(args)
+    finally:
+        if args.stats:
+            tracer.write_json(args.stats)
+        if args.trace:
+            tracer.write_chrome_trace(args.trace)
 
 if __name__ == '__main__':
     try:
         args = parse_args()
-        main(args)
+        traced_main(args)
     except KeyboardInterrupt:
         raise SystemExit(1)
     except OSError as e:
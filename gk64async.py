@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# gk64async.py - asyncio front end for GK64
+#
+# pyusb is blocking-only, so all the actual USB I/O happens on one shared
+# I/O thread (UsbIoThread). That thread sends whatever the coroutines ask it
+# to and polls each device that has requests outstanding, handing replies
+# back to whichever request they belong to. So you can drive a pile of
+# keyboards from one event loop without a thread per keyboard:
+#
+#   async def main():
+#       kbd = await AsyncGK64.open()
+#       print(await kbd.get_fwid())
+#       data = await kbd.read_memory(0x100000, 0x200)
+#
+# Replies get matched up with requests by cmd/subcmd, plus the address that
+# the haxed cmd 4,1 echoes back. Everything takes a timeout, and cancelling
+# a coroutine forgets about its reply.
+#
+# The long, stateful stuff (mode switches, firmware upload) just calls the
+# GK64 methods, on a thread of their own so they don't hold up every other
+# keyboard; see UsbIoThread.exclusive.
+
+import queue
+import asyncio
+import threading
+import concurrent.futures
+
+from usb.core import USBError
+
+from gk64 import GK64, PacketBuffer, memory_blocks
+
+class UsbIoThread(object):
+    '''The thread that does all the (blocking) USB work for AsyncGK64s
+
+    poll_timeout is how long (in ms) each read waits for a reply before we
+    move on to the next device.
+    '''
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, poll_timeout=2):
+        self.poll_timeout = poll_timeout
+        self.calls = queue.Queue()
+        self.pending = dict()  # GK64 -> [(match, concurrent Future), ...]
+        self.busy = set()      # GK64s handed over to exclusive() calls
+        self.unmatched = 0     # replies nobody was waiting for
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="gk64-usb-io",
+                                       daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def default(cls):
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def stop(self):
+        self.stopping = True
+        self.thread.join()
+
+    def call(self, fn, *args, **kwargs):
+        '''Run fn on the I/O thread; returns an awaitable for the result'''
+        cf = concurrent.futures.Future()
+        self.calls.put((cf, fn, args, kwargs))
+        return asyncio.wrap_future(cf)
+
+    def exclusive(self, kbd, fn, *args, **kwargs):
+        '''Run fn (a blocking GK64 method, say) on a thread of its own, with
+        kbd all to itself until it returns; returns an awaitable for the
+        result.
+
+        The I/O thread keeps serving the other keyboards in the meantime,
+        and refuses any requests for kbd.
+        '''
+        cf = concurrent.futures.Future()
+        self.calls.put((None, self._start_exclusive, (cf, kbd, fn, args, kwargs), {}))
+        return asyncio.wrap_future(cf)
+
+    # --- everything below here runs on the I/O thread ---
+
+    def _start_exclusive(self, cf, kbd, fn, args, kwargs):
+        if not cf.set_running_or_notify_cancel():
+            return
+        if kbd in self.busy or self.pending.get(kbd):
+            cf.set_exception(RuntimeError("{!r} has requests outstanding".format(kbd)))
+            return
+        self.busy.add(kbd)
+        def run():
+            try:
+                result, exc = fn(*args, **kwargs), None
+            except BaseException as e:
+                result, exc = None, e
+            # hand it back on the I/O thread, so busy is only ever touched there
+            self.calls.put((None, self._end_exclusive, (cf, kbd, result, exc), {}))
+        threading.Thread(target=run, name="gk64-usb-exclusive", daemon=True).start()
+
+    def _end_exclusive(self, cf, kbd, result, exc):
+        self.busy.discard(kbd)
+        self._resolve(cf, result, exc)
+
+    def submit(self, kbd, pkt, match=None):
+        '''Send an encoded packet; if match is given, return a Future that
+        gets the first reply for which match(reply) is true.'''
+        if kbd in self.busy:
+            raise RuntimeError("{!r} is busy".format(kbd))
+        waiter = None
+        if match is not None:
+            waiter = concurrent.futures.Future()
+            self.pending.setdefault(kbd, []).append((match, waiter))
+        try:
+            kbd.send_packet(pkt)
+        except Exception:
+            if waiter is not None:
+                self.pending[kbd].remove((match, waiter))
+            raise
+        return waiter
+
+    def _run_calls(self, wait):
+        try:
+            item = self.calls.get(timeout=0.05) if wait else self.calls.get_nowait()
+        except queue.Empty:
+            return
+        while item is not None:
+            cf, fn, args, kwargs = item
+            if cf is None: # internal; deals with its own future
+                fn(*args, **kwargs)
+            elif cf.set_running_or_notify_cancel():
+                try:
+                    cf.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    cf.set_exception(e)
+            try:
+                item = self.calls.get_nowait()
+            except queue.Empty:
+                item = None
+
+    @staticmethod
+    def _resolve(waiter, result=None, exc=None):
+        try:
+            if exc is not None:
+                waiter.set_exception(exc)
+            else:
+                waiter.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass # cancelled (or timed out) while we were busy
+
+    def _poll(self, kbd):
+        waiters = self.pending[kbd]
+        waiters[:] = [w for w in waiters if not w[1].done()]
+        if not waiters:
+            del self.pending[kbd]
+            return
+        try:
+            r = kbd.read_reply(replytimeout=self.poll_timeout)
+        except USBError as e:
+            if e.errno == 110:
+                return
+            # the device is gone or broken; nobody's getting a reply
+            for _, waiter in waiters:
+                self._resolve(waiter, exc=e)
+            del self.pending[kbd]
+            return
+        for idx, (match, waiter) in enumerate(waiters):
+            if match(r):
+                del waiters[idx]
+                self._resolve(waiter, r)
+                return
+        self.unmatched += 1
+
+    def _run(self):
+        while not self.stopping:
+            self._run_calls(wait=not self.pending)
+            for kbd in list(self.pending):
+                self._poll(kbd)
+
+def _match_cmd(cmd, subcmd):
+    return lambda r: r.cmd == cmd and r.subcmd == subcmd
+
+def _match_hax_read(addr):
+    lo = addr & 0xffff
+    return lambda r: r.cmd == 4 and r.pad2 == 0x38 and r.result == lo
+
+class AsyncGK64(object):
+    '''Coroutine versions of the GK64 operations
+
+    Wraps a GK64; only ever touch that GK64 from the I/O thread (i.e. via
+    self.io.call or self.io.exclusive) once you've handed it to one of these.
+    '''
+    def __init__(self, kbd, io=None):
+        self.kbd = kbd
+        self.io = io if io is not None else UsbIoThread.default()
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__, self.kbd)
+
+    @classmethod
+    async def open(cls, bus=None, address=None, transport=None, io=None):
+        io = io if io is not None else UsbIoThread.default()
+        kbd = await io.call(GK64, bus, address, transport)
+        if kbd.dev is None:
+            raise USBError("No such device (it may have been disconnected)", errno=19)
+        return cls(kbd, io)
+
+    async def _request(self, pkt, match, timeout):
+        waiter = await self.io.call(self.io.submit, self.kbd, pkt, match)
+        if waiter is None:
+            return None
+        return await asyncio.wait_for(asyncio.wrap_future(waiter), timeout)
+
+    async def send_cmd(self, cmd, subcmd, offset=0, length=0, data=None,
+                       getreply=True, timeout=1.0, match=None):
+        '''Send a command; returns the ReplyPacket (or None if not getreply)
+
+        Raises asyncio.TimeoutError if no matching reply turns up in time.
+        By default any reply with the same cmd/subcmd matches.
+        '''
+        if offset & 0xff000000:
+            raise ValueError("offset {:#010x} > 0x00ffffff".format(offset))
+        pkt = _encode_one(cmd, subcmd, offset & 0xffff, offset >> 16, length, data)
+        if getreply and match is None:
+            match = _match_cmd(cmd, subcmd)
+        return await self._request(pkt, match if getreply else None, timeout)
+
+    async def get_fwid(self, timeout=1.0):
+        r = await self.send_cmd(1,1, timeout=timeout)
+        if r.result == 1:
+            self.kbd.fwid = "{r[3]:02x}-{r[2]:02x}{r[1]:02x}-{r[0]:02x}-V{r[5]:d}.{r[4]:d}".format(r=r.data)
+        return self.kbd.fwid
+
+    async def read_block(self, addr, timeout=0.5, retries=5):
+        '''Read 0x38 bytes at addr with the haxed cmd 4,1'''
+        pkt = _encode_one(4, 1, addr & 0xffff, 0, addr >> 16)
+        for attempt in range(retries + 1):
+            try:
+                r = await self._request(pkt, _match_hax_read(addr), timeout)
+                return r.data
+            except asyncio.TimeoutError:
+                if attempt == retries:
+                    raise
+
+    async def read_memory(self, start, size, window=8, timeout=0.5, retries=5):
+        '''Read size bytes from start, keeping `window` reads in flight'''
+        end = start + size
+        out = bytearray(size)
+        sem = asyncio.Semaphore(window)
+        async def read_one(readaddr, skip, offset, length):
+            async with sem:
+                data = await self.read_block(readaddr, timeout, retries)
+            out[offset-start:offset-start+length] = data[skip:skip+length]
+        await asyncio.gather(*(read_one(*b) for b in memory_blocks(start, end)))
+        return bytes(out)
+
+    def _progress(self, progress):
+        # the GK64 methods call progress from the exclusive() thread; pass
+        # it on to the event loop
+        if progress is None:
+            return None
+        loop = asyncio.get_running_loop()
+        return lambda *args: loop.call_soon_threadsafe(progress, *args)
+
+    async def enter_cdboot_mode(self, timeout=5.0):
+        return await self.io.exclusive(self.kbd, self.kbd.enter_cdboot_mode, timeout)
+
+    async def enter_keyboard_mode(self, timeout=5.0):
+        return await self.io.exclusive(self.kbd, self.kbd.enter_keyboard_mode, timeout)
+
+    async def send_firmware(self, bindata, hdr=None, window=8, retries=3,
+                            timeout=1.0, progress=None):
+        '''GK64.cdboot_send_firmware, without the printing
+
+        timeout is in seconds here. Raises FirmwareUpdateError or USBError
+        like the real thing does.
+        '''
+        return await self.io.exclusive(self.kbd, self.kbd.cdboot_send_firmware,
+                                       bindata, hdr, window=window, retries=retries,
+                                       replytimeout=int(timeout * 1000), verbose=False,
+                                       progress=self._progress(progress))
+
+    async def update_firmware(self, bindata, hdr=None, window=8, progress=None):
+        '''GK64.update_firmware, without the printing'''
+        return await self.io.exclusive(self.kbd, self.kbd.update_firmware,
+                                       bindata, hdr, window=window, verbose=False,
+                                       progress=self._progress(progress))
+
+def _encode_one(cmd, subcmd, offset=0, pad1=0, length=0, data=None):
+    # each request gets its own copy of the packet, since it sits in the I/O
+    # thread's queue for a bit and so can't share one buffer
+    return bytes(PacketBuffer().encode(cmd, subcmd, offset, pad1, length, data))
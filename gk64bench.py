@@ -0,0 +1,364 @@
+#!/usr/bin/python3
+# gk64bench.py - micro-benchmarks for the hot paths in gk64.py
+#
+# Every benchmark checks that the fast path gives the same answer as the
+# slow one before it bothers timing anything; a fast wrong answer is no use.
+#
+# Usage: ./gk64bench.py [crc16|packets|hexdump|imagestore|keymap|light|upload|dump|modeswitch|async|trace|capture|diff ...]
+
+import io
+import time
+import argparse
+import timeit
+import contextlib
+
+import gk64
+import gk64sim
+
+BINFILE = "bin/BBD8.bin"
+
+def _best(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+def _report(name, old, new):
+    print("{:<28} {:>10.1f}us {:>10.1f}us {:>8.1f}x".format(
+          name, old*1e6, new*1e6, old/new))
+
+def bench_crc16():
+    print("{:<28} {:>12} {:>12} {:>9}".format("crc16", "old", "new", "speedup"))
+    image = open(BINFILE, 'rb').read()
+    packets = image[:len(image) & ~0x3f]
+    cases = [
+        ("mycrc16 (64 bytes)", image[:0x40], 0x1021, 0xffff, 0x0000),
+        ("mycrc16 (image)", image, 0x1021, 0xffff, 0x0000),
+        ("crc16_usb (64 bytes)", image[:0x40], 0x8005, 0xffff, 0xffff),
+        ("crc16_usb (image)", image, 0x8005, 0xffff, 0xffff),
+    ]
+    for name, data, poly, iv, xorf in cases:
+        ref = gk64.crc16_bitwise(data, poly, iv, xorf)
+        got = gk64.crc16(data, poly, iv, xorf)
+        assert got == ref, "{}: {:04x} != {:04x}".format(name, got, ref)
+        number = 1 if len(data) > 0x40 else 200
+        _report(name,
+                _best(lambda: gk64.crc16_bitwise(data, poly, iv, xorf), number),
+                _best(lambda: gk64.crc16(data, poly, iv, xorf), number*10))
+
+    # incremental update() has to match the one-shot value
+    c = gk64.CRC16(iv=0xffff)
+    for o in range(0, len(image), 0x1000):
+        c.update(image[o:o+0x1000])
+    assert c.value() == gk64.mycrc16(image)
+
+    # bulk packet path vs. one crc per packet
+    c = gk64.CRC16(iv=0xffff)
+    ref = [gk64.crc16_bitwise(packets[o:o+0x40], 0x1021, 0xffff)
+           for o in range(0, len(packets), 0x40)]
+    assert c.packets(packets) == ref
+    _report("{} packets".format(len(ref)),
+            _best(lambda: [gk64.crc16_bitwise(packets[o:o+0x40], 0x1021, 0xffff)
+                           for o in range(0, len(packets), 0x40)], 1),
+            _best(lambda: c.packets(packets), 10))
+
+def bench_packets():
+    print("{:<28} {:>12} {:>12} {:>9}".format("packets", "old", "new", "speedup"))
+    image = open(BINFILE, 'rb').read()
+    data = image[:0x38]
+
+    def old_encode():
+        return gk64.CommandPacket(2,2, 0x38, 0, len(data), 0, data)._replace_checksum()._pack()
+    pb = gk64.PacketBuffer()
+    def new_encode():
+        return pb.encode(2,2, 0x38, 0, len(data), data)
+    assert bytes(new_encode()) == old_encode()
+    _report("encode one packet", _best(old_encode, 2000), _best(new_encode, 2000))
+
+    reply = old_encode()
+    pb.load(reply)
+    assert pb.reply() == gk64.ReplyPacket._unpack(reply)
+    _report("decode + check one reply",
+            _best(lambda: gk64.ReplyPacket._unpack(reply)._checksum_ok(), 2000),
+            _best(lambda: (pb.load(reply), pb.checksum_ok()), 2000))
+
+    def old_stream():
+        return b''.join(gk64.CommandPacket(2,2, o, 0, len(image[o:o+0x38]), 0,
+                                           image[o:o+0x38])._replace_checksum()._pack()
+                        for o in range(0, len(image), 0x38))
+    assert bytes(gk64.encode_packet_stream(image)) == old_stream()
+    _report("encode firmware image", _best(old_stream, 3),
+            _best(lambda: gk64.encode_packet_stream(image), 10))
+
+def _hexdump_line_slow(data):
+    # what hexdump_line() used to be, one byte at a time
+    linedata = bytearray(data[:16])
+    hexbytes = ["%02x" % b for b in linedata] + (["  "] * (16-len(linedata)))
+    printable = ''.join(chr(b) if b >= 0x20 and b < 0x7f else '.' for b in linedata)
+    return '{}  {}   {} {}'.format(' '.join(hexbytes[:8]), ' '.join(hexbytes[8:]),
+                                   printable[:8], printable[8:])
+
+def bench_hexdump():
+    print("{:<28} {:>12} {:>12} {:>9}".format("hexdump", "old", "new", "speedup"))
+    for name in ("dump/BBD8-dump.flash", "dump/BBD8-bootrom.flash"):
+        data = open(name, 'rb').read()
+        def old():
+            return ["{:08x}  {}".format(o, _hexdump_line_slow(data[o:o+0x10]))
+                    for o in range(0, len(data), 0x10)]
+        def new():
+            return list(gk64.hexdump_iterlines(data))
+        assert new() == old()
+        _report("{} ({}k)".format(name.split('/')[-1], len(data) // 1024),
+                _best(old, 1), _best(new, 5))
+        out = io.StringIO()
+        _report("  file, collapsed",
+                _best(old, 1), _best(lambda: gk64.hexdump_file(name, collapse=True, out=out), 5))
+
+def bench_imagestore():
+    import tempfile
+    print("{:<28} {:>12} {:>12} {:>9}".format("image store", "old", "new", "speedup"))
+    def old():
+        bindata = gk64.binfile_read(BINFILE)
+        hdr = gk64.make_bimg_header(bindata)
+        return bindata, hdr, gk64.encode_packet_stream(bindata[:hdr.size], 2, 2)
+    store = gk64.ImageStore(tempfile.mkdtemp())
+    def new():
+        with store.get(BINFILE) as image:
+            return image.crc
+    with store.get(BINFILE) as image:
+        bindata, hdr, stream = old()
+        assert bytes(image.bindata) == bindata
+        assert image.header(hdr.ts)._pack() == hdr._pack()
+        assert bytes(image.stream) == stream.tobytes()
+    _report("read + header + encode", _best(old, 20), _best(new, 200))
+
+def bench_keymap():
+    import gk64keymap
+    print("{:<28} {:>12} {:>12} {:>9}".format("keymap", "uncached", "cached", "speedup"))
+    # a big made-up keymap: 32 layers of 128 keys, using all sorts of keycodes
+    names = sorted(gk64keymap.QMKKeycodes)
+    names += ["LCTL(KC_C)", "C(S(KC_T))", "MO(1)", "TG(2)", "RALT(KC_E)"]
+    keymap = dict(keymap="bench", layers=[[names[(l*7 + k) % len(names)]
+                                           for k in range(128)] for l in range(32)])
+
+    def uncached():
+        return gk64keymap.KeymapCompiler().compile(keymap)
+    compiler = gk64keymap.KeymapCompiler()
+    ref = compiler.compile(keymap)
+    assert uncached() == ref and compiler.misses == 32
+    _report("32x128 keymap, unchanged", _best(uncached, 10),
+            _best(lambda: compiler.compile(keymap), 100))
+
+    # touch one layer each time, so exactly one gets recompiled
+    edits = iter(range(10**9))
+    def one_changed():
+        keymap['layers'][5][0] = names[next(edits) % len(names)]
+        return compiler.compile(keymap)
+    misses = compiler.misses
+    one_changed()
+    assert compiler.misses == misses + 1
+    _report("32x128 keymap, 1 layer edited", _best(uncached, 10), _best(one_changed, 100))
+
+def bench_light():
+    import gk64light
+    print("{:<28} {:>12} {:>12} {:>9}".format("light", "uncached", "cached", "speedup"))
+    # a 104-key, 5 second rainbow-ish sweep at 60fps, plus a few static keys
+    obj = dict(keys=104, fps=60, length=5000, default="#000000",
+               tracks={"{}-{}".format(k, k+7): [[k*20, "#ff0000"], [k*20+1500, "#00ff00"],
+                                                [k*20+3000, "#0000ff"]]
+                       for k in range(0, 96, 8)})
+    obj['tracks']["100-103"] = [[0, "#ffffff"]]
+    encoder = gk64light.LightEncoder()
+    data = encoder.compile(gk64light.Animation.from_json(obj))
+    print("  {} frames -> {} full + {} delta, {} bytes ({} raw)".format(
+          encoder.steps, encoder.full, encoder.deltas, len(data), encoder.rawsize))
+
+    def uncached():
+        return gk64light.LightUploader(None).prepare(obj)
+    uploader = gk64light.LightUploader(None)
+    assert uploader.prepare(obj)[0] == data
+    _report("compile + encode stream", _best(uncached, 3),
+            _best(lambda: uploader.prepare(obj), 100))
+
+def _sim_kbd(mode=gk64sim.SimKeyboard.KeyboardMode, **kwargs):
+    '''Returns a GK64 talking to a fresh SimKeyboard that's already in mode'''
+    kwargs.setdefault('reenumerate', 0.0)
+    kwargs.setdefault('seed', 1)
+    sim = gk64sim.SimKeyboard(**kwargs)
+    sim.reset(mode)
+    sim.gone_until = 0.0
+    return gk64.GK64(transport=gk64sim.SimTransport([sim])), sim
+
+def _throughput_header(name):
+    print("{:<28} {:>11} {:>11} {:>9}".format(name, "time", "rate", "speedup"))
+
+def _timed(fn, *args, **kwargs):
+    '''Run fn quietly; returns (elapsed seconds, result)'''
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn(*args, **kwargs)
+    return time.monotonic() - start, result
+
+# a vaguely full-speed-USB-ish latency model: 125us per transfer plus a
+# little jitter, and 0.5ms of device time per packet
+SimLatency = dict(latency=0.000125, jitter=0.00005, turnaround=0.0005)
+
+def bench_upload():
+    image = gk64.binfile_read(BINFILE)
+    faults = [("", dict()),
+              (", 1% bad CRC", dict(corrupt_rate=0.01)),
+              (", 0.2% drop", dict(drop_rate=0.002))]
+    _throughput_header("upload (simulated)")
+    for label, fault in faults:
+        base = None
+        for window in (1, 4, 8, 16):
+            kbd, sim = _sim_kbd(gk64sim.SimKeyboard.CDBootMode,
+                                **dict(SimLatency, **fault))
+            elapsed, _ = _timed(kbd.cdboot_send_firmware, image, window=window,
+                                retries=10, replytimeout=50)
+            assert sim.image_ok(image)
+            base = base or elapsed
+            print("{:<28} {:>10.3f}s  {:>8.0f} B/s {:>8.1f}x".format(
+                  "fwup window={}{}".format(window, label), elapsed,
+                  len(image)/elapsed, base/elapsed))
+
+def bench_dump():
+    start, end = 0x0000, 0x10000
+    base = None
+    _throughput_header("dump (simulated)")
+    for window, label, fault in ((1, "", {}), (4, "", {}), (8, "", {}), (16, "", {}),
+                                 (8, ", 0.2% drop", dict(drop_rate=0.002))):
+        kbd, sim = _sim_kbd(**dict(SimLatency, **fault))
+        dumper = gk64.MemoryDumper(kbd, start, end, "/tmp/gk64bench.dump",
+                                   window=window, replytimeout=50)
+        elapsed, _ = _timed(dumper.run, resume=False)
+        assert open("/tmp/gk64bench.dump", 'rb').read() == sim.peek(start, end-start)
+        base = base or elapsed
+        print("{:<28} {:>10.3f}s  {:>8.0f} B/s {:>8.1f}x".format(
+              "dump window={}{}".format(window, label), elapsed,
+              (end-start)/elapsed, base/elapsed))
+
+def bench_modeswitch():
+    _throughput_header("mode switch (simulated)")
+    for reenumerate in (0.1, 0.25, 0.5):
+        kbd, sim = _sim_kbd(reenumerate=reenumerate)
+        start = time.monotonic()
+        assert kbd.enter_cdboot_mode() and sim.mode == sim.CDBootMode
+        assert kbd.enter_keyboard_mode() and sim.mode == sim.KeyboardMode
+        elapsed = (time.monotonic() - start) / 2
+        # the old code slept for 1s flat, then looked for the device
+        print("{:<28} {:>10.3f}s {:>11} {:>8.1f}x".format(
+              "re-enumerate in {:.2f}s".format(reenumerate), elapsed, "", 1.0/elapsed))
+
+def bench_trace():
+    import gk64trace
+    print("{:<28} {:>12} {:>12} {:>9}".format("trace (cmd 1,1, sim)", "untraced", "traced",
+                                              "overhead"))
+    kbd, sim = _sim_kbd()
+    untraced = _best(lambda: kbd.send_cmd(1,1), 2000)
+    for label, tracer in (("stats only", gk64trace.Tracer(max_events=0)),
+                          ("stats + events", gk64trace.Tracer())):
+        kbd, sim = _sim_kbd()
+        tracer.attach(kbd)
+        traced = _best(lambda: kbd.send_cmd(1,1), 2000)
+        assert tracer.stats()['latency']['cmd 01:01']['count'] == 3 * 2000
+        print("{:<28} {:>10.1f}us {:>10.1f}us {:>8.1f}us".format(
+              label, untraced*1e6, traced*1e6, (traced - untraced)*1e6))
+
+def bench_capture():
+    import gk64capture
+    print("{:<28} {:>12} {:>12} {:>9}".format("capture decode", "old", "new", "speedup"))
+    stream = gk64.encode_packet_stream(gk64.binfile_read(BINFILE))
+    size = gk64.PacketStruct.size
+    transfers = [gk64capture.UsbTransfer(n, n, 1, 5, 0x02, stream[pos:pos+size], size)
+                 for n, pos in enumerate(range(0, len(stream), size))]
+    def one_at_a_time():
+        return [(p.cmd, p.offset, p._checksum_ok())
+                for p in (gk64.CommandPacket._unpack(t.data) for t in transfers)]
+    def batched():
+        return [(p.fields[0], p.fields[2], p.crc_ok)
+                for p in gk64capture.capture_packets(transfers)]
+    assert one_at_a_time() == batched()
+    assert all(ok for _, _, ok in batched())
+    _report("{} packets".format(len(transfers)),
+            _best(one_at_a_time, 3), _best(batched, 3))
+
+def bench_diff():
+    import tempfile
+    import gk64diff
+    print("{:<28} {:>12} {:>12} {:>9}".format("diff", "uncached", "cached", "speedup"))
+    image = gk64diff.Image.open(BINFILE)
+    flash = gk64diff.Image.open("dump/BBD8-dump.flash")
+    bootrom = gk64diff.Image.open("dump/BBD8-bootrom.flash")
+    assert image.base == gk64.fw_base_addr
+    assert flash.base == 0
+    assert bootrom.base == gk64.memory_region('bootrom')[1]
+    # the image should be in the flash dump, at the same addresses
+    nbytes, _ = gk64diff.ImageDiff(flash, image, cachedir=False).totals()
+    assert nbytes['same'] > nbytes['changed']
+    cachedir = tempfile.mkdtemp()
+    gk64diff.BlockHashes(flash, cachedir=cachedir)
+    _report("flash dump vs image",
+            _best(lambda: gk64diff.ImageDiff(flash, image, cachedir=False), 3),
+            _best(lambda: gk64diff.ImageDiff(flash, image, cachedir=cachedir), 3))
+
+def bench_async():
+    import asyncio
+    import gk64async
+    _throughput_header("async, 4 keyboards (sim)")
+    image = gk64.binfile_read(BINFILE)
+    def transport():
+        return gk64sim.SimTransport([gk64sim.SimKeyboard(address=n+1, reenumerate=0.1,
+                                                         seed=n, **SimLatency)
+                                     for n in range(4)])
+    t = transport()
+    def one_at_a_time():
+        for n in range(4):
+            gk64.GK64(1, n+1, transport=t).update_firmware(image, window=8, verbose=False)
+    base, _ = _timed(one_at_a_time)
+    assert all(k.image_ok(image) for k in t.keyboards)
+    print("{:<28} {:>10.3f}s  {:>8.0f} B/s {:>8.1f}x".format(
+          "sequential GK64", base, 4*len(image)/base, 1.0))
+
+    t = transport()
+    async def all_at_once():
+        kbds = [await gk64async.AsyncGK64.open(1, n+1, transport=t) for n in range(4)]
+        await asyncio.gather(*(k.update_firmware(image, window=8) for k in kbds))
+    elapsed, _ = _timed(asyncio.run, all_at_once())
+    assert all(k.image_ok(image) for k in t.keyboards)
+    print("{:<28} {:>10.3f}s  {:>8.0f} B/s {:>8.1f}x".format(
+          "AsyncGK64", elapsed, 4*len(image)/elapsed, base/elapsed))
+
+BENCHMARKS = {
+    'crc16': bench_crc16,
+    'packets': bench_packets,
+    'hexdump': bench_hexdump,
+    'imagestore': bench_imagestore,
+    'keymap': bench_keymap,
+    'light': bench_light,
+    'upload': bench_upload,
+    'dump': bench_dump,
+    'modeswitch': bench_modeswitch,
+    'async': bench_async,
+    'capture': bench_capture,
+    'diff': bench_diff,
+    'trace': bench_trace,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK64 micro-benchmarks')
+    parser.add_argument("names", nargs='*', metavar="benchmark",
+                        help="benchmarks to run (default: all of them): "
+                             "{}".format(", ".join(BENCHMARKS)))
+    args = parser.parse_args()
+    # not choices=: argparse won't take an empty nargs='*' list with those
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark {} (choose from {})".format(
+                     ", ".join(unknown), ", ".join(sorted(BENCHMARKS))))
+    return args
+
+def main(args):
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
+
+if __name__ == '__main__':
+    main(parse_args())
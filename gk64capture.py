@@ -0,0 +1,585 @@
+#!/usr/bin/python3
+# gk64capture.py - pick GK6x packets out of USB captures
+#
+# fw_finalize_values and the notes about the final packet's checksum came
+# from staring at packet dumps of the vendor updater by hand. This does the
+# staring: it reads usbmon text captures (cat /sys/kernel/debug/usb/usbmon/1u)
+# and pcap/pcapng files (Wireshark on Linux, or USBPcap on Windows, where the
+# vendor tools live) one record at a time, so a capture of any size fits in
+# constant memory, and pulls out the 64-byte packets on the GK6x endpoints.
+#
+#   ./gk64capture.py stats vendor-fwup.pcapng     # per-command timing
+#   ./gk64capture.py packets vendor-fwup.pcapng   # decoded packet log
+#   ./gk64capture.py finalize *.pcapng            # the 2,3 packets, vs fw_finalize_values
+#   ./gk64capture.py replay vendor-fwup.pcapng    # send it again, and time it
+#
+# Packets get decoded in batches with PacketStruct.iter_unpack and their
+# checksums checked with CRC16.packets(). Commands get paired up with
+# replies the same way gk64trace does it (by cmd/subcmd, oldest first),
+# because the stats *are* a gk64trace.Tracer's: --stats/--trace write the
+# same stats.json and Chrome trace as `gk64.py --stats/--trace` does, so
+# the vendor tool and us can be compared number for number.
+#
+# usbmon's text interface only keeps the first 32 bytes of a transfer, so
+# packets from text captures get their headers decoded but no checksum
+# check (they count as "truncated"), and they can't be replayed. Use a
+# pcap if you can.
+
+import io
+import sys
+import json
+import time
+import array
+import struct
+import argparse
+from collections import namedtuple, OrderedDict
+
+import gk64
+import gk64trace
+
+# keyboard mode sends on 0x04 and answers on 0x83; CDBOOT mode is 0x02/0x81
+GK64Endpoints = {0x04: 'out', 0x83: 'in', 0x02: 'out', 0x81: 'in'}
+
+XferIso, XferInterrupt, XferControl, XferBulk = 0, 1, 2, 3
+
+# One finished transfer: submit and complete times (seconds), bus and device
+# address, endpoint address (0x80 set for IN), the data, and its length (the
+# data can be shorter, if the capture truncated it)
+UsbTransfer = namedtuple("UsbTransfer", "start end bus dev ep data length")
+
+# --- capture readers ---
+#
+# These all yield events: (ts, 'S' or 'C', urb id, bus, dev, ep, xfer type,
+# length, data). usb_transfers() turns those into UsbTransfers.
+
+_usbmon_xfer = {'Z': XferIso, 'I': XferInterrupt, 'C': XferControl, 'B': XferBulk}
+
+def read_usbmon_text(f):
+    '''Events from usbmon's text format (the 1u flavour, or the older 1t)'''
+    wrap = 0
+    last = None
+    for line in f:
+        words = line.split()
+        if len(words) < 6 or words[2] not in ('S', 'C'):
+            continue
+        addr = words[3].split(':')
+        kind = addr[0]
+        if len(kind) != 2 or kind[0] not in _usbmon_xfer or len(addr) not in (3, 4):
+            continue
+        xfer = _usbmon_xfer[kind[0]]
+        if xfer in (XferIso, XferControl):
+            continue    # different fields, and not ours anyway
+        bus = int(addr[1]) if len(addr) == 4 else 0
+        dev, ep = int(addr[-2]), int(addr[-1])
+        if kind[1] == 'i':
+            ep |= 0x80
+        # the timestamp is a 32-bit count of microseconds, so it wraps
+        # around every 71 minutes or so
+        ts = int(words[1])
+        if last is not None and ts < last:
+            wrap += 1 << 32
+        last = ts
+        try:
+            length = int(words[5])
+            data = bytes.fromhex(''.join(words[7:])) if words[6:7] == ['='] else b''
+        except ValueError:
+            continue
+        yield ((ts + wrap) / 1e6, words[2], words[0], bus, dev, ep, xfer, length, data)
+
+LinktypeUsbLinux = 189
+LinktypeUsbLinuxMmapped = 220
+LinktypeUsbPcap = 249
+
+# the pseudo-header Linux puts in front of each packet (64 bytes for the
+# mmapped flavour, but the extra 16 are iso stuff we don't need)
+UsbmonHeaderStruct = struct.Struct("<QBBBBHBBqiiII8s")
+# and USBPcap's; header_len says where the data starts
+UsbPcapHeaderStruct = struct.Struct("<HQIHBHHBBI")
+
+def _usb_event(linktype, ts, buf):
+    '''The event in one captured packet, or None if it's not a USB one'''
+    if linktype in (LinktypeUsbLinux, LinktypeUsbLinuxMmapped):
+        if len(buf) < UsbmonHeaderStruct.size:
+            return None
+        (urb, event, xfer, ep, dev, bus, _, _, _, _, _,
+         length, caplen, _) = UsbmonHeaderStruct.unpack_from(buf)
+        start = 64 if linktype == LinktypeUsbLinuxMmapped else 48
+        return (ts, chr(event), urb, bus, dev, ep, xfer, length, bytes(buf[start:start+caplen]))
+    if linktype == LinktypeUsbPcap:
+        if len(buf) < UsbPcapHeaderStruct.size:
+            return None
+        (hdrlen, irp, _, _, info, bus, dev, ep,
+         xfer, length) = UsbPcapHeaderStruct.unpack_from(buf)
+        # info bit 0 set means it's on its way back up, i.e. completed
+        return (ts, 'C' if info & 1 else 'S', irp, bus, dev, ep, xfer, length,
+                bytes(buf[hdrlen:hdrlen+length]))
+    return None
+
+def read_pcap(f):
+    '''Events from a classic libpcap file'''
+    head = f.read(24)
+    magic, = struct.unpack('<I', head[:4])
+    endian = '<' if magic in (0xa1b2c3d4, 0xa1b23c4d) else '>'
+    scale = 1e-9 if magic in (0xa1b23c4d, 0x4d3cb2a1) else 1e-6
+    linktype = struct.unpack(endian + 'I', head[20:24])[0] & 0xffff
+    record = struct.Struct(endian + 'IIII')
+    while True:
+        h = f.read(record.size)
+        if len(h) < record.size:
+            break
+        sec, frac, caplen, _ = record.unpack(h)
+        buf = f.read(caplen)
+        if len(buf) < caplen:
+            break
+        event = _usb_event(linktype, sec + frac * scale, buf)
+        if event is not None:
+            yield event
+
+def _pcapng_tsresol(options, endian):
+    '''Timestamp units per second, from an interface block's options'''
+    pos = 0
+    while pos + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, pos)
+        if code == 0:
+            break
+        if code == 9 and length:
+            v = options[pos + 4]
+            return 2 ** (v & 0x7f) if v & 0x80 else 10 ** v
+        pos += 4 + ((length + 3) & ~3)
+    return 10 ** 6
+
+def read_pcapng(f):
+    '''Events from a pcapng file (Wireshark's default)'''
+    endian = '<'
+    interfaces = []     # (linktype, timestamp units per second)
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        if head[:4] == b'\x0a\x0d\x0d\x0a':
+            # section header: the byte order magic says how to read the rest
+            bom = f.read(4)
+            endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            blocklen, = struct.unpack(endian + 'I', head[4:])
+            f.read(blocklen - 12)
+            interfaces = []
+            continue
+        blocktype, blocklen = struct.unpack(endian + 'II', head)
+        body = f.read(blocklen - 8)
+        if len(body) < blocklen - 8:
+            break
+        if blocktype == 1:      # interface description
+            linktype, = struct.unpack_from(endian + 'H', body)
+            interfaces.append((linktype, _pcapng_tsresol(body[8:-4], endian)))
+        elif blocktype == 6:    # enhanced packet
+            iface, hi, lo, caplen, _ = struct.unpack_from(endian + 'IIIII', body)
+            if iface < len(interfaces):
+                linktype, units = interfaces[iface]
+                event = _usb_event(linktype, ((hi << 32) | lo) / units, body[20:20+caplen])
+                if event is not None:
+                    yield event
+
+def read_capture(filename):
+    '''Events from a capture file, whichever kind it is'''
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic == b'\x0a\x0d\x0d\x0a':
+            reader = read_pcapng(f)
+        elif magic in (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4',
+                       b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+            reader = read_pcap(f)
+        else:
+            reader = read_usbmon_text(io.TextIOWrapper(f, 'ascii', 'replace'))
+        for event in reader:
+            yield event
+
+def usb_transfers(events, max_pending=4096):
+    '''Match up submits and completions into UsbTransfers (interrupt and
+    bulk only). OUT data comes from the submit, IN data from the completion.'''
+    pending = OrderedDict()
+    for ts, event, urb, bus, dev, ep, xfer, length, data in events:
+        if xfer not in (XferInterrupt, XferBulk):
+            continue
+        # urb ids get reused, but not while they're still in flight
+        key = (urb, bus, dev, ep)
+        if event == 'S':
+            pending[key] = (ts, length, data)
+            if len(pending) > max_pending:
+                pending.popitem(last=False)
+            continue
+        submitted = pending.pop(key, None)
+        start = submitted[0] if submitted is not None else ts
+        if ep & 0x80:
+            yield UsbTransfer(start, ts, bus, dev, ep, data, length)
+        elif submitted is not None:
+            yield UsbTransfer(start, ts, bus, dev, ep, submitted[2], submitted[1])
+
+# --- decoding ---
+
+# A GK6x packet seen in a capture. fields is the PacketStruct tuple (so
+# cmd, subcmd, offset/result, pad1, length/pad2, checksum, data); crc_ok is
+# None if the capture didn't keep the whole packet.
+CapturedPacketTuple = namedtuple("CapturedPacketTuple", "start end board out fields crc_ok raw")
+class CapturedPacket(CapturedPacketTuple):
+    def packet(self):
+        '''As a gk64.CommandPacket or ReplyPacket'''
+        return (gk64.CommandPacket if self.out else gk64.ReplyPacket)._make(self.fields)
+
+def board_name(bus, dev):
+    return "{:03d}:{:03d}".format(bus, dev)
+
+def capture_packets(transfers, device=None, batchsize=1024):
+    '''The GK6x packets in some UsbTransfers, decoded a batch at a time.
+
+    device, if given, is a (bus, dev) to stick to; otherwise every 64-byte
+    transfer on the GK6x endpoints counts.
+    '''
+    size = gk64.PacketStruct.size
+    crc = gk64.CRC16(poly=0x1021, iv=0xffff)
+    zeros = array.array('H', bytes(2 * batchsize))
+    boards = dict()
+    batch = []
+    buf = bytearray()
+
+    def flush():
+        # checksums are over the packet with the checksum field zeroed
+        zeroed = bytearray(buf)
+        memoryview(zeroed).cast('H')[gk64.PacketChecksumOffset // 2::size // 2] = zeros[:len(batch)]
+        crcs = crc.packets(zeroed, size)
+        for (xfer, truncated), fields, value in zip(batch, gk64.PacketStruct.iter_unpack(buf), crcs):
+            board = boards.get((xfer.bus, xfer.dev))
+            if board is None:
+                board = boards[xfer.bus, xfer.dev] = board_name(xfer.bus, xfer.dev)
+            yield CapturedPacket(xfer.start, xfer.end, board, not xfer.ep & 0x80, fields,
+                                 None if truncated else value == fields[5], xfer.data)
+        del batch[:]
+        del buf[:]
+
+    for xfer in transfers:
+        if (xfer.length != size or xfer.ep not in GK64Endpoints or len(xfer.data) < 8 or
+                (device is not None and (xfer.bus, xfer.dev) != device)):
+            continue
+        truncated = len(xfer.data) < size
+        batch.append((xfer, truncated))
+        buf += xfer.data
+        if truncated:
+            buf += bytes(size - len(xfer.data))
+        if len(batch) == batchsize:
+            for pkt in flush():
+                yield pkt
+    if batch:
+        for pkt in flush():
+            yield pkt
+
+def known_finalize(ts, cs):
+    '''Which fw_finalize_values entry (ts, cs) is, if any'''
+    for fwid, pairs in gk64.fw_finalize_values.items():
+        if (ts, cs) in pairs:
+            return fwid
+    return None
+
+class CaptureAnalyzer(object):
+    '''Feeds CapturedPackets to a gk64trace.Tracer as if we'd been tracing
+    whoever made the capture, and keeps the 2,3 (finalize) packets.
+
+    Boards are named bus:dev, so a keyboard shows up as two boards if it
+    switches modes in the capture (the address changes on re-enumeration).
+    '''
+    def __init__(self, tracer=None):
+        self.tracer = tracer if tracer is not None else gk64trace.Tracer(max_events=0)
+        self.first = None
+        self.last = None
+        self.finalize = []  # (board, time, ts, cs)
+        self.fwup = dict()  # board -> [start, end, offsets seen, bytes]
+
+    def feed(self, pkt):
+        tracer = self.tracer
+        if self.first is None:
+            # capture timestamps are wall clock time
+            self.first = tracer.started = tracer.started_wall = pkt.start
+        self.last = pkt.end
+        board = tracer.board(pkt.board)
+        cmd, subcmd = pkt.fields[0], pkt.fields[1]
+        if pkt.crc_ok is None:
+            board.count('truncated')
+        elif not pkt.crc_ok:
+            board.count('bad crc (out)' if pkt.out else 'bad crc (in)')
+        if not pkt.out:
+            # an IN transfer's submit time is just when the host started
+            # waiting, so there's no 'usb read' time to speak of; the reply
+            # is there when it completes
+            tracer._received(board, cmd, subcmd, None, pkt.end)
+            up = self.fwup.get(pkt.board)
+            if up is not None and (cmd, subcmd) == (2, 2):
+                up[1] = pkt.end
+            return
+        tracer._sent(board, cmd, subcmd, pkt.start, pkt.end)
+        if (cmd, subcmd) == (2, 2):
+            up = self.fwup.setdefault(pkt.board, [pkt.start, pkt.end, set(), 0])
+            offset = pkt.fields[2] | pkt.fields[3] << 16
+            if offset not in up[2]:
+                up[2].add(offset)
+                up[3] += pkt.fields[4]
+        elif (cmd, subcmd) == (2, 3):
+            self._end_fwup(pkt.board)
+            if pkt.crc_ok is not False:
+                ts, cs = struct.unpack_from('<IxxH', pkt.fields[6])
+                self.finalize.append((pkt.board, pkt.start, ts, cs))
+
+    def _end_fwup(self, name):
+        up = self.fwup.pop(name, None)
+        if up is not None:
+            self.tracer.add_span(name, 'fwup send', up[0], up[1], nbytes=up[3])
+
+    def run(self, packets):
+        for pkt in packets:
+            self.feed(pkt)
+        for name in list(self.fwup):
+            self._end_fwup(name)
+        return self
+
+    def stats(self):
+        '''Tracer.stats(), with capture times, unanswered requests and the
+        finalize packets'''
+        tracer = self.tracer
+        with tracer.lock:
+            for board in tracer.boards.values():
+                unanswered = sum(len(w) for w in board.outstanding.values())
+                if unanswered:
+                    board.count('unanswered', unanswered)
+                board.outstanding.clear()
+        stats = tracer.stats()
+        stats['elapsed'] = round(self.last - self.first, 6) if self.first is not None else 0
+        stats['finalize'] = [dict(board=board, time=round(t - self.first, 6), ts=ts, cs=cs,
+                                  known=known_finalize(ts, cs))
+                             for board, t, ts, cs in self.finalize]
+        return stats
+
+def analyze(filename, device=None, tracer=None):
+    '''Run a whole capture through a CaptureAnalyzer'''
+    return CaptureAnalyzer(tracer).run(
+        capture_packets(usb_transfers(read_capture(filename)), device))
+
+# --- replay ---
+
+class Replayer(object):
+    '''Sends the OUT packets from a capture to a GK64, and reads a reply
+    wherever the capture got one, so the device sees the same send/wait
+    pattern the capturing tool used (minus its think time).
+
+    Mode switches (cmd 3) go through enter_keyboard_mode/enter_cdboot_mode
+    so we follow the keyboard across re-enumeration. cmds, if given, limits
+    it to those command numbers. Attach a gk64trace.Tracer to kbd to get
+    the timing.
+    '''
+    def __init__(self, kbd, cmds=None, replytimeout=1000, verbose=False):
+        self.kbd = kbd
+        self.cmds = set(cmds) if cmds else None
+        self.replytimeout = replytimeout
+        self.verbose = verbose
+        self.sent = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.elapsed = 0.0
+
+    def run(self, packets):
+        kbd = self.kbd
+        start = time.monotonic()
+        fwup = None     # [start, last 2,2 reply, bytes, offsets], like CaptureAnalyzer's
+        for pkt in packets:
+            cmd, subcmd = pkt.fields[0], pkt.fields[1]
+            if self.cmds is not None and cmd not in self.cmds:
+                continue
+            if cmd == 3:
+                # send_cmd already read the reply to the mode switch
+                if pkt.out and subcmd in (1, 2):
+                    ok = kbd.enter_keyboard_mode() if subcmd == 1 else kbd.enter_cdboot_mode()
+                    if not ok:
+                        raise gk64.USBError("device didn't come back after mode switch", errno=19)
+                    self.sent += 1
+                continue
+            if pkt.crc_ok is None:
+                raise ValueError("capture only has the first {} bytes of packets; "
+                                 "can't replay it".format(len(pkt.raw)))
+            if pkt.out:
+                if (cmd, subcmd) == (2, 2):
+                    if fwup is None:
+                        fwup = [time.monotonic(), None, 0, set()]
+                    offset = pkt.fields[2] | pkt.fields[3] << 16
+                    if offset not in fwup[3]:
+                        fwup[3].add(offset)
+                        fwup[2] += pkt.fields[4]
+                elif (cmd, subcmd) == (2, 3):
+                    self._fwup_span(fwup)
+                    fwup = None
+                kbd.send_packet(pkt.raw, self.verbose)
+                self.sent += 1
+                continue
+            try:
+                r = kbd.read_reply(verbose=self.verbose, replytimeout=self.replytimeout)
+                self.replies += 1
+                if fwup is not None and (r.cmd, r.subcmd) == (2, 2):
+                    fwup[1] = time.monotonic()
+            except gk64.USBError as e:
+                if e.errno != 110:
+                    raise
+                self.timeouts += 1
+        self._fwup_span(fwup)
+        self.elapsed = time.monotonic() - start
+        return self
+
+    def _fwup_span(self, fwup):
+        if fwup is not None and fwup[1] is not None and self.kbd.trace is not None:
+            self.kbd.trace.add_span(self.kbd, 'fwup send', fwup[0], fwup[1], nbytes=fwup[2])
+
+def print_comparison(captured, replayed, out=None):
+    '''The round trip latencies from a capture and its replay side by side'''
+    out = out if out is not None else sys.stdout
+    print("{:<20} {:>23}   {:>23}".format("", "capture", "replay"), file=out)
+    print("{:<20} {:>7} {:>7} {:>7}   {:>7} {:>7} {:>7}".format(
+          "round trip (us)", "count", "p50", "p99", "count", "p50", "p99"), file=out)
+    a, b = captured.get('latency', {}), replayed.get('latency', {})
+    for name in sorted(set(a) | set(b)):
+        if not name.startswith('cmd '):
+            continue
+        cols = []
+        for h in (a.get(name), b.get(name)):
+            if h and h['count']:
+                cols.append("{:>7} {:>7.0f} {:>7.0f}".format(h['count'], h['p50_us'], h['p99_us']))
+            else:
+                cols.append("{:>23}".format("-"))
+        print("{:<20} {}   {}".format(name, *cols), file=out)
+    for name in sorted(set(captured.get('spans', {})) & set(replayed.get('spans', {}))):
+        rates = [s['spans'][name].get('bytes_per_sec') for s in (captured, replayed)]
+        if all(rates):
+            print("{:<20} {:>15.0f} B/s   {:>15.0f} B/s".format(name, *rates), file=out)
+    print("{:<20} {:>21.3f}s   {:>21.3f}s".format("elapsed", captured['elapsed'],
+                                                   replayed['elapsed']), file=out)
+
+# --- CLI ---
+
+def print_packet(pkt, t0, out=None):
+    out = out if out is not None else sys.stdout
+    cmd, subcmd, offset, pad1, length, _, data = pkt.fields
+    if pkt.out:
+        what = "off {:#06x} len {:#04x}".format(offset | pad1 << 16, length)
+        payload = data[:16]
+    else:
+        what = "result {:<12}".format(offset)
+        payload = data[:16]
+    crc = {None: "trunc", True: "", False: "BADCRC"}[pkt.crc_ok]
+    # a packet's time is when it was sent: submitted for OUT, completed for IN
+    when = pkt.start if pkt.out else pkt.end
+    print("{:12.6f} {} {} {:02x}:{:02x} {:<21} {:<6} {}".format(
+          when - t0, pkt.board, "->" if pkt.out else "<-", cmd, subcmd, what, crc,
+          payload.hex()), file=out)
+
+def print_finalize(stats, filename=None, out=None):
+    out = out if out is not None else sys.stdout
+    for f in stats.get('finalize', ()):
+        print("{}{:10.6f} {} 2,3 ts {:#010x} cs {:#06x}  {}".format(
+              filename + ": " if filename else "", f['time'], f['board'], f['ts'], f['cs'],
+              "(in fw_finalize_values for {})".format(f['known']) if f['known'] else "(new)"),
+              file=out)
+
+def usbdevice(s):
+    bus, _, dev = s.partition(':')
+    return (int(bus), int(dev))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK6x USB capture analyzer')
+    parser.add_argument("--device", type=usbdevice, default=None,
+                        help="only look at BUS:DEV (default: every GK6x-looking packet)")
+    subp = parser.add_subparsers(dest="action", required=True)
+
+    stats = subp.add_parser("stats", help="per-command timing and counters")
+    stats.add_argument("capture", help="usbmon text, pcap or pcapng file")
+    stats.add_argument("--stats", metavar="FILE", help="write the stats as JSON here")
+    stats.add_argument("--trace", metavar="FILE",
+                       help="write a Chrome/Perfetto trace of the capture here")
+
+    packets = subp.add_parser("packets", help="list the decoded packets")
+    packets.add_argument("capture", help="usbmon text, pcap or pcapng file")
+    packets.add_argument("--cmds", type=gk64.intlist, default=None,
+                         help="only these commands (e.g. 1,0x2)")
+
+    final = subp.add_parser("finalize", help="list the fwup final (2,3) packets")
+    final.add_argument("captures", nargs='+', help="usbmon text, pcap or pcapng files")
+
+    replay = subp.add_parser("replay", help="send a capture's packets to a keyboard")
+    replay.add_argument("capture", help="pcap or pcapng file")
+    replay.add_argument("--cmds", type=gk64.intlist, default=None,
+                        help="only replay these commands (e.g. 1,4)")
+    replay.add_argument("--replytimeout", type=int, default=1000,
+                        help="ms to wait for each reply (default: %(default)s)")
+    replay.add_argument("--stats", metavar="FILE", help="write the replay's stats as JSON here")
+    replay.add_argument("--sim", action="store_true",
+                        help="talk to a simulated keyboard (see gk64sim.py)")
+    replay.add_argument("--verbose", action="store_true", help="hexdump every packet")
+
+    return parser.parse_args()
+
+def main(args):
+    if args.action == "stats":
+        tracer = gk64trace.Tracer() if args.trace else gk64trace.Tracer(max_events=0)
+        analyzer = analyze(args.capture, args.device, tracer)
+        stats = analyzer.stats()
+        gk64trace.print_stats(stats)
+        print("{} packets in {:.3f}s".format(stats['counters'].get('packets', 0) +
+                                              stats['counters'].get('replies', 0),
+                                              stats['elapsed']))
+        print_finalize(stats)
+        if args.stats:
+            with open(args.stats, 'w') as f:
+                json.dump(stats, f, indent=1)
+                f.write('\n')
+        if args.trace:
+            tracer.write_chrome_trace(args.trace)
+
+    elif args.action == "packets":
+        t0 = None
+        for pkt in capture_packets(usb_transfers(read_capture(args.capture)), args.device):
+            t0 = pkt.start if t0 is None else t0
+            if args.cmds is None or pkt.fields[0] in args.cmds:
+                print_packet(pkt, t0)
+
+    elif args.action == "finalize":
+        for filename in args.captures:
+            print_finalize(analyze(filename, args.device).stats(),
+                           filename if len(args.captures) > 1 else None)
+
+    elif args.action == "replay":
+        captured = analyze(args.capture, args.device).stats()
+        transport = None
+        if args.sim:
+            import gk64sim
+            transport = gk64sim.SimTransport()
+        kbd = gk64.GK64(transport=transport)
+        if kbd.dev is None:
+            raise gk64.USBError("No device found", errno=19)
+        tracer = gk64trace.Tracer(max_events=0)
+        tracer.attach(kbd)
+        replayer = Replayer(kbd, args.cmds, args.replytimeout, args.verbose).run(
+            capture_packets(usb_transfers(read_capture(args.capture)), args.device))
+        replayed = tracer.stats()
+        replayed['elapsed'] = round(replayer.elapsed, 6)
+        print("replayed {} packets: {} replies, {} timeouts".format(
+              replayer.sent, replayer.replies, replayer.timeouts))
+        print_comparison(captured, replayed)
+        if args.stats:
+            with open(args.stats, 'w') as f:
+                json.dump(replayed, f, indent=1)
+                f.write('\n')
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except ValueError as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except BrokenPipeError:
+        pass
+    except OSError as e:
+        print(e)
+        raise SystemExit(e.errno or 1)
@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+# gk64diff.py - find what moved and what changed between firmware images
+#
+#   ./gk64diff.py bin/BBD8.bin bin/BBD8-ww.bin
+#   ./gk64diff.py bin/BBD8.bin dump/BBD8-dump.flash --hexdump
+#   ./gk64diff.py dump/BBD8-dump.flash dumps/*.flash     # one line per dump
+#   ./gk64diff.py bin/BBD8.bin weird.bin@0               # say where it goes
+#   ./gk64diff.py dump/BBD8-bootrom.flash other-bootrom.flash  # both at 0x400000
+#
+# Everything gets compared by address, not file offset: a firmware image
+# (.bin) lives at fw_base_addr (0x2a00) in flash, a flash dump at 0, and a
+# bootrom dump at 0x400000, so an image and a dump of the flash it got
+# written to line up. The base gets guessed from the vector tables (a flash
+# dump has one at 0 for the bootloader and one at 0x2a00 for the firmware),
+# or give it with FILE@BASE (a hex address or a region name, like for
+# `gk64.py peek`).
+#
+# The matching is rsync-style: the old image gets cut into aligned blocks
+# and their rolling hashes go in a dict; then a window slides over the new
+# image a byte at a time looking for blocks it's seen before. Matches get
+# grown byte by byte in both directions, so what comes out is exact:
+# ranges that are the same, ranges that moved (and by how much), and ranges
+# that changed. Runs of 0x00/0xff don't count as "moved", since blank flash
+# matches blank flash anywhere. Where the new image is the same as the old
+# one at the same address (or the same distance away as the last match)
+# we skip the hashing and just compare, which is most of the time.
+#
+# The old side's block hashes get cached (by content) in ~/.cache/gk64/diff,
+# so diffing a pile of dumps against one reference only hashes it once.
+
+import os
+import sys
+import array
+import hashlib
+import operator
+import argparse
+from collections import namedtuple
+
+import gk64
+
+# kind is 'same', 'moved', 'changed', 'added' (only in new) or 'removed'
+# (only in old); newaddr/oldaddr are None for the side it's not in
+Region = namedtuple("Region", "kind newaddr oldaddr length")
+
+VectorNames = ["reset/NMI", "TLB fill", "PTE not present", "TLB misc", "TLB VLPT miss",
+               "machine error", "debug", "general exception", "syscall",
+               "HW0", "HW1", "HW2", "HW3", "HW4", "HW5", "SW0"]
+
+def has_vectors(data, offset=0):
+    try:
+        gk64.check_vector_table(data[offset:offset+0x40])
+    except ValueError:
+        return False
+    return True
+
+def vector_targets(data, offset, addr):
+    '''Where the 16 "j" instructions in the vector table at data[offset]
+    (which is at address addr) jump to'''
+    targets = []
+    for n in range(16):
+        word = int.from_bytes(data[offset+n*4:offset+n*4+4], 'big')
+        disp = word & 0xffffff
+        if disp & 0x800000:
+            disp -= 0x1000000
+        targets.append(addr + n*4 + disp*2)
+    return targets
+
+def guess_base(filename, data):
+    '''Where a file goes in the address space, going by its name and contents'''
+    if has_vectors(data, gk64.fw_base_addr):
+        return 0    # whole flash, bootloader and firmware
+    if 'bootrom' in os.path.basename(filename):
+        return gk64.memory_region('bootrom')[1]
+    if has_vectors(data) and len(data) <= 0x10000 - gk64.fw_base_addr:
+        return gk64.fw_base_addr
+    return 0
+
+class Image(object):
+    '''An image's data and where it goes (base)'''
+    def __init__(self, name, data, base):
+        self.name = name
+        self.data = data
+        self.base = base
+
+    @classmethod
+    def open(cls, spec):
+        '''FILE or FILE@BASE'''
+        filename, at, base = spec.rpartition('@')
+        if not at:
+            filename = spec
+        with open(filename, 'rb') as f:
+            data = f.read()
+        return cls(filename, data, gk64.memaddr(base) if at else guess_base(filename, data))
+
+    @property
+    def end(self):
+        return self.base + len(self.data)
+
+    def vectors(self):
+        '''[(address of the vector table, its targets)] for each one in here'''
+        tables = []
+        for offset in (0, gk64.fw_base_addr):
+            if has_vectors(self.data, offset):
+                tables.append((self.base + offset,
+                               vector_targets(self.data, offset, self.base + offset)))
+        return tables
+
+def weak_parts(block):
+    '''The two halves of the rolling hash of block (see ImageDiff)'''
+    a = sum(block) & 0xffff
+    b = sum(map(operator.mul, range(len(block), 0, -1), block)) & 0xffff
+    return a, b
+
+BlockHashMagic = b'GK64BLK1'
+
+class BlockHashes(object):
+    '''Rolling hashes of the blocksize-aligned (by address) blocks of an
+    image, cached on disk by content.'''
+    def __init__(self, image, blocksize=0x40, cachedir=None):
+        self.blocksize = blocksize
+        # file offset of the first block that starts on an aligned address
+        self.first = -image.base % blocksize
+        count = max(0, (len(image.data) - self.first) // blocksize)
+        self.cachefile = None
+        self.hashes = None
+        if cachedir is not False:
+            cachedir = cachedir or gk64._cache_dir('diff')
+            self.cachefile = os.path.join(cachedir, "{}-{:x}-{:x}.bh".format(
+                hashlib.sha1(image.data).hexdigest(), self.first, blocksize))
+            self.hashes = self._load(count)
+        self.cached = self.hashes is not None
+        if self.hashes is None:
+            view = memoryview(image.data)
+            self.hashes = array.array('I', [a | b << 16 for a, b in (
+                weak_parts(view[off:off+blocksize])
+                for off in range(self.first, self.first + count * blocksize, blocksize))])
+            if self.cachefile:
+                self._save()
+        self._index = None
+
+    def _load(self, count):
+        try:
+            with open(self.cachefile, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if data[:8] != BlockHashMagic or len(data) != 8 + count * 4:
+            return None
+        hashes = array.array('I')
+        hashes.frombytes(data[8:])
+        return hashes
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+        with open(self.cachefile + '.tmp', 'wb') as f:
+            f.write(BlockHashMagic + self.hashes.tobytes())
+        os.replace(self.cachefile + '.tmp', self.cachefile)
+
+    def index(self):
+        '''hash -> [file offsets of the blocks with that hash]'''
+        if self._index is None:
+            self._index = dict()
+            for n, h in enumerate(self.hashes):
+                self._index.setdefault(h, []).append(self.first + n * self.blocksize)
+        return self._index
+
+class ImageDiff(object):
+    '''The regions of `new` that are the same as, moved from, or changed
+    from `old` (both Images), plus whatever's only in old.
+
+    runs is [(new offset, old offset, length)] for every stretch of new
+    that's in old somewhere; regions is the whole report, in new's order
+    (then the removed bits), with changed regions less than `merge` bytes
+    apart glued together.
+    '''
+    def __init__(self, old, new, blocksize=0x40, merge=16, hashes=None, cachedir=None):
+        self.old = old
+        self.new = new
+        self.blocksize = blocksize
+        self.hashes = hashes if hashes is not None else BlockHashes(old, blocksize, cachedir)
+        # old offset - new offset, for the same address in both
+        self.same = new.base - old.base
+        self.runs = self._extend(self._match())
+        self.regions = self._regions(merge)
+
+    def _verify(self, j, o):
+        B = self.blocksize
+        a, b = self.old.data, self.new.data
+        return 0 <= o <= len(a) - B and a[o:o+B] == b[j:j+B]
+
+    def _lookup(self, weak, j, last):
+        offsets = self.hashes.index().get(weak)
+        if not offsets:
+            return None
+        # same distance as the last match, then same address, then anywhere
+        for o in (j + last, j + self.same):
+            if o in offsets and self._verify(j, o):
+                return o
+        for o in offsets:
+            if self._verify(j, o):
+                return o
+        return None
+
+    def _match(self):
+        '''[(new offset, old offset)] for blocksize-long matches'''
+        B = self.blocksize
+        b = self.new.data
+        view = memoryview(b)
+        n = len(b)
+        matches = []
+        last = self.same
+        j = 0
+        wa = wb = None
+        while j + B <= n:
+            if wa is None:
+                # the cheap check first: is it just where we'd expect?
+                hit = next((j + d for d in (last, self.same) if self._verify(j, j + d)), None)
+                if hit is not None:
+                    matches.append((j, hit))
+                    j += B
+                    continue
+                wa, wb = weak_parts(view[j:j+B])
+            o = self._lookup(wa | wb << 16, j, last)
+            if o is not None:
+                matches.append((j, o))
+                last = o - j
+                j += B
+                wa = None
+                continue
+            if j + B >= n:
+                break
+            out, new = b[j], b[j+B]
+            wa = (wa - out + new) & 0xffff
+            wb = (wb - B * out + wa) & 0xffff
+            j += 1
+        return matches
+
+    def _extend(self, matches):
+        '''Glue adjacent matches together and grow them as far as they go'''
+        a, b = self.old.data, self.new.data
+        runs = []
+        for j, o in matches:
+            if runs and runs[-1][0] + runs[-1][2] == j and runs[-1][1] - runs[-1][0] == o - j:
+                runs[-1][2] += self.blocksize
+            else:
+                runs.append([j, o, self.blocksize])
+        for n, run in enumerate(runs):
+            j, o, length = run
+            floor = runs[n-1][0] + runs[n-1][2] if n else 0
+            while j > floor and o > 0 and b[j-1] == a[o-1]:
+                j -= 1
+                o -= 1
+                length += 1
+            ceiling = runs[n+1][0] if n + 1 < len(runs) else len(b)
+            while j + length < ceiling and o + length < len(a) and b[j+length] == a[o+length]:
+                length += 1
+            run[:] = [j, o, length]
+        # moved blank flash isn't news
+        return [tuple(run) for run in runs
+                if run[1] - run[0] == self.same or gk64._blank(b[run[0]:run[0]+run[2]]) is None]
+
+    def _gap(self, start, end):
+        '''Regions for new[start:end], which isn't in old anywhere'''
+        regions = []
+        lo = max(start, -self.same)
+        hi = min(end, len(self.old.data) - self.same)
+        if lo >= hi:
+            return [Region('added', self.new.base + start, None, end - start)]
+        if start < lo:
+            regions.append(Region('added', self.new.base + start, None, lo - start))
+        regions.append(Region('changed', self.new.base + lo, self.old.base + lo + self.same, hi - lo))
+        if hi < end:
+            regions.append(Region('added', self.new.base + hi, None, end - hi))
+        return regions
+
+    def _regions(self, merge):
+        regions = []
+        pos = 0
+        for j, o, length in self.runs:
+            if pos < j:
+                regions.extend(self._gap(pos, j))
+            regions.append(Region('same' if o - j == self.same else 'moved',
+                                  self.new.base + j, self.old.base + o, length))
+            pos = j + length
+        if pos < len(self.new.data):
+            regions.extend(self._gap(pos, len(self.new.data)))
+        # glue changed regions that are only a few same bytes apart
+        glued = []
+        for r in regions:
+            if (r.kind == 'changed' and len(glued) >= 2 and glued[-2].kind == 'changed' and
+                    glued[-1].kind == 'same' and glued[-1].length < merge):
+                first = glued[-2]
+                del glued[-2:]
+                r = Region('changed', first.newaddr, first.oldaddr,
+                           r.newaddr + r.length - first.newaddr)
+            glued.append(r)
+        # and what's only in old
+        for start, end in ((self.old.base, min(self.old.end, self.new.base)),
+                           (max(self.old.base, self.new.end), self.old.end)):
+            if start < end:
+                glued.append(Region('removed', None, start, end - start))
+        return glued
+
+    def totals(self):
+        '''bytes per kind of region, and the number of regions of each kind'''
+        nbytes = dict.fromkeys(('same', 'moved', 'changed', 'added', 'removed'), 0)
+        count = dict(nbytes)
+        for r in self.regions:
+            nbytes[r.kind] += r.length
+            count[r.kind] += 1
+        return nbytes, count
+
+    def vector_changes(self):
+        '''[(vector table address, n, old target, new target)] for every
+        vector that jumps somewhere else now'''
+        old = dict(self.old.vectors())
+        changes = []
+        for addr, targets in self.new.vectors():
+            if addr in old:
+                changes.extend((addr, n, o, t)
+                               for n, (o, t) in enumerate(zip(old[addr], targets)) if o != t)
+        return changes
+
+def _context_rows(image, addr, length, rows):
+    '''hexdump rows of image around addr..addr+length, at most `rows` of them'''
+    start = max(image.base, addr & ~0xf)
+    end = min(image.end, min(addr + length, start + rows * 16))
+    return gk64._hexdump_rows(image.data[start-image.base:end-image.base], start)
+
+def summary_line(diff):
+    nbytes, count = diff.totals()
+    size = len(diff.new.data)
+    parts = ["{:5.1f}% same".format(100.0 * nbytes['same'] / size if size else 100.0)]
+    for kind in ('moved', 'changed', 'added', 'removed'):
+        if count[kind]:
+            parts.append("{} {} ({:#x} bytes)".format(count[kind], kind, nbytes[kind]))
+    return ", ".join(parts)
+
+def print_report(diff, hexdump=False, context=4, out=None):
+    out = out if out is not None else sys.stdout
+    print("{} @{:#x} -> {} @{:#x}: {}".format(diff.old.name, diff.old.base, diff.new.name,
+                                               diff.new.base, summary_line(diff)), file=out)
+    for addr, n, old, new in diff.vector_changes():
+        print("  vector {:#x} {:<17} j {:#x} -> j {:#x}".format(addr + n*4, VectorNames[n],
+                                                               old, new), file=out)
+    for r in diff.regions:
+        if r.kind == 'same':
+            continue
+        if r.kind == 'moved':
+            where = "{:#08x} <- {:#08x} ({:+#x})".format(r.newaddr, r.oldaddr,
+                                                         r.newaddr - r.oldaddr)
+        elif r.kind == 'removed':
+            where = "{:>8} <- {:#08x}".format("", r.oldaddr)
+        else:
+            where = "{:#08x}".format(r.newaddr)
+        print("  {:<8} {:<32} {:#8x} bytes".format(r.kind, where, r.length), file=out)
+        if hexdump and r.kind in ('changed', 'added', 'removed'):
+            if r.oldaddr is not None:
+                for row in _context_rows(diff.old, r.oldaddr, r.length, context):
+                    print("    - " + row, file=out)
+            if r.newaddr is not None:
+                for row in _context_rows(diff.new, r.newaddr, r.length, context):
+                    print("    + " + row, file=out)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK6x firmware image/dump differ')
+    parser.add_argument("old", help="the image to compare against (FILE or FILE@BASE)")
+    parser.add_argument("new", nargs='+', help="image(s) to compare with it")
+    parser.add_argument("--blocksize", type=gk64.hexint, default=0x40,
+                        help="match block size, hex (default: %(default)#x)")
+    parser.add_argument("--merge", type=int, default=16,
+                        help="glue changes fewer than this many bytes apart (default: %(default)s)")
+    parser.add_argument("--regions", action="store_true",
+                        help="list regions even when comparing more than one image")
+    parser.add_argument("--hexdump", action="store_true",
+                        help="show hexdumps of changed regions")
+    parser.add_argument("--context", type=int, default=4,
+                        help="hexdump rows per changed region (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="don't read or write the block hash cache")
+    return parser.parse_args()
+
+def main(args):
+    if args.blocksize < 8:
+        raise ValueError("blocksize is too small")
+    old = Image.open(args.old)
+    hashes = BlockHashes(old, args.blocksize, None if args.cache else False)
+    detail = len(args.new) == 1 or args.regions or args.hexdump
+    for spec in args.new:
+        diff = ImageDiff(old, Image.open(spec), args.blocksize, args.merge, hashes)
+        if detail:
+            print_report(diff, args.hexdump, args.context)
+        else:
+            print("{}: {}".format(diff.new.name, summary_line(diff)))
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except ValueError as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except BrokenPipeError:
+        pass
+    except OSError as e:
+        print(e)
+        raise SystemExit(e.errno or 1)
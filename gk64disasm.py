@@ -0,0 +1,513 @@
+#!/usr/bin/python3
+# gk64disasm.py - symbol/xref index over the annotated disassemblies
+#
+# Grepping 60k lines of objdump output gets old fast. This parses the
+# listings in disasm/ once, keeps a compact index of each on disk (under
+# ~/.cache/gk64/disasm), and only re-parses a listing when it changes.
+#
+#   ./gk64disasm.py sym command_27            # find symbols by name
+#   ./gk64disasm.py sym 1b52                  # what function is 0x1b52 in?
+#   ./gk64disasm.py xref 1a90                 # who jumps/calls/points there
+#   ./gk64disasm.py callers crc16 --depth 3   # who calls it, and who calls them
+#   ./gk64disasm.py addr 1710                 # 0x1710 in the image = flash 0x4110
+#   ./gk64disasm.py cmd 27                    # the handler for command 0x27
+#
+# The listings:
+#   image    disasm/BBD8.disasm          firmware image, offset 0 = flash 0x2a00
+#   flash    disasm/BBD8-dump.disasm     the whole flash dump (bootloader too)
+#   bootrom  disasm/BBD8-bootrom.disasm  boot ROM, mapped at 0x400000
+#
+# Symbols come from the "; ------- 0x1ae8: command_27_thingy(...)" comment
+# headers, plus a sub_XXXX for every jal target that doesn't have one.
+# Anything named handle_command_NN counts as the handler for command 0xNN,
+# and results get tagged with the commands whose handlers call them.
+#
+# A listing can have more than one objdump run in it (each starts with a
+# "file format" line). BBD8-bootrom.disasm has a second, unannotated one
+# tacked on the end that starts over at 0x2018, where the reset vector goes,
+# because the first one got 0x2000-0x2020 out of step. A later run takes
+# over from its first address on; the comment headers still count.
+#
+# Branch targets in the listings are relative to the start of each listing
+# (objdump didn't know the base address), but sethi/ori constants are real
+# CPU addresses, so for the image those are 0x2a00 off; xref takes care of
+# that.
+
+import os
+import re
+import sys
+import json
+import array
+import bisect
+import struct
+import hashlib
+import argparse
+from collections import deque
+
+import gk64
+
+DISASMDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "disasm")
+
+# name -> (filename, where offset 0 is in the CPU's address space)
+Listings = {
+    'image':   ("BBD8.disasm", gk64.fw_base_addr),
+    'flash':   ("BBD8-dump.disasm", 0x000000),
+    'bootrom': ("BBD8-bootrom.disasm", 0x400000),
+}
+
+# what the commands are to us, for the ones gk64 knows about
+GK64Commands = {
+    0x01: "info: GK64.get_fwid sends 1,1; fwup starts with 1,2",
+    0x02: "firmware upload: cdboot_send_firmware sends 2,1 / 2,2 / 2,3 (and 2,5)",
+    0x03: "reset: enter_keyboard_mode sends 3,1, enter_cdboot_mode 3,2",
+    0x04: "memory read: read_memory / read_memory_hax send 4,1 (haxed firmware)",
+    0x22: "set keys: gk64keymap.CfgSetKeysCmd (a guess)",
+    0x2a: "get keys: gk64keymap.CfgGetKeysCmd (a guess)",
+}
+
+BranchOps = frozenset(['j', 'j8', 'beq', 'bne', 'beqz', 'bnez', 'beqz38', 'bnez38',
+                       'beqzs8', 'bnezs8', 'beqs38', 'bnes38', 'bgez', 'bltz', 'bgtz',
+                       'blez', 'beqc', 'bnec'])
+CallOps = frozenset(['jal', 'bgezal', 'bltzal'])
+RefJump, RefCall, RefAddr = 0, 1, 2
+RefKinds = {RefJump: 'jump', RefCall: 'call', RefAddr: 'addr'}
+
+# the opcode has to come after a gap, so the last byte of an *unknown*
+# row ("06 49 ff fe  *unknown*") doesn't pass for one
+_insn_re = re.compile(r'^\s*([0-9a-f]+):\s+(?:[0-9a-f]{2} ){1,4}\s+([a-z.][\w.]*)\s*([^;!]*)')
+_format_re = re.compile(r'^;?\s*\S.*:\s+file format ')
+_header_re = re.compile(r'^\s*;\s*-{3,}\s*(?:0x([0-9a-f]+)\b:?)?\s*(.*?)[\s-]*$')
+_name_re = re.compile(r'^([A-Za-z_]\w*)\s*(?:$|[(:-])')
+_target_re = re.compile(r'0x([0-9a-f]+)\s*$')
+_sethi_re = re.compile(r'^\$(\w+),#0x([0-9a-f]+)$')
+_lo_re = re.compile(r'^\$(\w+),\$(\w+),#0x([0-9a-f]+)$')
+_command_re = re.compile(r'^handle_command_([0-9a-f]+)$')
+
+def parse_listing(f):
+    '''Parse an objdump listing (a binary file object).
+
+    Returns (symbols, insns, refs): symbols is [(addr, name, description)],
+    insns is [(addr, byte offset of its line)], and refs is
+    [(from addr, to addr, kind)], all sorted by address. If a second
+    objdump run starts at addr, it replaces everything from addr on (see
+    the top of this file).
+    '''
+    symbols = dict()    # addr -> [name, description]
+    insns = []
+    refs = []
+    headers = []        # headers waiting for an instruction to belong to
+    sethi = dict()      # register -> (addr of the sethi, high bits)
+    offset = 0
+    restart = False     # a new objdump run just started
+    for raw in f:
+        line = raw.decode('utf8', 'replace')
+        pos = offset
+        offset += len(raw)
+        m = _insn_re.match(line)
+        if m is None:
+            if _format_re.match(line):
+                restart = bool(insns)
+                headers = []
+                sethi = dict()
+                continue
+            h = _header_re.match(line)
+            if h is not None:
+                headers.append((int(h.group(1), 16) if h.group(1) else None, h.group(2)))
+            elif line.strip() and not line.lstrip().startswith(';'):
+                headers = []
+            continue
+        addr = int(m.group(1), 16)
+        op = m.group(2)
+        operands = m.group(3).strip()
+        if restart:
+            # both lists are in address order, so this keeps them that way
+            del insns[bisect.bisect_left(insns, (addr,)):]
+            del refs[bisect.bisect_left(refs, (addr,)):]
+            restart = False
+        insns.append((addr, pos))
+
+        for haddr, text in headers:
+            haddr = addr if haddr is None else haddr
+            n = _name_re.match(text)
+            name = n.group(1) if n and re.search('[a-z]', n.group(1)) else None
+            sym = symbols.setdefault(haddr, [None, ""])
+            if name and sym[0] is None:
+                sym[0] = name
+            if text:
+                sym[1] = "{} / {}".format(sym[1], text) if sym[1] else text
+        headers = []
+
+        if op in BranchOps or op in CallOps:
+            t = _target_re.search(operands)
+            if t is not None:
+                refs.append((addr, int(t.group(1), 16),
+                             RefCall if op in CallOps else RefJump))
+        elif op == 'sethi':
+            s = _sethi_re.match(operands)
+            if s is not None:
+                sethi[s.group(1)] = (addr, int(s.group(2), 16) << 12)
+        elif op in ('ori', 'addi'):
+            # sethi $rX,#hi; ...; ori $rX,$rX,#lo is how addresses get loaded
+            lo = _lo_re.match(operands)
+            if lo is not None and lo.group(1) == lo.group(2) and lo.group(1) in sethi:
+                started, high = sethi.pop(lo.group(1))
+                if addr - started <= 0x20:
+                    refs.append((addr, high | int(lo.group(3), 16), RefAddr))
+
+    for addr in [r[1] for r in refs if r[2] == RefCall]:
+        symbols.setdefault(addr, [None, ""])
+    return ([(addr, name or "sub_{:x}".format(addr), desc)
+             for addr, (name, desc) in sorted(symbols.items())],
+            insns, refs)
+
+# Index file layout: header, symbols as JSON, then arrays of u32s (insn
+# addresses, their line offsets, ref sources, ref targets) and the ref kinds
+# as bytes.
+DisasmIndexMagic = b'GK64DIX1'
+DisasmIndexVersion = 2
+DisasmIndexStruct = struct.Struct("<8sIQQIII")
+
+class Listing(object):
+    '''One indexed listing: name, filename, base (CPU address of offset 0),
+    symbols, instructions and refs'''
+    def __init__(self, name, filename, base, symbols, addrs, offsets, refsrc, refdst, refkind):
+        self.name = name
+        self.filename = filename
+        self.base = base
+        self.symbols = symbols
+        self.symaddrs = [s[0] for s in symbols]
+        self.addrs = addrs
+        self.offsets = offsets
+        self.refsrc = refsrc
+        self.refdst = refdst
+        self.refkind = refkind
+        self.commands = dict()  # addr of handle_command_NN -> NN
+        for addr, name, _ in symbols:
+            m = _command_re.match(name)
+            if m:
+                self.commands[addr] = int(m.group(1), 16)
+        self._callers = None
+
+    @classmethod
+    def parse(cls, name, filename, base):
+        with open(filename, 'rb') as f:
+            symbols, insns, refs = parse_listing(f)
+        return cls(name, filename, base, symbols,
+                   array.array('I', [i[0] for i in insns]),
+                   array.array('I', [i[1] for i in insns]),
+                   array.array('I', [r[0] for r in refs]),
+                   array.array('I', [r[1] for r in refs]),
+                   bytes(r[2] for r in refs))
+
+    def save(self, indexfile, st):
+        blob = json.dumps(self.symbols).encode('utf8')
+        with open(indexfile + '.tmp', 'wb') as f:
+            f.write(DisasmIndexStruct.pack(DisasmIndexMagic, DisasmIndexVersion,
+                                           st.st_mtime_ns, st.st_size, len(blob),
+                                           len(self.addrs), len(self.refsrc)))
+            f.write(blob)
+            for arr in (self.addrs, self.offsets, self.refsrc, self.refdst):
+                f.write(arr.tobytes())
+            f.write(self.refkind)
+        os.replace(indexfile + '.tmp', indexfile)
+
+    @classmethod
+    def load(cls, name, filename, base, indexfile, st):
+        '''The saved index, or None if it's missing or out of date'''
+        try:
+            with open(indexfile, 'rb') as f:
+                data = f.read()
+            magic, version, mtime, size, jsonlen, ninsns, nrefs = \
+                DisasmIndexStruct.unpack_from(data)
+        except (OSError, struct.error):
+            return None
+        if (magic, version, mtime, size) != (DisasmIndexMagic, DisasmIndexVersion,
+                                             st.st_mtime_ns, st.st_size):
+            return None
+        pos = DisasmIndexStruct.size
+        symbols = [tuple(s) for s in json.loads(data[pos:pos+jsonlen].decode('utf8'))]
+        pos += jsonlen
+        arrays = []
+        for count in (ninsns, ninsns, nrefs, nrefs):
+            arr = array.array('I')
+            arr.frombytes(data[pos:pos+count*4])
+            arrays.append(arr)
+            pos += count * 4
+        return cls(name, filename, base, symbols, *arrays, refkind=data[pos:pos+nrefs])
+
+    # --- lookups ---
+
+    def function_at(self, addr):
+        '''The (addr, name, description) of the symbol addr is in, or None'''
+        idx = bisect.bisect_right(self.symaddrs, addr) - 1
+        return self.symbols[idx] if idx >= 0 else None
+
+    def find(self, name):
+        '''Symbols whose name contains `name`; exact matches first'''
+        exact = [s for s in self.symbols if s[1] == name]
+        return exact + [s for s in self.symbols if name in s[1] and s[1] != name]
+
+    def line(self, addr):
+        '''The listing line for the instruction at addr, or None'''
+        idx = bisect.bisect_left(self.addrs, addr)
+        if idx == len(self.addrs) or self.addrs[idx] != addr:
+            return None
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offsets[idx])
+            return f.readline().decode('utf8', 'replace').strip()
+
+    def refs_to(self, addr):
+        '''[(from, kind)] for everything that jumps to, calls or loads addr'''
+        # sethi/ori constants are CPU addresses, the rest are offsets
+        cpu = addr + self.base
+        return [(src, kind) for src, dst, kind in zip(self.refsrc, self.refdst, self.refkind)
+                if (dst == cpu if kind == RefAddr else dst == addr)]
+
+    def refs_from(self, start, end):
+        '''[(from, to, kind)] for the refs in start..end'''
+        lo = bisect.bisect_left(self.refsrc, start)
+        hi = bisect.bisect_left(self.refsrc, end)
+        return list(zip(self.refsrc[lo:hi], self.refdst[lo:hi], self.refkind[lo:hi]))
+
+    def function_range(self, addr):
+        '''(start, end) of the function starting at (or containing) addr'''
+        sym = self.function_at(addr)
+        start = sym[0] if sym else 0
+        idx = bisect.bisect_right(self.symaddrs, start)
+        end = self.symaddrs[idx] if idx < len(self.symaddrs) else (self.addrs[-1] + 4 if self.addrs else start)
+        return start, end
+
+    def callers(self, addr):
+        '''Functions (by start addr) that call or jump into addr's function'''
+        if self._callers is None:
+            self._callers = dict()
+            for src, dst, kind in zip(self.refsrc, self.refdst, self.refkind):
+                if kind == RefAddr:
+                    continue
+                f, t = self.function_at(src), self.function_at(dst)
+                if f and t and f[0] != t[0]:
+                    self._callers.setdefault(t[0], set()).add(f[0])
+        sym = self.function_at(addr)
+        return sorted(self._callers.get(sym[0], ())) if sym else []
+
+    def reaching_commands(self, addr, limit=12):
+        '''Command numbers whose handlers (eventually) call addr's function'''
+        sym = self.function_at(addr)
+        if sym is None:
+            return []
+        seen = {sym[0]}
+        todo = deque([(sym[0], 0)])
+        found = set()
+        while todo:
+            func, depth = todo.popleft()
+            if func in self.commands:
+                found.add(self.commands[func])
+            if depth >= limit:
+                continue
+            for caller in self.callers(func):
+                if caller not in seen:
+                    seen.add(caller)
+                    todo.append((caller, depth + 1))
+        return sorted(found)
+
+class DisasmIndex(object):
+    '''All the listings, indexed. Listings that changed since their index
+    was saved get re-parsed (their names end up in `rebuilt`).'''
+    def __init__(self, disasmdir=None, cachedir=None, listings=None, rebuild=False):
+        disasmdir = disasmdir or DISASMDIR
+        cachedir = cachedir or gk64._cache_dir('disasm')
+        self.listings = dict()
+        self.rebuilt = []
+        for name, (filename, base) in sorted((listings or Listings).items()):
+            path = os.path.join(disasmdir, filename)
+            if not os.path.exists(path):
+                continue
+            st = os.stat(path)
+            digest = hashlib.sha1(os.path.abspath(path).encode('utf8')).hexdigest()[:12]
+            indexfile = os.path.join(cachedir, "{}-{}.idx".format(filename, digest))
+            listing = None if rebuild else Listing.load(name, path, base, indexfile, st)
+            if listing is None:
+                listing = Listing.parse(name, path, base)
+                os.makedirs(cachedir, exist_ok=True)
+                listing.save(indexfile, st)
+                self.rebuilt.append(name)
+            self.listings[name] = listing
+
+    def __getitem__(self, name):
+        return self.listings[name]
+
+    def resolve(self, listing, target):
+        '''A symbol name or hex address -> address in listing'''
+        try:
+            return int(target, 16)
+        except ValueError:
+            pass
+        syms = listing.find(target)
+        if not syms:
+            raise ValueError("no symbol {!r} in {}".format(target, listing.name))
+        return syms[0][0]
+
+    def translate(self, addr, space):
+        '''addr in `space` (a listing name, or 'cpu') -> {space: addr} for
+        every listing it falls in, plus 'cpu' '''
+        cpu = addr if space == 'cpu' else addr + self.listings[space].base \
+              if space in self.listings else addr + Listings[space][1]
+        out = dict(cpu=cpu)
+        for name, listing in self.listings.items():
+            offset = cpu - listing.base
+            if offset >= 0 and listing.addrs and offset <= listing.addrs[-1]:
+                out[name] = offset
+        return out
+
+def _describe(listing, addr):
+    sym = listing.function_at(addr)
+    if sym is None:
+        return "{:#x}".format(addr)
+    where = sym[1] if sym[0] == addr else "{}+{:#x}".format(sym[1], addr - sym[0])
+    cmds = listing.reaching_commands(addr)
+    if cmds:
+        where += " [cmd {}]".format(",".join("{:#x}".format(c) for c in cmds))
+    return where
+
+def _show_line(listing, addr, out):
+    line = listing.line(addr)
+    print("  {:>8}  {:<36} {}".format("{:#x}".format(addr), _describe(listing, addr),
+                                     line.split(':', 1)[1].strip() if line else ""), file=out)
+
+def query_sym(index, listing, target, out=sys.stdout):
+    try:
+        addr = int(target, 16)
+    except ValueError:
+        for addr, name, desc in listing.find(target):
+            print("{:#8x}  {:<32} {}".format(addr, name, desc), file=out)
+        return
+    sym = listing.function_at(addr)
+    if sym is None:
+        print("{:#x}: not in any function".format(addr), file=out)
+        return
+    print("{:#x} is in {} ({:#x}){}".format(addr, sym[1], sym[0],
+          ": " + sym[2] if sym[2] else ""), file=out)
+    cmds = listing.reaching_commands(addr)
+    if cmds:
+        print("reached from command handlers: {}".format(
+              ", ".join("{:#x}".format(c) for c in cmds)), file=out)
+
+def query_xref(index, listing, target, out=sys.stdout):
+    addr = index.resolve(listing, target)
+    print("{} ({}):".format(_describe(listing, addr), listing.name), file=out)
+    refs = listing.refs_to(addr)
+    print("referenced from {} place(s):".format(len(refs)), file=out)
+    for src, kind in refs:
+        print("  {:<4}".format(RefKinds[kind]), end='', file=out)
+        _show_line(listing, src, out)
+    start, end = listing.function_range(addr)
+    if start == addr:
+        outgoing = listing.refs_from(start, end)
+        calls = sorted(set(dst for _, dst, kind in outgoing if kind == RefCall))
+        if calls:
+            print("calls:", file=out)
+            for dst in calls:
+                print("  {:#8x}  {}".format(dst, _describe(listing, dst)), file=out)
+
+def query_callers(index, listing, target, depth=1, out=sys.stdout):
+    addr = index.resolve(listing, target)
+    print("{} ({})".format(_describe(listing, addr), listing.name), file=out)
+    seen = set()
+    def walk(func, level):
+        for caller in listing.callers(func):
+            print("{}<- {:#x} {}".format("  " * level, caller, _describe(listing, caller)),
+                  file=out)
+            if level < depth and caller not in seen:
+                seen.add(caller)
+                walk(caller, level + 1)
+    walk(addr, 1)
+
+def query_addr(index, addr, space, out=sys.stdout):
+    spaces = index.translate(addr, space)
+    print("cpu {:#x}".format(spaces.pop('cpu')), file=out)
+    for name, offset in sorted(spaces.items()):
+        listing = index[name]
+        print("{:<8} {:#x}".format(name, offset), file=out)
+        _show_line(listing, offset, out)
+
+def query_cmd(index, cmd, out=sys.stdout):
+    if cmd in GK64Commands:
+        print("cmd {:#x}: {}".format(cmd, GK64Commands[cmd]), file=out)
+    found = False
+    for name, listing in sorted(index.listings.items()):
+        for addr, num in sorted(listing.commands.items()):
+            if num != cmd:
+                continue
+            found = True
+            sym = listing.function_at(addr)
+            print("{}: {:#x} {}".format(name, addr, sym[2] or sym[1]), file=out)
+            start, end = listing.function_range(addr)
+            for dst in sorted(set(d for _, d, k in listing.refs_from(start, end) if k == RefCall)):
+                print("  calls {:#8x}  {}".format(dst, _describe(listing, dst)), file=out)
+            for caller in listing.callers(addr):
+                print("  from  {:#8x}  {}".format(caller, _describe(listing, caller)), file=out)
+    if not found:
+        print("no handle_command_{:x} in the listings".format(cmd), file=out)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK6x disassembly index')
+    parser.add_argument("--listing", default="image", choices=sorted(Listings),
+                        help="which listing to look in (default: %(default)s)")
+    parser.add_argument("--disasm", default=None, help="listing directory (default: disasm/)")
+    parser.add_argument("--cache", default=None,
+                        help="index directory (default: ~/.cache/gk64/disasm)")
+    subp = parser.add_subparsers(dest="action", required=True)
+
+    sym = subp.add_parser("sym", help="find symbols by name, or the function an address is in")
+    sym.add_argument("target", help="(part of a) symbol name, or hex address")
+
+    xref = subp.add_parser("xref", help="what refers to an address or symbol")
+    xref.add_argument("target", help="symbol name or hex address")
+
+    callers = subp.add_parser("callers", help="who calls a function")
+    callers.add_argument("target", help="symbol name or hex address")
+    callers.add_argument("--depth", type=int, default=1, help="levels of callers to show")
+
+    addr = subp.add_parser("addr", help="an address in all the listings")
+    addr.add_argument("addr", type=gk64.hexint, help="hex address")
+    addr.add_argument("--from", dest="space", default=None,
+                      choices=sorted(Listings) + ['cpu'],
+                      help="what addr is relative to (default: --listing)")
+
+    cmd = subp.add_parser("cmd", help="the handler for a command number")
+    cmd.add_argument("cmd", type=gk64.hexint, help="command number (hex)")
+
+    subp.add_parser("reindex", help="re-parse all the listings")
+
+    return parser.parse_args()
+
+def main(args):
+    index = DisasmIndex(args.disasm, args.cache, rebuild=args.action == "reindex")
+    if args.action == "reindex":
+        for name in index.rebuilt:
+            listing = index[name]
+            print("{:<8} {:6} instructions, {:5} symbols, {:6} refs".format(
+                  name, len(listing.addrs), len(listing.symbols), len(listing.refsrc)))
+        return
+    if args.listing not in index.listings:
+        raise ValueError("no {} listing in {}".format(args.listing, args.disasm or DISASMDIR))
+    listing = index[args.listing]
+    if args.action == "sym":
+        query_sym(index, listing, args.target)
+    elif args.action == "xref":
+        query_xref(index, listing, args.target)
+    elif args.action == "callers":
+        query_callers(index, listing, args.target, args.depth)
+    elif args.action == "addr":
+        query_addr(index, args.addr, args.space or args.listing)
+    elif args.action == "cmd":
+        query_cmd(index, args.cmd)
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except ValueError as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except BrokenPipeError:
+        pass
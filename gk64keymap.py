@@ -0,0 +1,580 @@
+#!/usr/bin/python3
+# gk64keymap.py - turn a QMK Configurator keymap.json into a 'cfg' image
+#
+# The whole point of this project: go to https://config.qmk.fm/, lay out
+# your keys, download keymap.json, and put it on the keyboard.
+#
+#   ./gk64keymap.py compile keymap.json keymap.cfg --header keymap.cfg.hdr
+#
+# BIG FAT WARNING: I haven't worked out the real layout of the cfg image yet.
+# What's here is my best guess, going by how GK6X talks to these boards:
+#
+#   u16 layer count, u16 keys per layer, then for each layer, one u32 key
+#   value per key (little-endian), in the order the keys appear in the
+#   keymap.json layout.
+#
+# and key values work like GK6X's "driver values":
+#
+#   0x02MMKK00  keyboard key: HID usage KK, with modifier bits MM held
+#   0x03UUUUUU  consumer (media) key: usage UUUU
+#   0x0a00OONN  layer key: op OO (1=MO, 2=TG, 3=TO) for layer NN
+#   0x00000000  KC_NO - nothing
+#   0xffffffff  KC_TRNS - whatever the layer below has
+#
+# So the keycode tables below are solid (they're straight out of the HID
+# usage tables), but the container might need fixing once someone figures
+# out the real thing. That's also why the format version goes into the
+# cache keys.
+#
+# Layers get compiled separately and cached by a hash of their contents, so
+# editing one layer of a big keymap only recompiles that layer.
+
+import os
+import re
+import json
+import struct
+import hashlib
+import argparse
+
+import gk64
+
+CfgFormatVersion = 1
+CfgHeaderStruct = struct.Struct("<HH")  # layer count, keys per layer
+
+KeyNone = 0x00000000
+KeyTransparent = 0xffffffff
+
+# --- keycode tables ---
+
+def _keyboard(usage, mods=0):
+    return 0x02000000 | (mods << 16) | (usage << 8)
+
+def _consumer(usage):
+    return 0x03000000 | usage
+
+ModifierBits = {
+    'LCTL': 0x01, 'LSFT': 0x02, 'LALT': 0x04, 'LGUI': 0x08,
+    'RCTL': 0x10, 'RSFT': 0x20, 'RALT': 0x40, 'RGUI': 0x80,
+}
+ModifierAliases = {
+    'C': 'LCTL', 'S': 'LSFT', 'A': 'LALT', 'G': 'LGUI',
+    'LOPT': 'LALT', 'LCMD': 'LGUI', 'LWIN': 'LGUI',
+    'ROPT': 'RALT', 'RCMD': 'RGUI', 'RWIN': 'RGUI', 'ALGR': 'RALT',
+}
+
+LayerOps = {'MO': 1, 'TG': 2, 'TO': 3}
+
+# (HID usage, names...) for the plain keyboard keys
+_KeyboardUsages = [
+    (0x28, 'ENT', 'ENTER'),
+    (0x29, 'ESC', 'ESCAPE'),
+    (0x2a, 'BSPC', 'BSPACE', 'BACKSPACE'),
+    (0x2b, 'TAB'),
+    (0x2c, 'SPC', 'SPACE'),
+    (0x2d, 'MINS', 'MINUS'),
+    (0x2e, 'EQL', 'EQUAL'),
+    (0x2f, 'LBRC', 'LBRACKET', 'LEFT_BRACKET'),
+    (0x30, 'RBRC', 'RBRACKET', 'RIGHT_BRACKET'),
+    (0x31, 'BSLS', 'BSLASH', 'BACKSLASH'),
+    (0x32, 'NUHS', 'NONUS_HASH'),
+    (0x33, 'SCLN', 'SCOLON', 'SEMICOLON'),
+    (0x34, 'QUOT', 'QUOTE'),
+    (0x35, 'GRV', 'GRAVE', 'ZKHK'),
+    (0x36, 'COMM', 'COMMA'),
+    (0x37, 'DOT'),
+    (0x38, 'SLSH', 'SLASH'),
+    (0x39, 'CAPS', 'CLCK', 'CAPSLOCK', 'CAPS_LOCK'),
+    (0x46, 'PSCR', 'PSCREEN', 'PRINT_SCREEN'),
+    (0x47, 'SCRL', 'SLCK', 'SCROLLLOCK', 'SCROLL_LOCK'),
+    (0x48, 'PAUS', 'PAUSE', 'BRK'),
+    (0x49, 'INS', 'INSERT'),
+    (0x4a, 'HOME'),
+    (0x4b, 'PGUP', 'PAGE_UP'),
+    (0x4c, 'DEL', 'DELETE'),
+    (0x4d, 'END'),
+    (0x4e, 'PGDN', 'PGDOWN', 'PAGE_DOWN'),
+    (0x4f, 'RGHT', 'RIGHT'),
+    (0x50, 'LEFT'),
+    (0x51, 'DOWN'),
+    (0x52, 'UP'),
+    (0x53, 'NUM', 'NLCK', 'NUMLOCK', 'NUM_LOCK'),
+    (0x54, 'PSLS', 'KP_SLASH'),
+    (0x55, 'PAST', 'KP_ASTERISK'),
+    (0x56, 'PMNS', 'KP_MINUS'),
+    (0x57, 'PPLS', 'KP_PLUS'),
+    (0x58, 'PENT', 'KP_ENTER'),
+    (0x62, 'P0', 'KP_0'),
+    (0x63, 'PDOT', 'KP_DOT'),
+    (0x64, 'NUBS', 'NONUS_BSLASH', 'NONUS_BACKSLASH'),
+    (0x65, 'APP', 'APPLICATION'),
+]
+
+_ConsumerUsages = [
+    (0xe2, 'MUTE', 'AUDIO_MUTE'),
+    (0xe9, 'VOLU', 'AUDIO_VOL_UP'),
+    (0xea, 'VOLD', 'AUDIO_VOL_DOWN'),
+    (0xb5, 'MNXT', 'MEDIA_NEXT_TRACK'),
+    (0xb6, 'MPRV', 'MEDIA_PREV_TRACK'),
+    (0xb7, 'MSTP', 'MEDIA_STOP'),
+    (0xcd, 'MPLY', 'MEDIA_PLAY_PAUSE'),
+    (0x6f, 'BRIU', 'BRIGHTNESS_UP'),
+    (0x70, 'BRID', 'BRIGHTNESS_DOWN'),
+]
+
+# shifted symbols: name -> the unshifted key
+_Shifted = {
+    'TILD': 'GRV', 'TILDE': 'GRV', 'EXLM': '1', 'EXCLAIM': '1', 'AT': '2',
+    'HASH': '3', 'DLR': '4', 'DOLLAR': '4', 'PERC': '5', 'PERCENT': '5',
+    'CIRC': '6', 'CIRCUMFLEX': '6', 'AMPR': '7', 'AMPERSAND': '7',
+    'ASTR': '8', 'ASTERISK': '8', 'LPRN': '9', 'LEFT_PAREN': '9',
+    'RPRN': '0', 'RIGHT_PAREN': '0', 'UNDS': 'MINS', 'UNDERSCORE': 'MINS',
+    'PLUS': 'EQL', 'LCBR': 'LBRC', 'LEFT_CURLY_BRACE': 'LBRC',
+    'RCBR': 'RBRC', 'RIGHT_CURLY_BRACE': 'RBRC', 'PIPE': 'BSLS',
+    'COLN': 'SCLN', 'COLON': 'SCLN', 'DQUO': 'QUOT', 'DQT': 'QUOT',
+    'DOUBLE_QUOTE': 'QUOT', 'LABK': 'COMM', 'LT': 'COMM',
+    'LEFT_ANGLE_BRACKET': 'COMM', 'RABK': 'DOT', 'GT': 'DOT',
+    'RIGHT_ANGLE_BRACKET': 'DOT', 'QUES': 'SLSH', 'QUESTION': 'SLSH',
+}
+
+def _build_keycodes():
+    # Everything gets flattened into one name -> key value dict up front, so
+    # compiling a key is (almost always) just a dict lookup.
+    codes = dict()
+    for n in range(26):
+        codes[chr(ord('A') + n)] = _keyboard(0x04 + n)
+    for n in range(1, 10):
+        codes[str(n)] = _keyboard(0x1d + n)
+        codes['P{}'.format(n)] = codes['KP_{}'.format(n)] = _keyboard(0x58 + n)
+    codes['0'] = _keyboard(0x27)
+    for n in range(1, 13):
+        codes['F{}'.format(n)] = _keyboard(0x39 + n)
+    for n in range(13, 25):
+        codes['F{}'.format(n)] = _keyboard(0x5b + n)
+    for usage, *names in _KeyboardUsages:
+        for name in names:
+            codes[name] = _keyboard(usage)
+    for usage, *names in _ConsumerUsages:
+        for name in names:
+            codes[name] = _consumer(usage)
+    for name, bit in ModifierBits.items():
+        codes[name] = _keyboard(0, bit)
+    for alias, name in ModifierAliases.items():
+        if len(alias) > 1:
+            codes[alias] = codes[name]
+    for long_name, name in (('LCTRL', 'LCTL'), ('LEFT_CTRL', 'LCTL'),
+                            ('LSHIFT', 'LSFT'), ('LEFT_SHIFT', 'LSFT'),
+                            ('LEFT_ALT', 'LALT'), ('LEFT_GUI', 'LGUI'),
+                            ('RCTRL', 'RCTL'), ('RIGHT_CTRL', 'RCTL'),
+                            ('RSHIFT', 'RSFT'), ('RIGHT_SHIFT', 'RSFT'),
+                            ('RIGHT_ALT', 'RALT'), ('RIGHT_GUI', 'RGUI')):
+        codes[long_name] = codes[name]
+    for name, base in _Shifted.items():
+        codes[name] = codes[base] | (ModifierBits['LSFT'] << 16)
+    keycodes = {'KC_' + name: value for name, value in codes.items()}
+    keycodes.update({'KC_NO': KeyNone, 'XXXXXXX': KeyNone,
+                     'KC_TRNS': KeyTransparent, 'KC_TRANSPARENT': KeyTransparent,
+                     '_______': KeyTransparent})
+    return keycodes
+
+QMKKeycodes = _build_keycodes()
+
+_wrapped_re = re.compile(r'^([A-Z_]+)\((.*)\)$')
+
+def keycode_value(keycode):
+    '''Key value for one QMK keycode string (e.g. "KC_A", "LCTL(KC_C)", "MO(1)")'''
+    keycode = keycode.strip()
+    value = QMKKeycodes.get(keycode)
+    if value is not None:
+        return value
+    m = _wrapped_re.match(keycode)
+    if m:
+        fn, arg = m.groups()
+        if fn in LayerOps:
+            layer = int(arg, 0)
+            if not 0 <= layer <= 0xff:
+                raise ValueError("bad layer number in {!r}".format(keycode))
+            return 0x0a000000 | (LayerOps[fn] << 8) | layer
+        mod = ModifierBits.get(ModifierAliases.get(fn, fn))
+        if mod is not None:
+            inner = keycode_value(arg)
+            if inner >> 24 != 0x02:
+                raise ValueError("can't hold a modifier with {!r}".format(arg))
+            return inner | (mod << 16)
+    raise ValueError("unknown keycode {!r}".format(keycode))
+
+# --- compiling ---
+
+class KeymapCompiler(object):
+    '''Compiles keymap.json layers into cfg image data, with a layer cache.
+
+    Compiled layers are cached by (format version, keys per layer, the
+    layer's keycodes), in memory and, if cachedir is given, on disk too
+    (named by a hash of all that). hits/misses count how that's going.
+    '''
+    def __init__(self, keys=None, cachedir=None):
+        self.keys = keys
+        self.cachedir = cachedir
+        self.layers = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def _layer_key(self, layer, keys):
+        # keycodes can't have newlines in them, so this is unambiguous
+        return "{}:{}:{}".format(CfgFormatVersion, keys, "\n".join(layer))
+
+    def _cache_get(self, key):
+        data = self.layers.get(key)
+        if data is None and self.cachedir:
+            try:
+                with open(self._cache_file(key), 'rb') as f:
+                    data = self.layers[key] = f.read()
+            except OSError:
+                pass
+        return data
+
+    def _cache_file(self, key):
+        digest = hashlib.sha256(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cachedir, digest + '.layer')
+
+    def _cache_put(self, key, data):
+        self.layers[key] = data
+        if self.cachedir:
+            os.makedirs(self.cachedir, exist_ok=True)
+            filename = self._cache_file(key)
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def build_layer(layer, keys):
+        '''Compile one layer (a list of keycode strings), no caching'''
+        if len(layer) > keys:
+            raise ValueError("layer has {} keys, only room for {}".format(len(layer), keys))
+        values = []
+        for idx, keycode in enumerate(layer):
+            try:
+                values.append(keycode_value(keycode))
+            except ValueError as e:
+                raise ValueError("key {}: {}".format(idx, e))
+        values.extend([KeyNone] * (keys - len(values)))
+        return struct.pack('<{}I'.format(keys), *values)
+
+    def compile_layer(self, layer, keys):
+        key = self._layer_key(layer, keys)
+        data = self._cache_get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = self.build_layer(layer, keys)
+        self._cache_put(key, data)
+        return data
+
+    def compile(self, keymap):
+        '''keymap (the parsed keymap.json) -> cfg image data'''
+        layers = keymap.get('layers')
+        if not layers:
+            raise ValueError("keymap has no layers")
+        keys = self.keys or max(len(layer) for layer in layers)
+        out = [CfgHeaderStruct.pack(len(layers), keys)]
+        for num, layer in enumerate(layers):
+            try:
+                out.append(self.compile_layer(layer, keys))
+            except ValueError as e:
+                raise ValueError("layer {}: {}".format(num, e))
+        return b''.join(out)
+
+    def image(self, keymap, ts=None):
+        '''Returns (cfg data, BImgHdr) for keymap'''
+        data = self.compile(keymap)
+        name = keymap.get('keymap')
+        return data, gk64.make_bimg_header(data, ts=ts, imgtype='cfg',
+                                           name=name.encode('utf8') if name else None)
+
+# --- putting it on the keyboard ---
+
+# Keyboard-mode commands for reading/writing a layer's key values: subcmd is
+# the layer, offset/length are bytes within that layer's key values. These
+# are modelled on the layer commands GK6X uses; I haven't confirmed them on
+# this firmware yet (try `gk64.py scan` first), so treat them as guesses.
+# 0x22 definitely does *something* (see handle_command_22 in
+# disasm/BBD8.disasm), just not necessarily this. KeymapApplier won't touch
+# the keyboard at all without experimental=True.
+CfgSetKeysCmd = 0x22
+CfgGetKeysCmd = 0x2a
+
+def cfg_layers(data):
+    '''Split cfg image data into (keys per layer, [layer data, ...])'''
+    count, keys = CfgHeaderStruct.unpack_from(data)
+    size = keys * 4
+    start = CfgHeaderStruct.size
+    if len(data) != start + count * size:
+        raise ValueError("cfg data is {} bytes, expected {}".format(
+                         len(data), start + count * size))
+    return keys, [bytes(data[start+n*size:start+(n+1)*size]) for n in range(count)]
+
+def changed_runs(old, new, maxlen=0x38):
+    '''(offset, length) runs covering the 4-byte key values that differ
+    between old and new, each at most maxlen bytes. Unchanged keys in
+    between get sent along if that saves a packet.'''
+    runs = []
+    for offset in range(0, len(new), 4):
+        if old[offset:offset+4] == new[offset:offset+4]:
+            continue
+        if runs and offset + 4 - runs[-1][0] <= maxlen:
+            runs[-1] = (runs[-1][0], offset + 4 - runs[-1][0])
+        else:
+            runs.append((offset, 4))
+    return runs
+
+def device_name(kbd):
+    '''A name for this particular keyboard: its USB serial number if it has
+    one, or else where it's plugged in (bus and port path)'''
+    serial = gk64._serial_number(kbd.dev)
+    if serial:
+        return "serial-" + re.sub(r'[^\w.-]', '_', serial)
+    if kbd.port_numbers:
+        return "port-{}-{}".format(kbd.bus, ".".join(str(p) for p in kbd.port_numbers))
+    return "addr-{}-{}".format(kbd.bus, kbd.dev.address)
+
+class KeymapApplier(object):
+    '''Put cfg data on a keyboard.
+
+    All of this is experimental, and refuses to run without
+    experimental=True: the cfg layout is a guess, and the full upload sends
+    it through the bootloader with a 'cfg' header, just like firmware. If
+    the bootloader doesn't take that as a cfg image, it'll write it over
+    the firmware.
+
+    apply() first tries to send only the keys that changed, using the
+    guessed CfgSetKeysCmd/CfgGetKeysCmd (read the warning next to those
+    first). For that we keep a mirror of what's on each keyboard (see
+    device_name) in `mirrordir`; the first time, or with reread=True, the
+    mirror gets read back off the device, and after that apply() just
+    diffs against it. Every write gets read back to check it
+    took. If there's no usable mirror, or anything fails or reads back
+    wrong, it's a full upload after all.
+
+    After apply(): mode is 'incremental', 'full' or 'unchanged'; sent and
+    saved are byte counts; round_trips counts keyboard-mode commands
+    (readback counts the ones spent reading the mirror).
+    '''
+    def __init__(self, kbd, mirrordir=None, experimental=False, window=1,
+                 replytimeout=1000, verbose=True):
+        self.kbd = kbd
+        self.mirrordir = mirrordir if mirrordir is not None else gk64._cache_dir('keymaps')
+        self.experimental = experimental
+        self.window = window
+        self.replytimeout = replytimeout
+        self.verbose = verbose
+        self.log = print if verbose else gk64._quiet
+        self.mode = None
+        self.sent = self.saved = 0
+        self.round_trips = self.readback = 0
+
+    def _mirror_file(self):
+        return os.path.join(self.mirrordir, device_name(self.kbd) + '.cfg')
+
+    def load_mirror(self):
+        '''The cfg data we think is on the device, or None'''
+        try:
+            with open(self._mirror_file(), 'rb') as f:
+                hdr = gk64.BImgHdr._unpack(f.read(gk64.BImgHdr._struct.size))
+                data = f.read()
+        except (OSError, struct.error):
+            return None
+        if hdr.size != len(data) or hdr.datachecksum != gk64.mycrc16(data):
+            return None
+        return data
+
+    def save_mirror(self, data):
+        os.makedirs(self.mirrordir, exist_ok=True)
+        filename = self._mirror_file()
+        hdr = gk64.make_bimg_header(data, imgtype='cfg')
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(hdr._pack() + data)
+        os.replace(filename + '.tmp', filename)
+
+    def _cmd(self, cmd, layer, offset, length, data=None):
+        self.round_trips += 1
+        r = self.kbd.send_cmd(cmd, layer, offset=offset, length=length, data=data,
+                              replytimeout=self.replytimeout)
+        if (r.cmd, r.subcmd) != (cmd, layer) or r.result != 1:
+            raise gk64.CmdError("cmd {:02x}:{:02x} at {:#x} failed".format(cmd, layer, offset), r)
+        return r
+
+    def read_back(self, layers, keys):
+        '''Read `layers` layers of `keys` key values off the device
+        (experimental; see CfgGetKeysCmd)'''
+        size = keys * 4
+        data = [CfgHeaderStruct.pack(layers, keys)]
+        start = self.round_trips
+        try:
+            for layer in range(layers):
+                for offset in range(0, size, 0x38):
+                    length = min(0x38, size - offset)
+                    r = self._cmd(CfgGetKeysCmd, layer, offset, length)
+                    data.append(bytes(r.data[:length]))
+        finally:
+            self.readback += self.round_trips - start
+        return b''.join(data)
+
+    def _write(self, layer, runs, data):
+        for offset, length in runs:
+            chunk = data[offset:offset+length]
+            self._cmd(CfgSetKeysCmd, layer, offset, length, chunk)
+            self.sent += length
+            r = self._cmd(CfgGetKeysCmd, layer, offset, length)
+            if bytes(r.data[:length]) != chunk:
+                raise gk64.CmdError("layer {} at {:#x} didn't read back what "
+                                    "we wrote".format(layer, offset), r)
+
+    def _incremental(self, new, keys, reread):
+        # returns False if there's nothing usable to diff against
+        mirror = None if reread else self.load_mirror()
+        if mirror is None:
+            mirror = self.read_back(len(new), keys)
+            self.log("read the current keymap back ({} round trips)".format(self.readback))
+        try:
+            oldkeys, old = cfg_layers(mirror)
+        except (ValueError, struct.error):
+            return False
+        if oldkeys != keys or len(old) != len(new):
+            return False
+        runs = [changed_runs(o, n) for o, n in zip(old, new)]
+        self.mode = 'incremental' if any(runs) else 'unchanged'
+        for layer, (layer_runs, data) in enumerate(zip(runs, new)):
+            self._write(layer, layer_runs, data)
+        return True
+
+    def upload(self, cfgdata):
+        '''Full upload of cfgdata through the bootloader; returns True if it
+        went through'''
+        if not self.experimental:
+            raise gk64.Error("the cfg image layout is a guess; only sending it "
+                             "with experimental=True (--experimental)")
+        hdr = gk64.make_bimg_header(cfgdata, imgtype='cfg')
+        if not self.kbd.update_firmware(cfgdata, hdr, window=self.window,
+                                        verbose=self.verbose):
+            return False
+        self.sent += hdr.size
+        return True
+
+    def apply(self, cfgdata, reread=False):
+        '''Get cfgdata onto the keyboard; returns True if it went through'''
+        keys, new = cfg_layers(cfgdata)
+        total = len(new) * keys * 4
+        self.sent = self.saved = self.round_trips = self.readback = 0
+        self.mode = 'full'
+        if not self.experimental:
+            raise gk64.Error("the cfg image layout is a guess; only sending it "
+                             "with experimental=True (--experimental)")
+        try:
+            done = self._incremental(new, keys, reread)
+            if not done:
+                self.log("no usable copy of the current keymap, doing a full upload")
+        except (gk64.CmdError, gk64.USBError) as e:
+            done = False
+            self.mode = 'full'
+            self.log("{}, doing a full upload".format(
+                     e.message if isinstance(e, gk64.CmdError) else e))
+        if not done:
+            done = self.upload(cfgdata)
+        if done:
+            self.saved = max(total - self.sent, 0)
+            self.save_mirror(bytes(cfgdata))
+        return done
+
+def load_keymap(filename):
+    with open(filename) as f:
+        keymap = json.load(f)
+    if not isinstance(keymap.get('layers'), list):
+        raise ValueError("{}: doesn't look like a QMK keymap.json".format(filename))
+    return keymap
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK6x keymap compiler')
+    subp = parser.add_subparsers(dest="action", required=True)
+
+    comp = subp.add_parser("compile", help="compile keymap.json into a cfg image")
+    comp.add_argument("keymap", help="QMK Configurator keymap.json")
+    comp.add_argument("outfile", help="cfg image data (w/o header)")
+    comp.add_argument("--header", help="write the image header here too")
+    comp.add_argument("--keys", type=int, default=None,
+                      help="keys per layer (default: the most in any layer)")
+    comp.add_argument("--cache", default=None,
+                      help="compiled layer cache (default: ~/.cache/gk64/layers)")
+
+    apply = subp.add_parser("apply", help="put a keymap on the keyboard")
+    apply.add_argument("keymap", help="QMK Configurator keymap.json")
+    apply.add_argument("--keys", type=int, default=None,
+                       help="keys per layer (default: the most in any layer)")
+    apply.add_argument("--window", type=int, default=1,
+                       help="chunks to send before waiting for a reply (default: %(default)s)")
+    apply.add_argument("--experimental", action="store_true",
+                       help="required: the cfg layout is a guess, and so are the "
+                            "keyboard-mode commands used to send only the keys that "
+                            "changed (0x22 is a real command on BBD8 that nobody's "
+                            "figured out); this could brick your keyboard")
+    apply.add_argument("--reread", action="store_true",
+                       help="read the current keymap back off "
+                            "the keyboard first")
+    apply.add_argument("--mirror", default=None,
+                       help="where to keep the copy of what's on the keyboard "
+                            "(default: ~/.cache/gk64/keymaps)")
+    apply.add_argument("--sim", action="store_true",
+                       help="talk to a simulated keyboard (see gk64sim.py)")
+
+    return parser.parse_args()
+
+def main(args):
+    if args.action == "compile":
+        keymap = load_keymap(args.keymap)
+        compiler = KeymapCompiler(args.keys, args.cache or gk64._cache_dir('layers'))
+        data, hdr = compiler.image(keymap)
+        with open(args.outfile, 'wb') as outf:
+            outf.write(data)
+        if args.header:
+            with open(args.header, 'wb') as hdrf:
+                hdrf.write(hdr._pack())
+        print("{} layers, {} bytes, checksum {:04X} ({} layers from cache)".format(
+              len(keymap['layers']), len(data), hdr.datachecksum, compiler.hits))
+
+    elif args.action == "apply":
+        if not args.experimental:
+            print("error: the cfg image layout is a guess; pass --experimental "
+                  "to send it anyway")
+            raise SystemExit(1)
+        transport = None
+        if args.sim:
+            import gk64sim
+            transport = gk64sim.SimTransport()
+        data = KeymapCompiler(args.keys, gk64._cache_dir('layers')).compile(
+                   load_keymap(args.keymap))
+        kbd = gk64.GK64(transport=transport)
+        if kbd.dev is None:
+            raise gk64.USBError("No device found", errno=19)
+        applier = KeymapApplier(kbd, args.mirror, experimental=args.experimental,
+                                window=args.window)
+        if not applier.apply(data, reread=args.reread):
+            print("keymap upload failed")
+            raise SystemExit(1)
+        print("{} upload: sent {} bytes, saved {} bytes, {} round trips "
+              "({} reading it back)".format(applier.mode, applier.sent, applier.saved,
+                                            applier.round_trips, applier.readback))
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except ValueError as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except gk64.CmdError as e:
+        print("error: {}".format(e.message))
+        raise SystemExit(1)
+    except gk64.Error as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except OSError as e:
+        print(e)
+        raise SystemExit(e.errno or 1)
@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+# gk64light.py - per-key lighting animations -> 'le' (CMF1 LIGHT) images
+#
+#   ./gk64light.py compile rainbow.json rainbow.le --header rainbow.le.hdr
+#   ./gk64light.py upload --experimental rainbow.json
+#   ./gk64light.py info rainbow.le
+#
+# An animation is a JSON file of color tracks, one per key (or range of
+# keys), that get interpolated and sampled at `fps`:
+#
+#   {"keys": 87, "fps": 30, "length": 2000, "default": "#000000",
+#    "tracks": {"0":     [[0, "#ff0000"], [1000, "#0000ff"], [2000, "#ff0000"]],
+#               "10-20": [[0, "#000000"], [500, "#ffffff"]]}}
+#
+# Times are in ms. Before a track's first point a key holds that color, and
+# after its last point it holds that one.
+#
+# BIG FAT WARNING, same as gk64keymap.py: the real 'le' layout is unknown.
+# This is a made-up container that's easy for firmware to play back:
+#
+#   header:   u16 version, u16 keys, u16 steps, u16 blocks
+#   steps:    (u16 block, u16 duration ms) each - the timeline
+#   blocks:   u8 kind, pad, u16 base, u16 payload length, then the payload
+#     kind 0: a full frame, keys * (r, g, b)
+#     kind 1: a delta against block `base`: runs of (u16 first key,
+#             u16 count, count * (r, g, b))
+#
+# Identical frames are stored once (repeats in a row just make the step
+# longer), and each new frame is stored as a delta against the one before
+# it whenever that's smaller. Smooth animations mostly come out as deltas.
+#
+# Uploading goes through the same CDBOOT 2,1/2,2/2,3 sequence as firmware,
+# with a CMF1 header from make_bimg_header(imgtype='le'), which is also a
+# guess until someone captures the official tool doing it. Since nobody
+# knows what the bootloader does with an image it doesn't understand,
+# upload refuses to send anything without --experimental.
+#
+# NumPy gets used for sampling and diffing frames if it's there; without
+# it there's a plain Python version that does the same thing, just slower.
+
+import re
+import json
+import struct
+import bisect
+import hashlib
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import gk64
+
+LeFormatVersion = 1
+LeHeaderStruct = struct.Struct("<HHHH")
+LeStepStruct = struct.Struct("<HH")
+LeBlockStruct = struct.Struct("<BxHH")
+LeRunStruct = struct.Struct("<HH")
+LeFullFrame = 0
+LeDeltaFrame = 1
+LeMaxDuration = 0xffff
+
+def parse_color(color):
+    '''"#rrggbb", "rrggbb", 0xrrggbb or [r, g, b] -> (r, g, b)'''
+    if isinstance(color, str):
+        m = re.match(r'^#?([0-9a-fA-F]{6})$', color.strip())
+        if not m:
+            raise ValueError("bad color {!r}".format(color))
+        color = int(m.group(1), 16)
+    if isinstance(color, int):
+        if not 0 <= color <= 0xffffff:
+            raise ValueError("bad color {:#x}".format(color))
+        return (color >> 16, (color >> 8) & 0xff, color & 0xff)
+    if len(color) != 3 or not all(0 <= int(c) <= 0xff for c in color):
+        raise ValueError("bad color {!r}".format(color))
+    return tuple(int(c) for c in color)
+
+def parse_keys(spec, keys):
+    '''"5" or "5-10" (inclusive) or "all" -> range of key indexes'''
+    if spec == "all":
+        return range(keys)
+    m = re.match(r'^(\d+)(?:-(\d+))?$', str(spec).strip())
+    if not m:
+        raise ValueError("bad key spec {!r}".format(spec))
+    first = int(m.group(1))
+    last = int(m.group(2)) if m.group(2) else first
+    if first > last or last >= keys:
+        raise ValueError("keys {!r} out of range (have {})".format(spec, keys))
+    return range(first, last + 1)
+
+class Animation(object):
+    '''A parsed animation: keys, fps, length (ms), default color, and
+    tracks, a list of (key range, [(ms, (r, g, b)), ...]) sorted by time'''
+    def __init__(self, keys, fps=30, length=1000, default=(0, 0, 0), tracks=()):
+        if not 0 < keys <= 0x5555:
+            raise ValueError("can't do {} keys".format(keys))
+        if not 0 < fps <= 1000:
+            raise ValueError("fps should be 1-1000")
+        if length <= 0:
+            raise ValueError("length should be > 0")
+        self.keys = keys
+        self.fps = fps
+        self.length = length
+        self.default = default
+        self.tracks = [(keyrange, sorted(points)) for keyrange, points in tracks]
+
+    @classmethod
+    def from_json(cls, obj):
+        keys = int(obj['keys'])
+        tracks = []
+        for spec, points in obj.get('tracks', {}).items():
+            if not points:
+                raise ValueError("track {!r} has no points".format(spec))
+            tracks.append((parse_keys(spec, keys),
+                           [(float(t), parse_color(c)) for t, c in points]))
+        return cls(keys, float(obj.get('fps', 30)), int(obj.get('length', 1000)),
+                   parse_color(obj.get('default', 0)), tracks)
+
+    def times(self):
+        '''Sample times (ms) and how long each sample is shown (ms)'''
+        count = max(1, int(round(self.length * self.fps / 1000.0)))
+        starts = [int(round(i * 1000.0 / self.fps)) for i in range(count + 1)]
+        starts[-1] = max(starts[-1], self.length)
+        return starts[:-1], [b - a for a, b in zip(starts, starts[1:])]
+
+def _interp(points, t):
+    idx = bisect.bisect_right(points, (t, (256, 256, 256)))
+    if idx == 0:
+        return points[0][1]
+    if idx == len(points):
+        return points[-1][1]
+    (t0, c0), (t1, c1) = points[idx-1], points[idx]
+    f = (t - t0) / (t1 - t0)
+    # round half up, same as the numpy version does
+    return tuple(int(a + (b - a) * f + 0.5) for a, b in zip(c0, c1))
+
+def sample_frames(anim, times):
+    '''Render anim at each of times (ms): a list of keys*3-byte RGB frames'''
+    keys = anim.keys
+    if numpy is not None:
+        frames = numpy.empty((len(times), keys, 3), dtype=numpy.uint8)
+        frames[:] = anim.default
+        t = numpy.asarray(times, dtype=numpy.float64)
+        for keyrange, points in anim.tracks:
+            pt = numpy.array([p[0] for p in points], dtype=numpy.float64)
+            colors = numpy.empty((len(times), 3), dtype=numpy.uint8)
+            for ch in range(3):
+                pc = numpy.array([p[1][ch] for p in points], dtype=numpy.float64)
+                colors[:, ch] = numpy.floor(numpy.interp(t, pt, pc) + 0.5)
+            frames[:, keyrange.start:keyrange.stop] = colors[:, None, :]
+        return [f.tobytes() for f in frames]
+
+    blank = bytes(anim.default) * keys
+    frames = [bytearray(blank) for _ in times]
+    for keyrange, points in anim.tracks:
+        span = slice(keyrange.start * 3, keyrange.stop * 3)
+        for frame, t in zip(frames, times):
+            frame[span] = bytes(_interp(points, t)) * len(keyrange)
+    return [bytes(f) for f in frames]
+
+def changed_runs(old, new):
+    '''(first key, count) runs of keys whose color differs between two
+    frames. Runs a single unchanged key apart get merged, since a run
+    header costs more than resending one color.'''
+    if numpy is not None:
+        a = numpy.frombuffer(old, dtype=numpy.uint8).reshape(-1, 3)
+        b = numpy.frombuffer(new, dtype=numpy.uint8).reshape(-1, 3)
+        changed = numpy.flatnonzero((a != b).any(axis=1)).tolist()
+    else:
+        changed = [k for k in range(len(new) // 3)
+                   if old[k*3:k*3+3] != new[k*3:k*3+3]]
+    runs = []
+    for key in changed:
+        if runs and key - (runs[-1][0] + runs[-1][1]) <= 1:
+            runs[-1] = (runs[-1][0], key + 1 - runs[-1][0])
+        else:
+            runs.append((key, 1))
+    return runs
+
+def encode_delta(old, new):
+    out = []
+    for first, count in changed_runs(old, new):
+        out.append(LeRunStruct.pack(first, count))
+        out.append(new[first*3:(first+count)*3])
+    return b''.join(out)
+
+class LightEncoder(object):
+    '''Turns frames into 'le' image data, deduplicating and delta-encoding.
+
+    After encode(): steps is the timeline length, full/deltas count the
+    kinds of block stored, and rawsize is what the frames would've taken
+    with neither trick.
+    '''
+    def __init__(self):
+        self.steps = self.full = self.deltas = self.rawsize = 0
+
+    def encode(self, keys, frames, durations):
+        steps = []      # [block, duration]
+        blocks = []     # encoded blocks
+        index = dict()  # frame bytes -> block
+        prev = None
+        for frame, duration in zip(frames, durations):
+            block = index.get(frame)
+            if block is None:
+                block = index[frame] = len(blocks)
+                delta = encode_delta(prev, frame) if prev is not None else None
+                if delta is not None and len(delta) < len(frame):
+                    blocks.append(LeBlockStruct.pack(LeDeltaFrame, block - 1, len(delta)) + delta)
+                else:
+                    blocks.append(LeBlockStruct.pack(LeFullFrame, 0, len(frame)) + frame)
+                prev = frame
+            if steps and steps[-1][0] == block and steps[-1][1] + duration <= LeMaxDuration:
+                steps[-1][1] += duration
+                continue
+            while duration > LeMaxDuration:
+                steps.append([block, LeMaxDuration])
+                duration -= LeMaxDuration
+            steps.append([block, duration])
+        if len(steps) > 0xffff or len(blocks) > 0xffff:
+            raise ValueError("animation too long ({} steps, {} frames)".format(
+                             len(steps), len(blocks)))
+
+        self.steps = len(steps)
+        self.full = sum(1 for b in blocks if b[0] == LeFullFrame)
+        self.deltas = len(blocks) - self.full
+        self.rawsize = LeHeaderStruct.size + len(frames) * (LeStepStruct.size + keys * 3)
+        return b''.join([LeHeaderStruct.pack(LeFormatVersion, keys, len(steps), len(blocks))] +
+                        [LeStepStruct.pack(*step) for step in steps] + blocks)
+
+    def compile(self, anim):
+        '''Animation -> 'le' image data'''
+        times, durations = anim.times()
+        return self.encode(anim.keys, sample_frames(anim, times), durations)
+
+    def image(self, anim, ts=None):
+        '''Animation -> (image data, BImgHdr)'''
+        data = self.compile(anim)
+        return data, gk64.make_bimg_header(data, ts=ts, imgtype='le')
+
+def decode_le(data):
+    ''''le' image data -> (keys, [(frame, duration ms), ...]); mostly for
+    checking the encoder, but it's also what firmware would have to do'''
+    version, keys, nsteps, nblocks = LeHeaderStruct.unpack_from(data)
+    if version != LeFormatVersion:
+        raise ValueError("unknown le format version {}".format(version))
+    pos = LeHeaderStruct.size
+    steps = [LeStepStruct.unpack_from(data, pos + i * LeStepStruct.size)
+             for i in range(nsteps)]
+    pos += nsteps * LeStepStruct.size
+    frames = []
+    for num in range(nblocks):
+        kind, base, size = LeBlockStruct.unpack_from(data, pos)
+        pos += LeBlockStruct.size
+        payload = bytes(data[pos:pos+size])
+        pos += size
+        if kind == LeFullFrame:
+            if size != keys * 3:
+                raise ValueError("block {}: full frame is {} bytes".format(num, size))
+            frames.append(payload)
+        elif kind == LeDeltaFrame and base < num:
+            frame = bytearray(frames[base])
+            rpos = 0
+            while rpos < size:
+                first, count = LeRunStruct.unpack_from(payload, rpos)
+                rpos += LeRunStruct.size
+                frame[first*3:(first+count)*3] = payload[rpos:rpos+count*3]
+                rpos += count * 3
+            frames.append(bytes(frame))
+        else:
+            raise ValueError("block {}: bad kind {} / base {}".format(num, kind, base))
+    if pos != len(data):
+        raise ValueError("{} bytes of junk after the last block".format(len(data) - pos))
+    return keys, [(frames[block], duration) for block, duration in steps]
+
+class LightUploader(object):
+    '''Puts animations on a keyboard, keeping the compiled images (and their
+    encoded packet streams) around, so flipping back and forth between a few
+    animations only costs the transfer.
+
+    The le container is made up (see the top of this file), so upload()
+    won't send anything to a real keyboard unless experimental=True.
+    '''
+    def __init__(self, kbd, window=8, experimental=False, verbose=True):
+        self.kbd = kbd
+        self.window = window
+        self.experimental = experimental
+        self.verbose = verbose
+        self.encoder = LightEncoder()
+        self.images = dict()  # sha256 of the animation JSON -> (data, hdr, stream)
+
+    def prepare(self, obj):
+        '''Animation JSON (parsed) -> (data, hdr, stream), compiling if needed'''
+        key = hashlib.sha256(json.dumps(obj, sort_keys=True).encode('utf8')).digest()
+        image = self.images.get(key)
+        if image is None:
+            data, hdr = self.encoder.image(Animation.from_json(obj))
+            stream = gk64.encode_packet_stream(data)
+            image = self.images[key] = (data, hdr, stream)
+        return image
+
+    def upload(self, obj):
+        '''Compile (or reuse) and send an animation; returns the image size'''
+        if not self.experimental:
+            raise gk64.Error("the le image layout is a guess; only sending it "
+                             "with experimental=True (--experimental)")
+        data, hdr, stream = self.prepare(obj)
+        if not self.kbd.update_firmware(data, hdr, window=self.window,
+                                        verbose=self.verbose, stream=stream):
+            raise gk64.Error("le upload failed")
+        return len(data)
+
+def load_animation(filename):
+    with open(filename) as f:
+        obj = json.load(f)
+    if not isinstance(obj, dict) or 'keys' not in obj:
+        raise ValueError("{}: doesn't look like an animation".format(filename))
+    return obj
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK6x lighting effect compiler')
+    subp = parser.add_subparsers(dest="action", required=True)
+
+    comp = subp.add_parser("compile", help="compile an animation into an le image")
+    comp.add_argument("animation", help="animation JSON")
+    comp.add_argument("outfile", help="le image data (w/o header)")
+    comp.add_argument("--header", help="write the image header here too")
+
+    info = subp.add_parser("info", help="describe an le image")
+    info.add_argument("infile", help="le image data (w/o header)")
+
+    upload = subp.add_parser("upload", help="compile an animation and send it")
+    upload.add_argument("animation", help="animation JSON")
+    upload.add_argument("--experimental", action="store_true",
+                        help="required: the le layout is made up, and nobody knows "
+                             "what the bootloader does with one it doesn't like")
+    upload.add_argument("--window", type=int, default=8,
+                        help="chunks in flight at once (default: %(default)s)")
+    upload.add_argument("--sim", action="store_true",
+                        help="talk to a simulated keyboard (see gk64sim.py)")
+
+    return parser.parse_args()
+
+def main(args):
+    if args.action == "compile":
+        encoder = LightEncoder()
+        data, hdr = encoder.image(Animation.from_json(load_animation(args.animation)))
+        with open(args.outfile, 'wb') as outf:
+            outf.write(data)
+        if args.header:
+            with open(args.header, 'wb') as hdrf:
+                hdrf.write(hdr._pack())
+        print("{} steps, {} full + {} delta frames, {} bytes ({} uncompressed), "
+              "checksum {:04X}".format(encoder.steps, encoder.full, encoder.deltas,
+                                       len(data), encoder.rawsize, hdr.datachecksum))
+
+    elif args.action == "info":
+        with open(args.infile, 'rb') as f:
+            keys, steps = decode_le(f.read())
+        print("{} keys, {} steps, {} unique frames, {} ms".format(
+              keys, len(steps), len(set(frame for frame, _ in steps)),
+              sum(duration for _, duration in steps)))
+
+    elif args.action == "upload":
+        if not args.experimental:
+            print("error: the le image layout is a guess; pass --experimental "
+                  "to send it anyway")
+            raise SystemExit(1)
+        transport = None
+        if args.sim:
+            import gk64sim
+            transport = gk64sim.SimTransport()
+        kbd = gk64.GK64(transport=transport)
+        if kbd.dev is None:
+            raise gk64.USBError("No device found", errno=19)
+        uploader = LightUploader(kbd, args.window, experimental=args.experimental)
+        size = uploader.upload(load_animation(args.animation))
+        print("sent {} byte le image".format(size))
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except (ValueError, KeyError, struct.error) as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except gk64.CmdError as e:
+        print("error: {}".format(e.message))
+        raise SystemExit(1)
+    except gk64.Error as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except OSError as e:
+        print(e)
+        raise SystemExit(e.errno or 1)
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+# gk64session.py - keep the keyboard open in a long-lived session server
+#
+# Every run of gk64.py has to import pyusb, find the device, detach the
+# kernel driver and look up endpoints before it can send anything. If you're
+# running `cmd`/`peek` hundreds of times in a row, that's most of the time.
+# So instead:
+#
+#   ./gk64session.py serve &          # opens the keyboard once, keeps it
+#   ./gk64session.py cmd 1 1          # thin client: no pyusb, one round trip
+#   ./gk64session.py peek 2a00
+#   ./gk64session.py batch < requests.jsonl
+#
+# The protocol is one JSON object per line over a Unix socket, both ways:
+#
+#   {"op": "cmd", "cmd": 1, "subcmd": 1}
+#   {"ok": true, "reply": {"cmd": 1, ..., "data": "0139..."}, "hexdump": "..."}
+#
+# Ops: ping, cmd, peek, dump, fwup, stats, and batch (a list of any of the others,
+# done back-to-back without letting other clients in between). Requests from
+# all clients go through one queue, so they never step on each other.
+#
+# `serve --trace` keeps a gk64trace.Tracer on the keyboard (stats only, no
+# events), and `stats` fetches its latency histograms and counters.
+#
+# Only the server imports gk64 (and so pyusb); the client side of this file
+# sticks to the standard library.
+
+import os
+import sys
+import json
+import errno
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+
+def default_socket_path():
+    rundir = os.environ.get("XDG_RUNTIME_DIR")
+    if rundir:
+        return os.path.join(rundir, "gk64.sock")
+    return "/tmp/gk64-{}.sock".format(os.getuid())
+
+class SessionError(Exception):
+    '''Raised by SessionClient when the server says a request failed'''
+    pass
+
+# --- server side ---
+
+class DeviceWorker(object):
+    '''Owns the GK64 and runs queued requests against it, one at a time'''
+    def __init__(self, transport=None, tracer=None):
+        import gk64
+        self.gk64 = gk64
+        self.transport = transport
+        self.tracer = tracer
+        self.kbd = None
+        self.requests = queue.Queue()
+        self.handled = 0
+        self.thread = threading.Thread(target=self._run, name="gk64-session",
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        '''Queue a request; blocks until it's done and returns the response'''
+        done = threading.Event()
+        slot = dict()
+        self.requests.put((request, slot, done))
+        done.wait()
+        return slot['response']
+
+    def _run(self):
+        while True:
+            request, slot, done = self.requests.get()
+            slot['response'] = self.handle(request)
+            self.handled += 1
+            done.set()
+
+    def _device(self):
+        if self.kbd is None:
+            self.kbd = self.gk64.GK64(transport=self.transport)
+            if self.tracer is not None:
+                self.tracer.attach(self.kbd)
+        if self.kbd.dev is None and not self.kbd.find_dev():
+            raise self.gk64.USBError("No device found", errno=19)
+        return self.kbd
+
+    def handle(self, request):
+        try:
+            if request.get('op') == 'batch':
+                return dict(ok=True, responses=[self.handle(r)
+                                                for r in request.get('requests', [])])
+            op = getattr(self, 'op_' + str(request.get('op')), None)
+            if op is None:
+                raise ValueError("unknown op {!r}".format(request.get('op')))
+            response = op(request)
+            response['ok'] = True
+            return response
+        except self.gk64.CmdError as e:
+            return dict(ok=False, error=e.message, reply=self._reply(e.reply))
+        except Exception as e:
+            if isinstance(e, self.gk64.USBError) and e.errno == 19:
+                # device went away; find it again next time
+                self.kbd = None
+            return dict(ok=False, error=str(e) or e.__class__.__name__)
+
+    @staticmethod
+    def _reply(r):
+        if r is None:
+            return None
+        reply = r._asdict()
+        reply['data'] = bytes(r.data).hex()
+        return reply
+
+    def op_ping(self, request):
+        kbd = self._device()
+        return dict(device=repr(kbd.dev), handled=self.handled)
+
+    def op_stats(self, request):
+        if self.tracer is None:
+            raise ValueError("not tracing (start the server with --trace)")
+        return dict(stats=self.tracer.stats())
+
+    def op_cmd(self, request):
+        kbd = self._device()
+        data = bytes.fromhex(request.get('data', ''))
+        r = kbd.send_cmd(int(request['cmd']), int(request['subcmd']),
+                         offset=int(request.get('offset', 0)),
+                         length=int(request.get('length', len(data))),
+                         data=data, replytimeout=request.get('timeout'))
+        return dict(reply=self._reply(r), hexdump=r._hexdump())
+
+    def op_peek(self, request):
+        kbd = self._device()
+        addr = int(request['addr'])
+        size = int(request.get('size', 0x38))
+        data = kbd.read_memory([(addr, addr + size)])
+        return dict(data=data.hex(),
+                    hexdump='\n'.join(self.gk64.hexdump_iterlines(data, addr)))
+
+    def op_dump(self, request):
+        kbd = self._device()
+        dumper = self.gk64.MemoryDumper(kbd, int(request['start']), int(request['end']),
+                                        request['outfile'],
+                                        window=int(request.get('window', 8)))
+        count = dumper.run(resume=not request.get('restart'), progress=False)
+        return dict(bytes=count, elapsed=dumper.elapsed)
+
+    def op_fwup(self, request):
+        kbd = self._device()
+        gk64 = self.gk64
+        bindata = gk64.binfile_read(request['binfile'])
+        hdr = None
+        if request.get('header'):
+            with open(request['header'], 'rb') as hdrf:
+                hdr = gk64.BImgHdr._unpack(hdrf.read(0x20))
+        ok = kbd.update_firmware(bindata, hdr, window=int(request.get('window', 1)),
+                                 verbose=False)
+        if not ok:
+            raise gk64.Error("couldn't switch to CDBOOT mode")
+        return dict(size=len(bindata))
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = dict(ok=False, error="bad request: {}".format(e))
+            else:
+                response = self.server.worker.submit(request)
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+            self.wfile.flush()
+
+class SessionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, worker):
+        if os.path.exists(path):
+            # a leftover from a server that died, unless someone answers
+            if socket_in_use(path):
+                raise OSError(errno.EADDRINUSE,
+                              "a session server is already running on {}".format(path))
+            os.unlink(path)
+        self.worker = worker
+        socketserver.UnixStreamServer.__init__(self, path, SessionHandler)
+        os.chmod(path, 0o600)
+
+def socket_in_use(path):
+    '''True if something is accepting connections on the Unix socket at path'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def serve(path, transport=None, tracer=None):
+    # bind first, so that if there's a server running already we find out
+    # before grabbing the keyboard out from under it
+    server = SessionServer(path, None)
+    try:
+        server.worker = DeviceWorker(transport, tracer)
+        print("serving on {}".format(path), flush=True)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+# --- client side ---
+
+class SessionClient(object):
+    '''Talks to a running session server. One connection, reused.'''
+    def __init__(self, path=None):
+        self.path = path or default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, op, **kwargs):
+        '''Send one request; returns the response, raises SessionError on failure'''
+        kwargs['op'] = op
+        response = self.raw([kwargs])[0]
+        if not response.get('ok'):
+            raise SessionError(response.get('error'))
+        return response
+
+    def batch(self, requests):
+        '''Run a list of requests back to back; returns the list of responses'''
+        return self.request('batch', requests=list(requests))['responses']
+
+    def raw(self, requests):
+        '''Send some requests as-is and return their responses, in order'''
+        self.sock.sendall(b''.join(json.dumps(r).encode('utf8') + b'\n'
+                                   for r in requests))
+        return [json.loads(self.rfile.readline()) for _ in requests]
+
+def hexint(s):
+    return int(s, 16)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GK6x session server/client')
+    parser.add_argument("--socket", default=default_socket_path(),
+                        help="socket path (default: %(default)s)")
+    subp = parser.add_subparsers(dest="action", required=True)
+
+    srv = subp.add_parser("serve", help="open the keyboard and serve requests")
+    srv.add_argument("--sim", action="store_true",
+                     help="serve a simulated keyboard (see gk64sim.py)")
+    srv.add_argument("--trace", action="store_true",
+                     help="keep latency stats (see gk64trace.py)")
+
+    subp.add_parser("ping", help="check the server and device are alive")
+    subp.add_parser("stats", help="show latency stats (server needs --trace)")
+
+    cmd = subp.add_parser("cmd", help="send command packet")
+    cmd.add_argument("cmd", type=int, help="command number")
+    cmd.add_argument("sub", type=int, help="sub-command number")
+
+    peek = subp.add_parser("peek", help="* peek at a memory address")
+    peek.add_argument("addr", type=hexint, help="memory address to peek at")
+    peek.add_argument("--size", type=hexint, default=0x38, help="bytes to read (hex)")
+
+    dump = subp.add_parser("dump", help="* dump memory to a file")
+    dump.add_argument("start", type=hexint, help="start address")
+    dump.add_argument("end", type=hexint, help="end address")
+    dump.add_argument("outfile", help="output filename")
+    dump.add_argument("--window", type=int, default=8)
+
+    fwup = subp.add_parser("fwup", help="send a firmware update")
+    fwup.add_argument("binfile", help="firmware binary (w/o header)")
+    fwup.add_argument("--header", help="firmware header")
+    fwup.add_argument("--window", type=int, default=1)
+
+    subp.add_parser("batch", help="run JSON requests from stdin (one per line) as one batch")
+
+    return parser.parse_args()
+
+def main(args):
+    if args.action == "serve":
+        transport = None
+        if args.sim:
+            import gk64sim
+            transport = gk64sim.SimTransport()
+        tracer = None
+        if args.trace:
+            import gk64trace
+            tracer = gk64trace.Tracer(max_events=0)
+        serve(args.socket, transport, tracer)
+        return
+
+    with SessionClient(args.socket) as client:
+        if args.action == "ping":
+            print(client.request("ping")['device'])
+        elif args.action == "stats":
+            # as JSON; `gk64trace.py` can summarize it if you save it
+            print(json.dumps(client.request("stats")['stats'], indent=1))
+        elif args.action == "cmd":
+            print(client.request("cmd", cmd=args.cmd, subcmd=args.sub)['hexdump'])
+        elif args.action == "peek":
+            print(client.request("peek", addr=args.addr, size=args.size)['hexdump'])
+        elif args.action == "dump":
+            r = client.request("dump", start=args.start, end=args.end,
+                               outfile=os.path.abspath(args.outfile),
+                               window=args.window)
+            print("read {} bytes in {:.2f}s".format(r['bytes'], r['elapsed']))
+        elif args.action == "fwup":
+            client.request("fwup", binfile=os.path.abspath(args.binfile),
+                           header=args.header and os.path.abspath(args.header),
+                           window=args.window)
+            print("firmware updated successfully! have fun!!!!")
+        elif args.action == "batch":
+            requests = [json.loads(line) for line in sys.stdin if line.strip()]
+            for response in client.batch(requests):
+                print(json.dumps(response))
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        raise SystemExit(1)
+    except SessionError as e:
+        print("error: {}".format(e))
+        raise SystemExit(1)
+    except OSError as e:
+        print(e)
+        raise SystemExit(e.errno or 1)
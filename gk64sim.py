@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+# gk64sim.py - a pretend GK6x keyboard, so we can poke at gk64.py without one
+#
+# This implements just enough of the device side of the protocol described
+# in gk64.py to exercise everything GK64 does:
+#
+# * keyboard mode (SemitekVendor/GK64Product, interface 1, EP 4 out/3 in):
+#   * 1,1 returns a firmware id, 1,2 returns some info
+#   * 3,1 / 3,2 reset into keyboard / CDBOOT mode (the device goes away and
+#     comes back with a different product id, just like the real thing)
+#   * 4,1 is the haxed memory read (see GK64.read_memory_hax)
+# * CDBOOT mode (WeltrendVendor/CDBootProduct, interface 0, EP 2 out/1 in):
+#   * 2,1 .bimg header (the first one gets no reply, see cdboot_send_firmware)
+#   * 2,2 firmware chunk, written to flash at fw_base_addr + offset
+#   * 2,3 final packet, 2,5 version signature
+#
+# Packets with a bad CRC get dropped, like the firmware does. Memory is
+# backed by the dumps in dump/. Every transfer can be given some latency and
+# jitter, and packets can be randomly dropped/NAKed/corrupted, so you can see
+# what retries and pipelining actually buy you.
+#
+# Usage:
+#
+#   sim = SimTransport(latency=0.001, turnaround=0.002)
+#   kbd = GK64(transport=sim)
+#
+# or `./gk64.py --sim <command>` to do the same thing from the command line.
+
+import os
+import time
+import array
+import random
+import threading
+from collections import deque
+
+from usb.core import USBError
+
+import gk64
+from gk64 import CommandPacket, ReplyPacket, BImgHdr
+from gk64keymap import CfgSetKeysCmd, CfgGetKeysCmd
+
+DUMPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dump")
+
+# (base, size, backing file, fill byte) - see the memory map at the top of
+# disasm/BBD8.disasm
+SimMemoryMap = [
+    (0x000000, 0x10000, "BBD8-dump.flash", 0xff),    # Flash
+    (0x100000, 0x02000, None, 0x00),                 # SRAM
+    (0x400000, 0x02000, "BBD8-bootrom.flash", 0xff), # Boot ROM
+]
+
+class SimEndpoint(object):
+    def __init__(self, address):
+        self.bEndpointAddress = address
+    def __repr__(self):
+        return "<{} {:#04x}>".format(self.__class__.__name__, self.bEndpointAddress)
+
+class _SimInterface(object):
+    def __init__(self, endpoints):
+        self._endpoints = endpoints
+    def endpoints(self):
+        return self._endpoints
+
+class _SimConfig(object):
+    def __init__(self, interfaces):
+        self._interfaces = interfaces
+    def __getitem__(self, key):
+        return self._interfaces[key]
+
+class SimDevice(object):
+    '''A handle to the simulated keyboard, quacking like a usb.core.Device
+
+    Each re-enumeration creates a new handle; old ones raise ENODEV.
+    '''
+    def __init__(self, sim, generation):
+        self.sim = sim
+        self.generation = generation
+        self.idVendor, self.idProduct, iface, ep_in, ep_out = sim.mode_info()
+        self.bus = sim.bus
+        self.address = sim.address
+        self.port_numbers = sim.port_numbers
+        self._config = _SimConfig({(iface,0): _SimInterface(
+                                   (SimEndpoint(ep_in), SimEndpoint(ep_out)))})
+
+    def __repr__(self):
+        return "<{} {:04x}:{:04x} bus {} addr {}>".format(
+               self.__class__.__name__, self.idVendor, self.idProduct,
+               self.bus, self.address)
+
+    def __getitem__(self, idx):
+        if idx != 0:
+            raise IndexError(idx)
+        return self._config
+
+    def is_kernel_driver_active(self, iface):
+        self.sim.check_handle(self)
+        return False
+
+    def detach_kernel_driver(self, iface):
+        self.sim.check_handle(self)
+
+    def write(self, endpoint, data, timeout=None):
+        return self.sim.write(self, endpoint, data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        return self.sim.read(self, endpoint, size_or_buffer, timeout)
+
+class SimKeyboard(object):
+    '''The device itself: modes, memory, and the queue of pending replies
+
+    Latency model (all times in seconds):
+        latency     - host-side cost of each write() and read() transfer
+        jitter      - up to this much extra, uniformly random, per transfer
+        turnaround  - device time to handle one packet; packets are handled
+                      one at a time, in order, but that overlaps with the
+                      host sending more of them
+        reenumerate - how long the device is gone after a mode switch
+    Fault injection (probabilities, per packet):
+        drop_rate    - packet silently vanishes (-> reply timeout)
+        nak_rate     - firmware chunk gets result=0
+        corrupt_rate - reply comes back with a bad checksum
+    Bootloader behavior:
+        erase_on_header - accepting a 2,1 header erases the whole image
+                          area first (so chunks that don't get sent come
+                          out as 0xff); turn it off to model a bootloader
+                          that only rewrites what it's sent
+    Keymap: with keymap_cmds=True, the guessed CfgSetKeysCmd/CfgGetKeysCmd
+    from gk64keymap work on keymap_layers x keymap_size bytes of key values
+    (zeroed at startup, kept across resets), so KeymapApplier's experimental
+    path has something to talk to. That's the guess agreeing with itself
+    and says nothing about the real firmware, so it's off by default and
+    those commands get NAKed like anything else the sim doesn't know.
+    '''
+    KeyboardMode = 'keyboard'
+    CDBootMode = 'cdboot'
+
+    def __init__(self, bus=1, address=1, port=None, fwid=b'\x01\x39\x10\x02\x09\x01',
+                 latency=0.0, jitter=0.0, turnaround=0.0, reenumerate=0.5,
+                 drop_rate=0.0, nak_rate=0.0, corrupt_rate=0.0,
+                 default_timeout=1000, seed=None, erase_on_header=True,
+                 keymap_cmds=False, keymap_layers=8, keymap_size=0x400):
+        self.bus = bus
+        self.address = address
+        # the port path stays put when we re-enumerate; the address doesn't
+        self.port_numbers = (port if port is not None else address,)
+        self.fwid = fwid
+        self.latency = latency
+        self.jitter = jitter
+        self.turnaround = turnaround
+        self.reenumerate = reenumerate
+        self.drop_rate = drop_rate
+        self.nak_rate = nak_rate
+        self.corrupt_rate = corrupt_rate
+        self.default_timeout = default_timeout
+        self.erase_on_header = erase_on_header
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.memory = self._load_memory()
+        self.keymap_cmds = keymap_cmds
+        self.keymap = [bytearray(keymap_size) for _ in range(keymap_layers)]
+        self.mode = self.KeyboardMode
+        self.generation = 0
+        self.gone_until = 0.0
+        self.reset_at = None
+        self.reset_mode = None
+        self.replies = deque()  # (ready_time, reply bytes)
+        self.busy_until = 0.0
+        self.hdr = None
+        self.hdr_count = 0
+        self.stats = dict(writes=0, reads=0, timeouts=0, dropped=0,
+                          naks=0, corrupted=0, resets=0)
+
+    def __repr__(self):
+        return "<{} {} bus {} addr {}>".format(self.__class__.__name__,
+                                               self.mode, self.bus, self.address)
+
+    @staticmethod
+    def _load_memory():
+        memory = []
+        for base, size, filename, fill in SimMemoryMap:
+            mem = bytearray([fill]) * size
+            if filename:
+                with open(os.path.join(DUMPDIR, filename), 'rb') as f:
+                    data = f.read(size)
+                mem[:len(data)] = data
+            memory.append((base, mem))
+        return memory
+
+    def mem_region(self, addr):
+        for base, mem in self.memory:
+            if base <= addr < base + len(mem):
+                return base, mem
+        return None, None
+
+    def peek(self, addr, size):
+        '''Read memory the way the haxed cmd 4,1 does (unmapped reads as 0)'''
+        data = bytearray(size)
+        for i in range(size):
+            base, mem = self.mem_region(addr+i)
+            if mem is not None:
+                data[i] = mem[addr+i-base]
+        return bytes(data)
+
+    def poke(self, addr, data):
+        base, mem = self.mem_region(addr)
+        if mem is None or addr + len(data) > base + len(mem):
+            raise ValueError("can't write {} bytes at {:#x}".format(len(data), addr))
+        mem[addr-base:addr-base+len(data)] = data
+
+    @property
+    def flash(self):
+        return self.memory[0][1]
+
+    def mode_info(self):
+        '''Returns (idVendor, idProduct, iface, ep_in, ep_out) for this mode'''
+        if self.mode == self.KeyboardMode:
+            return (gk64.GK64.SemitekVendor, gk64.GK64.GK64Product, 1, 0x83, 0x04)
+        return (gk64.GK64.WeltrendVendor, gk64.GK64.CDBootProduct, 0, 0x81, 0x02)
+
+    # --- bus side ---
+
+    def _transfer_delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _tick(self):
+        if self.reset_at is not None and time.monotonic() >= self.reset_at:
+            self.reset(self.reset_mode, self.reset_at)
+
+    def present(self):
+        self._tick()
+        return time.monotonic() >= self.gone_until
+
+    def handle(self):
+        '''Returns a new SimDevice, or None if we're off re-enumerating'''
+        if not self.present():
+            return None
+        return SimDevice(self, self.generation)
+
+    def check_handle(self, dev):
+        if dev.generation != self.generation or not self.present():
+            raise USBError("No such device (it may have been disconnected)",
+                           errno=19)
+
+    def write(self, dev, endpoint, data):
+        self._transfer_delay()
+        with self.lock:
+            self.check_handle(dev)
+            if getattr(endpoint, 'bEndpointAddress', endpoint) != self.mode_info()[4]:
+                raise USBError("Invalid endpoint", errno=22)
+            self.stats['writes'] += 1
+            data = bytes(data)
+            if len(data) != 0x40:
+                raise USBError("Invalid param", errno=22)
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.stats['dropped'] += 1
+                return len(data)
+            reply = self.handle_packet(CommandPacket._unpack(data))
+            if reply is not None:
+                if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+                    self.stats['corrupted'] += 1
+                    reply = reply._replace(checksum=reply.checksum ^ 0xffff)
+                now = time.monotonic()
+                self.busy_until = max(now, self.busy_until) + self.turnaround
+                self.replies.append((self.busy_until, reply._pack()))
+            if self.reset_mode is not None and self.reset_at is None:
+                # give the host a moment to pick up the reply first
+                self.reset_at = max(time.monotonic(), self.busy_until) + 0.05
+        return len(data)
+
+    def read(self, dev, endpoint, size_or_buffer, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        deadline = time.monotonic() + timeout / 1000.0
+        self._transfer_delay()
+        with self.lock:
+            self.check_handle(dev)
+            if getattr(endpoint, 'bEndpointAddress', endpoint) != self.mode_info()[3]:
+                raise USBError("Invalid endpoint", errno=22)
+            ready = self.replies[0][0] if self.replies else None
+        if ready is None or ready > deadline:
+            time.sleep(max(deadline - time.monotonic(), 0))
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise USBError("Operation timed out", errno=110)
+        time.sleep(max(ready - time.monotonic(), 0))
+        with self.lock:
+            # no check_handle() here: if the reply was ready, it made it out
+            # before any reset that's happened since
+            if dev.generation != self.generation or not self.replies:
+                raise USBError("No such device (it may have been disconnected)",
+                               errno=19)
+            self.stats['reads'] += 1
+            _, reply = self.replies.popleft()
+        # like pyusb: fill in the array we were given and return the count,
+        # or return a new array
+        if isinstance(size_or_buffer, array.array):
+            n = min(len(size_or_buffer), len(reply))
+            size_or_buffer[:n] = array.array('B', reply[:n])
+            return n
+        return array.array('B', reply[:size_or_buffer])
+
+    def reset(self, mode, when=None):
+        '''Reboot into `mode`; the device is gone for a bit, then comes back'''
+        self.stats['resets'] += 1
+        self.reset_at = None
+        self.reset_mode = None
+        self.mode = mode
+        self.generation += 1
+        self.address = (self.address + 16) % 128 or 1
+        if when is None:
+            when = time.monotonic()
+        self.gone_until = when + self.reenumerate
+        self.replies.clear()
+        self.busy_until = 0.0
+        self.hdr = None
+        self.hdr_count = 0
+
+    # --- device side ---
+
+    def handle_packet(self, pkt):
+        '''Handle one CommandPacket; returns a ReplyPacket or None'''
+        if not pkt._checksum_ok():
+            return None
+        if self.mode == self.KeyboardMode:
+            return self.handle_keyboard(pkt)
+        return self.handle_cdboot(pkt)
+
+    @staticmethod
+    def reply(pkt, result=1, pad1=0, pad2=0, data=b''):
+        return ReplyPacket(pkt.cmd, pkt.subcmd, result, pad1, pad2, 0,
+                           bytes(data[:0x38]).ljust(0x38, b'\0'))._replace_checksum()
+
+    def handle_keyboard(self, pkt):
+        if (pkt.cmd, pkt.subcmd) == (1,1):
+            return self.reply(pkt, data=self.fwid)
+        elif (pkt.cmd, pkt.subcmd) == (1,2):
+            return self.reply(pkt, data=self.fwid[:4])
+        elif pkt.cmd == 3 and pkt.subcmd in (1,2):
+            # the reply goes out, then the device drops off the bus
+            self.reset_mode = self.KeyboardMode if pkt.subcmd == 1 else self.CDBootMode
+            return self.reply(pkt)
+        elif (pkt.cmd, pkt.subcmd) == (4,1):
+            # haxed: address bits 16-23 come in the length byte, and we
+            # echo back the low 16 bits of the address and a size of 0x38
+            addr = pkt.offset | (pkt.length << 16)
+            return self.reply(pkt, result=pkt.offset, pad2=0x38,
+                              data=self.peek(addr, 0x38))
+        elif self.keymap_cmds and pkt.cmd in (CfgSetKeysCmd, CfgGetKeysCmd):
+            if pkt.subcmd >= len(self.keymap) or pkt.length > 0x38 or \
+               pkt.offset + pkt.length > len(self.keymap[pkt.subcmd]):
+                return self.reply(pkt, result=0)
+            layer = self.keymap[pkt.subcmd]
+            if pkt.cmd == CfgSetKeysCmd:
+                layer[pkt.offset:pkt.offset+pkt.length] = pkt.data[:pkt.length]
+                return self.reply(pkt)
+            return self.reply(pkt, data=bytes(layer[pkt.offset:pkt.offset+pkt.length]))
+        return self.reply(pkt, result=0)
+
+    def handle_cdboot(self, pkt):
+        if (pkt.cmd, pkt.subcmd) == (1,2):
+            return self.reply(pkt, data=self.fwid[:4])
+        elif (pkt.cmd, pkt.subcmd) == (2,1):
+            self.hdr_count += 1
+            hdr = BImgHdr._unpack(pkt.data[:BImgHdr._struct.size])
+            if not hdr._checksum_ok() or hdr.size > 0x10000 - gk64.fw_base_addr:
+                return self.reply(pkt, result=0)
+            if self.hdr_count == 1:
+                return None # the first copy never gets an answer
+            self.hdr = hdr
+            if self.erase_on_header:
+                end = gk64.fw_base_addr + hdr.size
+                self.flash[gk64.fw_base_addr:end] = b'\xff' * hdr.size
+            return self.reply(pkt)
+        elif (pkt.cmd, pkt.subcmd) == (2,2):
+            if self.hdr is None or pkt.length > 0x38 or \
+               pkt.offset + pkt.length > self.hdr.size:
+                return self.reply(pkt, result=0)
+            if self.nak_rate and self.random.random() < self.nak_rate:
+                self.stats['naks'] += 1
+                return self.reply(pkt, result=0)
+            addr = gk64.fw_base_addr + pkt.offset
+            self.flash[addr:addr+pkt.length] = pkt.data[:pkt.length]
+            return self.reply(pkt)
+        elif (pkt.cmd, pkt.subcmd) == (2,3):
+            if self.hdr is None:
+                return self.reply(pkt, result=0)
+            return self.reply(pkt)
+        elif (pkt.cmd, pkt.subcmd) == (2,5):
+            return self.reply(pkt, data=pkt.data[:8])
+        elif pkt.cmd == 3 and pkt.subcmd in (1,2):
+            self.reset_mode = self.KeyboardMode if pkt.subcmd == 1 else self.CDBootMode
+            return self.reply(pkt)
+        return self.reply(pkt, result=0)
+
+    def image_ok(self, bindata):
+        '''True if flash holds bindata at the firmware base address'''
+        base = gk64.fw_base_addr
+        return bytes(self.flash[base:base+len(bindata)]) == bytes(bindata)
+
+class SimTransport(object):
+    '''Stands in for usb.core as GK64's transport
+
+    Holds one or more SimKeyboards; find() behaves like usb.core.find(),
+    including find_all=True and the bus/address/idProduct filters.
+    '''
+    def __init__(self, keyboards=None, **kwargs):
+        if keyboards is None:
+            keyboards = [SimKeyboard(**kwargs)]
+        self.keyboards = list(keyboards)
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__, self.keyboards)
+
+    def find(self, find_all=False, **match):
+        found = []
+        for kbd in self.keyboards:
+            dev = kbd.handle()
+            if dev is None:
+                continue
+            if all(getattr(dev, k) == v for k, v in match.items()):
+                found.append(dev)
+        if find_all:
+            return iter(found)
+        return found[0] if found else None
+
+    def stats(self):
+        '''Combined fault/transfer counters for all the keyboards'''
+        total = dict()
+        for kbd in self.keyboards:
+            for k, v in kbd.stats.items():
+                total[k] = total.get(k, 0) + v
+        return total
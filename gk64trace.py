@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+# gk64trace.py - find out where the time goes when talking to a GK64
+#
+#   ./gk64.py --stats stats.json --trace trace.json dump 0 10000 flash.bin
+#   ./gk64trace.py stats.json            # summarize it again later
+#
+# Then load trace.json into https://ui.perfetto.dev/ (or chrome://tracing).
+#
+# A Tracer gets hooked in by wrapping the GK64's USB device (GK64.find_dev
+# does that whenever GK64.trace is set), so it sees every packet go out and
+# every reply come back:
+#
+#   * per-cmd/subcmd round trip latency (send -> matching reply), plus how
+#     long the USB writes and reads themselves block, as log2 histograms
+#   * counters: packets, replies, timeouts (per cmd, going by the oldest
+#     unanswered request), unmatched replies, and the retry counters the
+#     fwup/dump code bumps
+#   * spans for mode switches, firmware uploads and dumps, with their
+#     throughput
+#
+# All of it is kept per board too, so one slow keyboard in a fleet stands
+# out. With no tracer set, GK64 talks to the device directly and nothing
+# here runs at all, so it costs nothing to leave the hooks in.
+#
+# Round trips get matched up by cmd/subcmd, oldest request first. That's
+# exact for send-wait-send, and right for windowed requests as long as the
+# device answers in order (it does); if replies go missing, the next few
+# round trips for that cmd will look slow.
+
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+
+from usb.core import USBError
+
+class Histogram(object):
+    '''Durations in log2 buckets: bucket n counts samples under 2**n us
+    (and at least 2**(n-1) us, apart from bucket 0)'''
+    nbuckets = 28   # the last one is everything over ~67 seconds
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * self.nbuckets
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), self.nbuckets - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        '''Estimate of the p'th percentile, in seconds (the buckets are
+        coarse, so this assumes samples are spread evenly within one)'''
+        want = self.count * p / 100.0
+        seen = 0
+        for n, count in enumerate(self.buckets):
+            if count and seen + count >= want:
+                low = (1 << n - 1) / 1e6 if n else 0.0
+                high = (1 << n) / 1e6
+                estimate = low + (high - low) * (want - seen) / count
+                return min(max(estimate, self.min), self.max)
+            seen += count
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return dict(count=0)
+        return dict(count=self.count,
+                    mean_us=round(self.total / self.count * 1e6, 1),
+                    min_us=round(self.min * 1e6, 1),
+                    p50_us=round(self.percentile(50) * 1e6, 1),
+                    p90_us=round(self.percentile(90) * 1e6, 1),
+                    p99_us=round(self.percentile(99) * 1e6, 1),
+                    max_us=round(self.max * 1e6, 1),
+                    buckets={"<{}us".format(1 << n): count
+                             for n, count in enumerate(self.buckets) if count})
+
+class BoardStats(object):
+    '''Everything a Tracer keeps about one keyboard'''
+    def __init__(self, name, tid):
+        self.name = name
+        self.tid = tid
+        self.histograms = dict()    # name -> Histogram
+        self.counters = dict()
+        self.spans = dict()         # name -> [count, seconds, bytes]
+        self.outstanding = dict()   # (cmd, subcmd) -> deque of (send time, id)
+
+    def add(self, name, seconds):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram()
+        hist.add(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        return dict(counters=dict(sorted(self.counters.items())),
+                    latency={name: hist.summary()
+                             for name, hist in sorted(self.histograms.items())},
+                    spans={name: _span_summary(*totals)
+                           for name, totals in sorted(self.spans.items())})
+
+def _span_summary(count, seconds, nbytes):
+    summary = dict(count=count, seconds=round(seconds, 6))
+    if nbytes:
+        summary['bytes'] = nbytes
+        summary['bytes_per_sec'] = round(nbytes / seconds, 1) if seconds else None
+    return summary
+
+def _cmd_name(cmd, subcmd):
+    return "cmd {:02x}:{:02x}".format(cmd, subcmd)
+
+class TracedDevice(object):
+    '''Wraps a usb.core.Device (or SimDevice) and reports writes and reads
+    to a Tracer; everything else goes straight through.'''
+    def __init__(self, dev, tracer, board):
+        self._dev = dev
+        self._tracer = tracer
+        self._board = board
+
+    def __getattr__(self, name):
+        return getattr(self._dev, name)
+
+    def __getitem__(self, key):
+        return self._dev[key]
+
+    def __repr__(self):
+        return repr(self._dev)
+
+    def write(self, endpoint, data, *args, **kwargs):
+        start = time.monotonic()
+        n = self._dev.write(endpoint, data, *args, **kwargs)
+        self._tracer._sent(self._board, data[0], data[1], start, time.monotonic())
+        return n
+
+    def read(self, endpoint, size_or_buffer, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            r = self._dev.read(endpoint, size_or_buffer, *args, **kwargs)
+        except USBError as e:
+            if e.errno == 110:
+                self._tracer._timeout(self._board, start, time.monotonic())
+            raise
+        data = size_or_buffer if r is None or isinstance(r, int) else r
+        self._tracer._received(self._board, data[0], data[1], start, time.monotonic())
+        return r
+
+class Tracer(object):
+    '''Collects latency histograms, counters, spans and trace events for
+    any number of GK64s (see the top of this file).
+
+    Set GK64.trace = tracer to trace every GK64 from then on, or call
+    attach(kbd) for just one. max_events caps how many trace events are
+    kept (the oldest go first); 0 keeps only the stats.
+    '''
+    def __init__(self, max_events=200000):
+        self.lock = threading.Lock()
+        self.boards = dict()    # board name -> BoardStats
+        self.events = deque(maxlen=max_events) if max_events else None
+        self.started = time.monotonic()
+        self.started_wall = time.time()
+        self.next_id = 0
+
+    # --- hooking up ---
+
+    def attach(self, kbd):
+        '''Trace one GK64 (and keep tracing it across re-enumeration)'''
+        kbd.trace = self
+        if kbd.dev is not None and not isinstance(kbd.dev, TracedDevice):
+            kbd.dev = self.wrap(kbd)
+        return kbd
+
+    def wrap(self, kbd):
+        '''Returns kbd.dev wrapped in a TracedDevice; GK64.find_dev calls this'''
+        return TracedDevice(kbd.dev, self, self.board(kbd))
+
+    @staticmethod
+    def board_name(kbd):
+        # by port path if we know it, since the address changes on every
+        # mode switch
+        if kbd.port_numbers:
+            return "{}-{}".format(kbd.bus, ".".join(str(p) for p in kbd.port_numbers))
+        return "{:03d}:{:03d}".format(kbd.bus or 0, kbd.dev.address if kbd.dev else 0)
+
+    def board(self, kbd):
+        # kbd can also just be a board name (gk64capture uses that)
+        name = kbd if isinstance(kbd, str) else self.board_name(kbd)
+        with self.lock:
+            board = self.boards.get(name)
+            if board is None:
+                board = self.boards[name] = BoardStats(name, len(self.boards) + 1)
+            return board
+
+    # --- things that happened ---
+
+    def _ts(self, t):
+        return round((t - self.started) * 1e6, 1)
+
+    def _event(self, **event):
+        if self.events is not None:
+            event['pid'] = 1
+            self.events.append(event)
+
+    def _sent(self, board, cmd, subcmd, start, end):
+        with self.lock:
+            board.count('packets')
+            board.add('usb write', end - start)
+            eid = self.next_id
+            self.next_id += 1
+            board.outstanding.setdefault((cmd, subcmd), deque(maxlen=256)).append((start, eid))
+            if self.events is not None:
+                name = _cmd_name(cmd, subcmd)
+                self._event(name='write', cat='usb', ph='X', tid=board.tid,
+                            ts=self._ts(start), dur=round((end - start) * 1e6, 1),
+                            args=dict(cmd=name))
+                self._event(name=name, cat='cmd', ph='b', id=eid, tid=board.tid,
+                            ts=self._ts(start))
+
+    def _received(self, board, cmd, subcmd, start, end):
+        # start is None if all we know is when the reply turned up (captures:
+        # an IN transfer gets submitted long before there's anything to read)
+        name = _cmd_name(cmd, subcmd)
+        with self.lock:
+            board.count('replies')
+            if start is not None:
+                board.add('usb read', end - start)
+            waiting = board.outstanding.get((cmd, subcmd))
+            if not waiting:
+                board.count('unmatched replies')
+                return
+            sent, eid = waiting.popleft()
+            board.add(name, end - sent)
+            if self.events is not None:
+                if start is not None:
+                    self._event(name='read', cat='usb', ph='X', tid=board.tid,
+                                ts=self._ts(start), dur=round((end - start) * 1e6, 1),
+                                args=dict(cmd=name))
+                self._event(name=name, cat='cmd', ph='e', id=eid, tid=board.tid,
+                            ts=self._ts(end))
+
+    def _timeout(self, board, start, end):
+        with self.lock:
+            board.count('timeouts')
+            board.add('usb read timeout', end - start)
+            oldest = min(((w[0][0], key) for key, w in board.outstanding.items() if w),
+                         default=None)
+            name = _cmd_name(*oldest[1]) if oldest else None
+            if name:
+                board.count('timeouts ' + name)
+            self._event(name='timeout', cat='usb', ph='i', s='t', tid=board.tid,
+                        ts=self._ts(end), args=dict(cmd=name))
+
+    def count(self, kbd, name, n=1):
+        '''Bump a counter (e.g. retries) for kbd's board'''
+        board = self.board(kbd)
+        with self.lock:
+            board.count(name, n)
+
+    def add_span(self, kbd, name, start, end=None, nbytes=0, **args):
+        '''Record that `name` ran from start to end (time.monotonic()),
+        moving nbytes, e.g. a dump or a firmware upload'''
+        end = end if end is not None else time.monotonic()
+        board = self.board(kbd)
+        with self.lock:
+            totals = board.spans.setdefault(name, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += end - start
+            totals[2] += nbytes
+            if nbytes:
+                args['bytes'] = nbytes
+            self._event(name=name, cat='span', ph='X', tid=board.tid,
+                        ts=self._ts(start), dur=round((end - start) * 1e6, 1),
+                        args=args)
+
+    def span(self, kbd, name, nbytes=0, **args):
+        '''Context manager version of add_span'''
+        return _Span(self, kbd, name, nbytes, args)
+
+    # --- getting it back out ---
+
+    def stats(self):
+        '''Everything but the trace events, as a JSON-friendly dict'''
+        with self.lock:
+            boards = {name: board.summary() for name, board in sorted(self.boards.items())}
+        total = BoardStats('all', 0)
+        with self.lock:
+            for board in self.boards.values():
+                for name, n in board.counters.items():
+                    total.count(name, n)
+                for name, hist in board.histograms.items():
+                    merged = total.histograms.setdefault(name, Histogram())
+                    merged.count += hist.count
+                    merged.total += hist.total
+                    merged.max = max(merged.max, hist.max)
+                    if hist.min is not None and (merged.min is None or hist.min < merged.min):
+                        merged.min = hist.min
+                    merged.buckets = [a + b for a, b in zip(merged.buckets, hist.buckets)]
+                for name, totals in board.spans.items():
+                    merged = total.spans.setdefault(name, [0, 0.0, 0])
+                    for n, value in enumerate(totals):
+                        merged[n] += value
+        stats = total.summary()
+        stats['started'] = self.started_wall
+        stats['elapsed'] = round(time.monotonic() - self.started, 6)
+        stats['boards'] = boards
+        return stats
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.stats(), f, indent=1)
+            f.write('\n')
+
+    def chrome_trace(self):
+        '''The events in Chrome trace event format (Perfetto reads it too)'''
+        with self.lock:
+            events = list(self.events or ())
+            names = [(board.tid, name) for name, board in self.boards.items()]
+        meta = [dict(name='process_name', ph='M', pid=1, args=dict(name='gk64'))]
+        meta += [dict(name='thread_name', ph='M', pid=1, tid=tid, args=dict(name=name))
+                 for tid, name in sorted(names)]
+        return dict(traceEvents=meta + events, displayTimeUnit='ms')
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+class _Span(object):
+    def __init__(self, tracer, kbd, name, nbytes, args):
+        self.tracer = tracer
+        self.kbd = kbd
+        self.name = name
+        self.nbytes = nbytes
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_span(self.kbd, self.name, self.start, nbytes=self.nbytes,
+                             **self.args)
+
+def print_stats(stats, out=None):
+    out = out if out is not None else sys.stdout
+    def section(indent, s):
+        for name, n in s.get('counters', {}).items():
+            print("{}{:<28} {:>10}".format(indent, name, n), file=out)
+        for name, h in s.get('latency', {}).items():
+            if h['count']:
+                print("{}{:<28} {:>10} x  p50 {:>9.0f}us  p99 {:>9.0f}us  max {:>9.0f}us".format(
+                      indent, name, h['count'], h['p50_us'], h['p99_us'], h['max_us']),
+                      file=out)
+        for name, sp in s.get('spans', {}).items():
+            rate = sp.get('bytes_per_sec')
+            print("{}{:<28} {:>10} x  {:>9.3f}s{}".format(
+                  indent, name, sp['count'], sp['seconds'],
+                  "  {:.0f} bytes/sec".format(rate) if rate else ""), file=out)
+    section("", stats)
+    if len(stats.get('boards', {})) > 1:
+        for name, board in stats['boards'].items():
+            print("{}:".format(name), file=out)
+            section("  ", board)
+
+def main(args):
+    if not args:
+        print("usage: {} stats.json".format(os.path.basename(sys.argv[0])))
+        raise SystemExit(2)
+    with open(args[0]) as f:
+        print_stats(json.load(f))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])